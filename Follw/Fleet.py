@@ -0,0 +1,177 @@
+import logging, time, threading, heapq, json, concurrent.futures
+from Follw import Follw
+from Transport import Transport
+from Outbox import Outbox
+from Replay import Replay
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class FixedSource:
+  """ Location source which always returns the same configured location """
+  def __init__(self, config):
+    self.location = [config['latitude'], config['longitude']] + [config.get(key) for key in ['accuracy', 'altitude', 'direction', 'speed']]
+    while self.location[-1] is None:
+      self.location.pop()
+    self.method = 'Fixed'
+
+  def getLocation(self):
+    return list(self.location)
+
+  def stop(self):
+    pass
+
+class GPSdSource:
+  """ Location source which reads from a (remote) GPS daemon, readers are shared between shares """
+  readers = {}
+  maxAge = 10
+  # Guards starting the shared readers
+  lock = threading.Lock()
+
+  def __init__(self, config):
+    # The GPSd library is only imported when a fleet uses GPSd
+    from GPSReader import GPSReader, gps
+    if not gps:
+      raise ValueError("GPSd library not installed")
+    key = (config.get('host', GPSReader.host), int(config.get('port', GPSReader.port)))
+    if key not in self.readers:
+      self.readers[key] = GPSReader(*key)
+    self.reader = self.readers[key]
+    self.maxAge = config.get('maxAge', self.maxAge)
+    self.method = 'GPS'
+
+  def getLocation(self):
+    # The configuration is loaded before daemonizing and threads don't survive the fork, so the reader is started on first use
+    if self.reader.ident is None:
+      with self.lock:
+        if self.reader.ident is None:
+          self.reader.start()
+    return self.reader.getLocation(self.maxAge)
+
+  def stop(self):
+    self.reader.stop()
+
+class ReplaySource(Replay):
+  """ Location source which plays back a recording """
+  def __init__(self, config):
+    super().__init__(config['file'], config.get('speed'), config.get('loop'), config.get('format'))
+
+# Location source types which can be used in a fleet configuration
+sourceTypes = {
+  'fixed': FixedSource,
+  'gpsd': GPSdSource,
+  'replay': ReplaySource
+  }
+
+class Fleet:
+  """ Runs many shares in one process with a shared connection pool and a bounded number of workers """
+  # Maximum number of shares that are acquiring or submitting at the same time
+  workers = 8
+  interval = Follw.interval
+
+  def __init__(self, config, outboxPath = None):
+    self.terminate = False
+    self.lock = threading.Lock()
+    self.event = threading.Event()
+    # Heap of (due, index) tuples, a share is only in the heap when it's not running
+    self.heap = []
+
+    self.workers = config.get('workers', self.workers)
+    self.interval = config.get('interval', self.interval)
+
+    self.transport = Transport()
+    self.outbox = Outbox(self.resubmitLocation, outboxPath)
+    self.shares = []
+    self.sharesByUrl = {}
+    for shareConfig in config.get('shares', []):
+      sourceConfig = shareConfig.get('source', {})
+      sourceType = sourceTypes.get(sourceConfig.get('type'))
+      if not sourceType:
+        raise ValueError("Unsupported location source type {}".format(sourceConfig.get('type')))
+
+      share = Follw(location=sourceType(sourceConfig), transport=self.transport, outbox=self.outbox)
+      share.url = shareConfig['url']
+      share.interval = shareConfig.get('interval', self.interval)
+      share.scheduler.setInterval(share.interval)
+      if 'schedule' in shareConfig:
+        share.scheduler.mode = shareConfig['schedule']
+      self.shares.append(share)
+      self.sharesByUrl[share.url] = share
+
+  @classmethod
+  def load(cls, path, outboxPath = None):
+    """ Load a fleet from a JSON configuration file """
+    with open(path) as file:
+      return cls(json.load(file), outboxPath)
+
+  def stop(self, signum = None, frame = None):
+    """ Stop the fleet """
+    logger.info("Stopping Follw fleet")
+    self.terminate = True
+    self.event.set()
+    self.outbox.stop()
+    for share in self.shares:
+      share.location.stop()
+    self.transport.close()
+
+  def resubmitLocation(self, url, location):
+    share = self.sharesByUrl.get(url)
+    if not share:
+      logger.debug("Dropping pending location of an unknown share")
+      return True, None
+    return share.resubmitLocation(url, location)
+
+  def runShare(self, index):
+    share = self.shares[index]
+    submitted = False
+    try:
+      # Returns right away since the share is due, but records the start of the run
+      share.scheduler.wait()
+      submitted = share.cycle()
+    except Exception as e:
+      logger.exception(e)
+    share.scheduler.done(submitted)
+
+    if share.terminate:
+      logger.warning("Share {} stopped".format(index))
+      return
+
+    with self.lock:
+      heapq.heappush(self.heap, (share.scheduler.due, index))
+    self.event.set()
+
+  def run(self):
+    """ The main loop of the fleet """
+    logger.info("Starting Follw fleet with {} shares".format(len(self.shares)))
+    self.outbox.start()
+
+    now = time.monotonic()
+    self.heap = [(now, index) for index in range(len(self.shares))]
+    running = threading.BoundedSemaphore(self.workers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Fleet') as executor:
+      while not self.terminate:
+        with self.lock:
+          timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+          if timeout is not None and timeout <= 0:
+            due, index = heapq.heappop(self.heap)
+          else:
+            index = None
+
+        if index is None:
+          self.event.wait(timeout)
+          self.event.clear()
+          continue
+
+        # Don't queue more runs than there are workers, so late shares keep their place in the heap
+        running.acquire()
+        if self.terminate:
+          break
+        future = executor.submit(self.runShare, index)
+        future.add_done_callback(lambda future: running.release())
+
+      executor.shutdown(wait=True, cancel_futures=True)
+
+    # Writes the pending locations the outbox thread didn't get to yet
+    self.outbox.close(self.transport.timeout)
+    logger.info("Stopped Follw fleet")
@@ -1,5 +1,11 @@
-import sys, logging, signal, time, urllib.request, urllib.parse, json, os, platform, re, argparse, socket
+import logging, time, threading, urllib.parse
 from Location import Location
+from Transport import Transport, TransportError, Endpoint
+from Scheduler import Scheduler
+from Outbox import Outbox, parseRetryAfter
+from MovementFilter import MovementFilter
+from Metrics import metrics
+from LatestQueue import LatestQueue
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -9,94 +15,281 @@ class Follw:
   url = None
   interval = 5
   oneshot = False
-  online = True
+  isOnline = True
+  # Wake up as soon as a location source pushes a new location
+  wakeOnFix = False
+  # Acquire and submit on separate threads, so a slow submission never delays the next acquisition
+  pipeline = True
 
   location = None
+  transport = None
+  endpoint = None
+  scheduler = None
+  previousLocation = None
+  outbox = None
+  movementFilter = None
+  # Serves the location to other local processes
+  server = None
+  # Hands the acquired locations over to the submission thread
+  queue = None
+  # Privacy zones and regions with their own interval
+  geofences = None
+  # Redirects of the sharing URL that are followed per submission
+  maxRedirects = 5
 
-  def __init__(self):
-    self.location = Location()
+  def __init__(self, outboxPath = None, location = None, transport = None, outbox = None):
+    # A location source, transport and outbox can be shared when running many shares in one process
+    self.location = location or Location()
+    self.transport = transport or Transport()
+    self.scheduler = Scheduler()
+    self.movementFilter = MovementFilter()
+    self.outbox = outbox or Outbox(self.resubmitLocation, outboxPath)
 
   def stop(self, signum = None, frame = None):
     """ Stop the Follw process """
     logger.info("Stopping Follw")
     self.terminate = True
+    self.scheduler.stop()
+    if self.queue is not None:
+      self.queue.close()
+    self.outbox.stop()
+    if self.server:
+      self.server.stop()
     self.location.stop()
+    self.transport.close()
 
   def online(self, online = True):
-    self.online = online
+    wasOnline = self.isOnline
+    self.isOnline = online
+    self.location.online(online)
+    if online and not wasOnline:
+      # Connectivity is back, submit pending locations right away
+      self.outbox.flush()
 
   def offline(self, offline = True):
-    self.online = not online
+    self.online(not offline)
 
   def run(self):
     """ The main loop of the Follw process """
-    previousLocation = None
-    _time = 0
-    while not self.terminate:
-      location = None
+    self.scheduler.setInterval(self.interval)
+    if self.wakeOnFix:
+      self.location.listeners.append(self.onLocation)
+    if not self.oneshot:
+      self.outbox.start()
+      # After a network change the Follw.app WebService may well be reachable again
+      watcher = self.location.getNetworkWatcher()
+      if watcher:
+        watcher.listeners.append(self.onNetworkChange)
+      if self.server:
+        self.server.start()
+
+    submitter = None
+    if self.pipeline and not self.oneshot:
+      self.queue = LatestQueue()
+      submitter = threading.Thread(target=self.submitWorker, name='Submitter', daemon=True)
+      submitter.start()
 
-      elapsedTime = time.time() - _time
-      if elapsedTime > self.interval:
-        location = self.location.getLocation()
+    while self.scheduler.wait():
+      if submitter:
+        location = self.acquire()
+        if location:
+          # Replaces a location the submission thread didn't get to yet
+          self.queue.put(location)
+        success = bool(location)
+      else:
+        success = self.cycle()
 
-        if location and location != previousLocation:
-          if self.submitLocation(*location):
-            previousLocation = location
-            _time = time.time()
+      if self.oneshot:
+        # There is no outbox thread in oneshot mode, retry the pending locations which are due once
+        self.outbox.process()
+        break
+      if self.terminate:
+        break
+      self.scheduler.done(success)
 
-        if self.oneshot:
-          break
-      time.sleep(0.1)
+    if submitter:
+      self.queue.close()
+      # Let a submission which is in progress finish
+      submitter.join(self.transport.timeout)
+      if self.queue.dropped:
+        logger.debug("Dropped {} locations which were superseded before they could be submitted".format(self.queue.dropped))
+
+    if not self.oneshot:
+      # Writes the pending locations the outbox thread didn't get to yet
+      self.outbox.close(self.transport.timeout)
 
     if self.terminate:
       logger.info("Stopped Follw")
 
-  def submitLocation(self, latitude, longitude, accuracy = None, altitude = None, direction = None, speed = None):
-    parsedUrl = urllib.parse.urlparse(self.url)
+  def submitWorker(self):
+    """ Submits the locations handed over by the main loop """
+    while not self.terminate:
+      location = self.queue.get()
+      if location is None:
+        break
+      self.handleLocation(location)
+      if self.terminate:
+        # The share doesn't exist anymore, stop the main loop
+        self.scheduler.stop()
+
+  def onNetworkChange(self, events):
+    """ Called by the network watcher, retries the pending locations right away """
+    self.outbox.flush()
+
+  def onLocation(self, location):
+    """ Called by location sources which push a new location """
+    self.scheduler.wake()
 
-    if not self.online:
+  def cycle(self):
+    """ Get the current location and submit it when it has been changed enough """
+    location = self.acquire()
+    if not location:
       return False
 
-    url = parsedUrl.scheme
-    url += "://"
-    url += parsedUrl.netloc
-    if parsedUrl.path:
-      url += parsedUrl.path
-    else:
-      url += "/"
-    url += "?"
-    if parsedUrl.query:
-      url += parsedUrl.query
-      url += "&"
-    url += 'la={}&lo={}'.format(latitude, longitude)
+    return self.handleLocation(location)
+
+  def acquire(self):
+    """ Get the current location and adapt the interval to whether we're moving """
+    location = self.location.getLocation()
+    if location:
+      interval = self.movementFilter.getInterval(location, self.interval)
+      if self.geofences:
+        self.geofences.update(location)
+        interval = self.geofences.getInterval(interval)
+      self.scheduler.setInterval(interval)
+    return location
+
+  def handleLocation(self, location):
+    """ Submit the location when it has been changed enough, returns False when it should be retried soon """
+    if self.geofences:
+      # Each location is checked on its own, the submission can lag behind the last geofence events
+      location = self.geofences.apply(location)
+      if location is None:
+        return True
+
+    if not self.movementFilter.accept(location):
+      # Not worth submitting, but there is no need to retry early either
+      return True
+
+    # Fleet sources return plain location lists, which don't know when they were measured
+    fixTime = getattr(location, 'time', None)
+    if fixTime is not None:
+      metrics.observe('follw_fix_age_seconds', time.monotonic() - fixTime)
+
+    if self.deliverLocation(location):
+      self.movementFilter.submitted(location)
+      self.previousLocation = location
+      return True
+
+    return False
+
+  def deliverLocation(self, location):
+    """ Submit the location, or queue it in the outbox when it can't be submitted right now """
+    # Only the location itself is submitted, not the time and source of a fix
+    location = list(location[:6])
+    if not self.isOnline or (self.outbox.has(self.url) and not self.outbox.isDue(self.url) and not self.outbox.probe(self.url)):
+      # Don't interfere with the backoff of the outbox, just replace the pending location
+      self.outbox.put(self.url, location)
+      return True
+
+    success, retry, retryAfter = self.submit(*location)
+    if success:
+      self.outbox.remove(self.url)
+      # The Follw.app WebService can be reached again, submit other pending locations right away
+      self.outbox.flush()
+      return True
+    if retry:
+      self.outbox.put(self.url, location, retryAfter)
+      if self.oneshot:
+        return False
+      return True
+
+    return False
+
+  def resubmitLocation(self, url, location):
+    """ Called by the outbox to retry a pending location, returns a tuple (done, retryAfter) """
+    if url != self.url:
+      logger.debug("Dropping pending location of an other share")
+      return True, None
+
+    success, retry, retryAfter = self.submit(*location)
+    return success or not retry, retryAfter
+
+  def submitLocation(self, latitude, longitude, accuracy = None, altitude = None, direction = None, speed = None):
+    """ Submit the location, returns True on success """
+    return self.submit(latitude, longitude, accuracy, altitude, direction, speed)[0]
+
+  def submit(self, latitude, longitude, accuracy = None, altitude = None, direction = None, speed = None):
+    """ Submit the location, returns a tuple (success, retry, retryAfter) """
+    if not self.isOnline:
+      return False, True, None
+
+    # Only parse the sharing URL again when it has been changed
+    if not self.endpoint or self.endpoint.url != self.url:
+      self.endpoint = Endpoint(self.url)
+
+    query = 'la={}&lo={}'.format(latitude, longitude)
     if accuracy:
-      url += '&ac={}'.format(accuracy)
+      query += '&ac={}'.format(accuracy)
     if altitude:
-      url += '&al={}'.format(altitude)
+      query += '&al={}'.format(altitude)
     if direction:
-      url += '&di={}'.format(direction)
+      query += '&di={}'.format(direction)
     if speed:
-      url += '&sp={}'.format(speed)
-    logger.debug(url);
+      query += '&sp={}'.format(speed)
+    target = self.endpoint.target(query)
+    logger.debug(target)
 
-    try:
-      urllib.request.urlopen(url, timeout=1)
+    scheme, netloc = self.endpoint.scheme, self.endpoint.netloc
+    for redirects in range(self.maxRedirects + 1):
+      try:
+        response = self.transport.request(scheme, netloc, target)
+      except TransportError as e:
+        logger.error(e)
+        metrics.increment('follw_submit_total', status='error')
+        return False, True, None
+      if response.status not in (301, 302, 303, 307, 308) or not response.headers.get('Location'):
+        break
 
+      url = urllib.parse.urljoin('{}://{}{}'.format(scheme, netloc, target), response.headers['Location'])
+      logger.debug("Redirected to {}".format(url))
+      parsedUrl = urllib.parse.urlsplit(url)
+      if parsedUrl.scheme not in ('http', 'https'):
+        logger.error("Unsupported redirect to {}".format(url))
+        return False, False, None
+      scheme, netloc, target = parsedUrl.scheme, parsedUrl.netloc, parsedUrl.path + ('?' + parsedUrl.query if parsedUrl.query else '')
+
+      if response.status in (301, 308) and parsedUrl.query.endswith(query):
+        # Moved permanently, submit to the new location right away from now on
+        base = urllib.parse.urlunsplit(parsedUrl._replace(query=parsedUrl.query[:-len(query)].rstrip('&'), fragment=''))
+        self.endpoint = Endpoint(base)
+        # Keep the sharing URL, so the endpoint isn't parsed again on the next submission
+        self.endpoint.url = self.url
+    else:
+      logger.error("Too many redirects")
+      metrics.increment('follw_submit_total', status='error')
+      return False, True, None
+
+    logger.debug("Submit latency {:.3f}s".format(response.latency))
+    metrics.observe('follw_submit_duration_seconds', response.latency)
+    metrics.increment('follw_submit_total', status=str(response.status))
+    if 200 <= response.status < 300:
       logger.info("Submitted location")
-      return True
-    except urllib.error.HTTPError as e:
-      if e.code == 404:
-        logger.error("Follw share ID does not exist")
-        self.terminate = True
-      elif e.code == 410:
-        logger.error("Follw share ID is deleted")
-        self.terminate = True
-      else:
-        logger.error(e.code)
-        logger.error(e.reason)
-    except urllib.error.URLError as e:
-      logger.error(e.reason)
-    except socket.timeout as e:
-      logger.error(e)
-
-    return False
\ No newline at end of file
+      return True, False, None
+
+    if response.status == 429 or response.status >= 500:
+      logger.error(response.status)
+      logger.error(response.reason)
+      return False, True, parseRetryAfter(response.headers.get('Retry-After'))
+
+    if response.status == 404:
+      logger.error("Follw share ID does not exist")
+      self.terminate = True
+    elif response.status == 410:
+      logger.error("Follw share ID is deleted")
+      self.terminate = True
+    else:
+      logger.error(response.status)
+      logger.error(response.reason)
+
+    return False, False, None
@@ -0,0 +1,152 @@
+import logging, math
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+earthRadius = 6371008.8
+
+# Accuracy in meters of a location source which doesn't report its accuracy
+defaultAccuracies = {
+  'GPS': 10,
+  'CoreLocation': 20,
+  'LocationServices': 20,
+  'WiFi': 50,
+  'IP': 5000
+  }
+
+class KalmanFilter:
+  """ Constant velocity Kalman filter over locations from several sources
+
+  The state is the position and velocity in a local east/north plane. With an isotropic measurement
+  noise both axes share the same covariance, so one 2x2 covariance is kept for both axes.
+  """
+  # Acceleration noise spectral density in m²/s³, how fast the velocity can change
+  accelerationNoise = 1.0
+  # Variance in m²/s² of the initial velocity
+  initialVelocityVariance = 100
+  # Below this speed in m/s the heading is unreliable and not reported
+  minimumHeadingSpeed = 0.5
+  # The local plane is moved when the position is farther than this many meters from its origin
+  maximumOriginDistance = 100000
+
+  def __init__(self):
+    if numpy is None:
+      raise ImportError("NumPy is required for location fusion")
+    self.reset()
+
+  def reset(self):
+    self.origin = None
+    self.time = None
+    # Position and velocity, east and north
+    self.east = 0.0
+    self.north = 0.0
+    self.velocityEast = 0.0
+    self.velocityNorth = 0.0
+    # Covariance of position and velocity, shared by both axes
+    self.p00 = 0.0
+    self.p01 = 0.0
+    self.p11 = 0.0
+
+  def setOrigin(self, latitude, longitude):
+    if self.origin is not None:
+      # Keep the state, but express it relative to the new origin
+      latitude0, longitude0 = self.toLatitudeLongitude(numpy.array([self.east]), numpy.array([self.north]))
+      self.origin = (float(latitude0[0]), float(longitude0[0]))
+      self.east = 0.0
+      self.north = 0.0
+    else:
+      self.origin = (latitude, longitude)
+    self.cosOrigin = math.cos(math.radians(self.origin[0]))
+
+  def toEastNorth(self, latitudes, longitudes):
+    east = numpy.radians(longitudes - self.origin[1]) * earthRadius * self.cosOrigin
+    north = numpy.radians(latitudes - self.origin[0]) * earthRadius
+    return east, north
+
+  def toLatitudeLongitude(self, east, north):
+    latitudes = self.origin[0] + numpy.degrees(north / earthRadius)
+    longitudes = self.origin[1] + numpy.degrees(east / (earthRadius * self.cosOrigin))
+    return latitudes, longitudes
+
+  def filter(self, fixes):
+    """ Process a batch of fixes, rows of (time, latitude, longitude, accuracy) sorted by time
+
+    Returns an array with rows of (time, latitude, longitude, accuracy, heading, speed), the
+    filtered state after each fix. The heading is NaN when the speed is too low to know it. Fixes
+    older than a fix processed before can't be applied without rewinding the state, they are
+    dropped and have no row.
+    """
+    fixes = numpy.asarray(fixes, dtype=float).reshape(-1, 4)
+    previous = numpy.maximum.accumulate(numpy.concatenate(([-numpy.inf if self.time is None else self.time], fixes[:, 0])))[:-1]
+    fixes = fixes[fixes[:, 0] >= previous]
+    count = len(fixes)
+    result = numpy.empty((count, 6))
+    if count == 0:
+      return result
+
+    if self.origin is None:
+      self.setOrigin(fixes[0, 1], fixes[0, 2])
+
+    times = fixes[:, 0].tolist()
+    variances = (fixes[:, 3] ** 2).tolist()
+    east, north = self.toEastNorth(fixes[:, 1], fixes[:, 2])
+    east = east.tolist()
+    north = north.tolist()
+    states = numpy.empty((count, 5))
+
+    q = self.accelerationNoise
+    for i in range(count):
+      if self.time is None:
+        self.east = east[i]
+        self.north = north[i]
+        self.velocityEast = 0.0
+        self.velocityNorth = 0.0
+        self.p00 = variances[i]
+        self.p01 = 0.0
+        self.p11 = self.initialVelocityVariance
+      else:
+        # Predict
+        dt = times[i] - self.time
+        self.east += dt * self.velocityEast
+        self.north += dt * self.velocityNorth
+        self.p00 += dt * (2 * self.p01 + dt * self.p11) + q * dt ** 3 / 3
+        self.p01 += dt * self.p11 + q * dt ** 2 / 2
+        self.p11 += q * dt
+
+        # Update
+        s = self.p00 + variances[i]
+        k0 = self.p00 / s
+        k1 = self.p01 / s
+        innovationEast = east[i] - self.east
+        innovationNorth = north[i] - self.north
+        self.east += k0 * innovationEast
+        self.north += k0 * innovationNorth
+        self.velocityEast += k1 * innovationEast
+        self.velocityNorth += k1 * innovationNorth
+        self.p11 -= k1 * self.p01
+        self.p00 *= 1 - k0
+        self.p01 *= 1 - k0
+      self.time = times[i]
+      states[i] = (self.east, self.north, self.velocityEast, self.velocityNorth, self.p00)
+
+    latitudes, longitudes = self.toLatitudeLongitude(states[:, 0], states[:, 1])
+    speeds = numpy.hypot(states[:, 2], states[:, 3])
+    headings = numpy.degrees(numpy.arctan2(states[:, 2], states[:, 3])) % 360
+    headings[speeds < self.minimumHeadingSpeed] = numpy.nan
+
+    result[:, 0] = fixes[:, 0]
+    result[:, 1] = latitudes
+    result[:, 2] = longitudes
+    result[:, 3] = numpy.sqrt(states[:, 4])
+    result[:, 4] = headings
+    result[:, 5] = speeds
+
+    if math.hypot(self.east, self.north) > self.maximumOriginDistance:
+      self.setOrigin(None, None)
+
+    return result
@@ -0,0 +1,287 @@
+import logging, time, threading, selectors
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# GPS Hardware
+try:
+  import gps
+except ImportError:
+  gps = None
+  logger.warning("GPSd library not installed")
+
+def parseEndpoint(value):
+  """ Parse a GPSd endpoint host[:port][/device] into (host, port, device), IPv6 hosts in brackets """
+  host, separator, device = value.partition('/')
+  device = separator + device if device else None
+  port = GPSReader.port
+  if host.startswith('['):
+    host, separator, rest = host[1:].partition(']')
+    if rest:
+      if not rest.startswith(':'):
+        raise ValueError("Invalid GPSd endpoint {}".format(value))
+      port = int(rest[1:])
+  elif ':' in host:
+    host, separator, rest = host.rpartition(':')
+    port = int(rest)
+  if not 0 < port < 65536:
+    raise ValueError("Invalid GPSd port {}".format(port))
+  return host or GPSReader.host, port, device
+
+class GPSdConnection:
+  """ A connection to a GPS daemon, watching all its devices or only one """
+  def __init__(self, host, port, device = None):
+    self.host = host
+    self.port = port
+    self.device = device
+    self.name = '{}:{}{}'.format(host, port, device or '')
+    self.gpsd = None
+    self.reconnectAt = 0
+    # Set once GPSd has told us whether there is a device and a fix, or when we can't connect
+    self.ready = False
+    self.devices = set()
+
+class GPSReader(threading.Thread):
+  """ Background reader which keeps the latest fix of every GPS device in memory
+
+  Any number of GPSd endpoints is read in a single selector loop. Every device, a device being a
+  GPSd endpoint and device path, has its own latest fix. getLocation() chooses the best fix, the one
+  with the highest mode and the smallest error once degraded by its age, or blends the fixes of the
+  best mode weighted by their inverse variance.
+  """
+  host = '127.0.0.1'
+  port = 2947
+  # Seconds to wait before reconnecting to GPSd
+  reconnectInterval = 5
+  # 'best' to use the best fix, 'blend' to average the fixes of all devices with the best mode
+  selection = 'best'
+  # Meters per second of age a fix's error is degraded by when comparing fixes
+  agePenalty = 5
+  # Error in meters of a fix without epx and epy
+  unknownAccuracy = 100
+
+  def __init__(self, host = None, port = None, callback = None, endpoints = None):
+    """ endpoints is a list of (host, port, device) tuples, device None for all devices, by default host and port """
+    super().__init__(name='GPSReader', daemon=True)
+    if host:
+      self.host = host
+    if port:
+      self.port = port
+    # Called with the new location whenever a TPV report with a fix is received
+    self.callback = callback
+
+    self.connections = [GPSdConnection(*endpoint) for endpoint in endpoints or [(self.host, self.port, None)]]
+    self.selector = selectors.DefaultSelector()
+    self.terminate = threading.Event()
+    # Set once all GPSd endpoints have told us whether there is a device and a fix, or as soon as there is a fix
+    self.ready = threading.Event()
+    self.lock = threading.Lock()
+
+    self.nGPSDevices = 0
+    # Latest fix of every device, (connection name, device path) to (location, timestamp, mode)
+    self.fixes = {}
+    self.location = None
+    self.timestamp = None
+    self.hasFix = {}
+
+  def stop(self):
+    self.terminate.set()
+
+  def getLocation(self, maxAge = None):
+    """ Return the best location, or None when there is none or all are older than maxAge seconds """
+    with self.lock:
+      location, timestamp = self.select(time.monotonic(), maxAge)
+      if location is not None:
+        self.location = location
+        self.timestamp = timestamp
+    return location
+
+  def select(self, now, maxAge = None):
+    """ Choose or blend the latest fixes of the devices, the lock has to be held """
+    candidates = []
+    for location, timestamp, mode in self.fixes.values():
+      age = now - timestamp
+      if maxAge is not None and age > maxAge:
+        continue
+      accuracy = location[2] if location[2] is not None else self.unknownAccuracy
+      candidates.append((mode, accuracy + age * self.agePenalty, location, timestamp))
+    if not candidates:
+      return None, None
+
+    bestMode = max(candidate[0] for candidate in candidates)
+    candidates = sorted((candidate for candidate in candidates if candidate[0] == bestMode), key=lambda candidate: candidate[1])
+    mode, error, location, timestamp = candidates[0]
+    if self.selection != 'blend' or len(candidates) == 1:
+      return list(location), timestamp
+    return blend(candidates), timestamp
+
+  def connect(self, connection):
+    try:
+      if connection.device:
+        connection.gpsd = gps.gps(host=connection.host, port=connection.port)
+        connection.gpsd.stream(gps.WATCH_ENABLE|gps.WATCH_NEWSTYLE|gps.WATCH_DEVICE, connection.device)
+      else:
+        connection.gpsd = gps.gps(host=connection.host, port=connection.port, mode=gps.WATCH_ENABLE|gps.WATCH_NEWSTYLE)
+    except (ConnectionRefusedError, OSError) as e:
+      logger.warning("Can't connect to GPSd {}".format(connection.name))
+      connection.gpsd = None
+      connection.reconnectAt = time.monotonic() + self.reconnectInterval
+      self.setReady(connection)
+      return False
+
+    self.selector.register(connection.gpsd.sock, selectors.EVENT_READ, connection)
+    return True
+
+  def disconnect(self, connection):
+    if connection.gpsd:
+      try:
+        self.selector.unregister(connection.gpsd.sock)
+      except (KeyError, ValueError):
+        pass
+      connection.gpsd.close()
+      connection.gpsd = None
+    connection.reconnectAt = time.monotonic() + self.reconnectInterval
+
+    with self.lock:
+      connection.devices.clear()
+      self.countDevices()
+      for key in [key for key in self.fixes if key[0] == connection.name]:
+        del self.fixes[key]
+
+  def setReady(self, connection):
+    connection.ready = True
+    if all(connection.ready for connection in self.connections):
+      self.ready.set()
+
+  def countDevices(self):
+    self.nGPSDevices = sum(len(connection.devices) for connection in self.connections)
+
+  def run(self):
+    while not self.terminate.is_set():
+      now = time.monotonic()
+      for connection in self.connections:
+        if not connection.gpsd and now >= connection.reconnectAt:
+          self.connect(connection)
+      if not self.selector.get_map():
+        self.terminate.wait(min(connection.reconnectAt for connection in self.connections) - now)
+        continue
+
+      # Block until a GPSd sends something, wake up once a second to check if we need to stop or reconnect
+      for key, events in self.selector.select(timeout=1):
+        connection = key.data
+        while connection.gpsd and connection.gpsd.waiting(0):
+          status = connection.gpsd.read()
+          if status == -1:
+            logger.warning("Lost connection to GPSd {}".format(connection.name))
+            self.disconnect(connection)
+            break
+          if status > 0 and hasattr(connection.gpsd, 'data'):
+            self.handleReport(connection, connection.gpsd.data)
+
+    for connection in self.connections:
+      self.disconnect(connection)
+    self.selector.close()
+
+  def handleReport(self, connection, report):
+    device = report.get('device')
+    if report['class'] == 'DEVICES':
+      with self.lock:
+        connection.devices = set(entry.get('path') for entry in report['devices'])
+        self.countDevices()
+      if not connection.devices:
+        logger.warning("No GPS device connected to {}".format(connection.name))
+        self.setReady(connection)
+    elif report['class'] == 'DEVICE':
+      if report['activated'] == 0:
+        logger.warning("GPS device {} disconnected".format(device))
+        with self.lock:
+          connection.devices.discard(device)
+          self.countDevices()
+          self.fixes.pop((connection.name, device), None)
+      else:
+        logger.info("GPS device {} connected".format(device))
+        with self.lock:
+          connection.devices.add(device)
+          self.countDevices()
+    elif report['class'] == 'TPV':
+      key = (connection.name, device)
+      if report['mode'] in [0,1]:
+        if self.hasFix.get(key) is not False:
+          logger.warning("GPS {} has no fix".format(device or connection.name))
+        self.hasFix[key] = False
+        with self.lock:
+          self.fixes.pop(key, None)
+        self.setReady(connection)
+      elif 'lat' in report and 'lon' in report:
+        if self.hasFix.get(key) is False:
+          logger.info("GPS {} has a fix".format(device or connection.name))
+        self.hasFix[key] = True
+
+        location = [ report['lat'], report['lon'] ]
+
+        # Accuracy
+        if 'epx' in report and 'epy' in report:
+          location.append(max([ report['epx'], report['epy'] ]))
+        else:
+          location.append(None)
+
+        # Altitude
+        if 'alt' in report:
+          location.append(report['alt'])
+        else:
+          location.append(None)
+
+        # Direction
+        if 'track' in report:
+          location.append(report['track'])
+        else:
+          location.append(None)
+
+        # Speed
+        if 'speed' in report:
+          location.append(report['speed'])
+        else:
+          location.append(None)
+
+        now = time.monotonic()
+        with self.lock:
+          self.fixes[key] = (location, now, report['mode'])
+          location, timestamp = self.select(now)
+          self.location = location
+          self.timestamp = timestamp
+        connection.ready = True
+        self.ready.set()
+
+        if self.callback:
+          self.callback(location)
+      else:
+        logger.warning("No latitude or longitude in GPS report, this should not happen")
+        logger.warning(report)
+    elif report['class'] == 'SKY':
+      if 'satellites' not in report:
+        logger.debug("No satellites in view")
+    elif report['class'] in ['VERSION', 'WATCH']:
+      pass
+    else:
+      logger.debug("Unsupported class {}".format(report['class']))
+      logger.debug(report)
+
+def blend(candidates):
+  """ Average (mode, error, location, timestamp) candidates weighted by the inverse of their variance
+
+  The direction and speed are those of the best candidate, the first one.
+  """
+  best = candidates[0][2]
+  weights = [1 / max(error, 0.1) ** 2 for mode, error, location, timestamp in candidates]
+  total = sum(weights)
+
+  latitude = sum(weight * location[0] for weight, (mode, error, location, timestamp) in zip(weights, candidates)) / total
+  # Longitudes are averaged as offsets from the best one, so fixes on both sides of the antimeridian can be blended
+  offset = sum(weight * ((location[1] - best[1] + 180) % 360 - 180) for weight, (mode, error, location, timestamp) in zip(weights, candidates)) / total
+  longitude = (best[1] + offset + 180) % 360 - 180
+
+  altitudes = [(weight, location[3]) for weight, (mode, error, location, timestamp) in zip(weights, candidates) if location[3] is not None]
+  altitude = sum(weight * value for weight, value in altitudes) / sum(weight for weight, value in altitudes) if altitudes else None
+
+  # The error of the weighted average of independent measurements
+  return [latitude, longitude, total ** -0.5, altitude, best[4], best[5]]
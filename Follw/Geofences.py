@@ -0,0 +1,248 @@
+import logging, math, json
+from array import array
+from Track import Fix
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+metersPerDegree = 111320
+
+def pointInRings(x, y, rings):
+  """ Even-odd ray casting over all rings, so holes are outside """
+  inside = False
+  for xs, ys in rings:
+    j = len(xs) - 1
+    for i in range(len(xs)):
+      yi = ys[i]
+      yj = ys[j]
+      if (yi > y) != (yj > y) and x < (xs[j] - xs[i]) * (y - yi) / (yj - yi) + xs[i]:
+        inside = not inside
+      j = i
+  return inside
+
+def coarsen(location, precision):
+  """ Snap the location to a grid of precision meters, dropping everything that is more precise """
+  latitudeStep = precision / metersPerDegree
+  latitude = round(location[0] / latitudeStep) * latitudeStep
+  longitudeStep = latitudeStep / max(math.cos(math.radians(latitude)), 0.01)
+  longitude = round(location[1] / longitudeStep) * longitudeStep
+  accuracy = max(location[2] or 0, precision) if len(location) > 2 else precision
+  if isinstance(location, Fix):
+    return location._replace(latitude=latitude, longitude=longitude, accuracy=accuracy, altitude=None, direction=None, speed=None)
+  return [latitude, longitude, accuracy, None, None, None]
+
+class Geofence:
+  """ A polygon, or multi polygon, with what to do with the locations inside it
+
+  action is 'suppress' to not submit locations inside the geofence, 'coarsen' to only submit them
+  with a precision of precision meters, or None. interval is the interval in seconds inside the
+  geofence, None for the regular interval.
+  """
+  action = None
+  precision = 1000
+  interval = None
+
+  def __init__(self, name, polygons, action = None, precision = None, interval = None):
+    if action not in (None, 'suppress', 'coarsen'):
+      raise ValueError("Unknown geofence action {}".format(action))
+    if interval is not None and not (isinstance(interval, (int, float)) and interval > 0):
+      raise ValueError("Geofence {} has an invalid interval {}".format(name, interval))
+    if precision is not None and not (isinstance(precision, (int, float)) and precision > 0):
+      raise ValueError("Geofence {} has an invalid precision {}".format(name, precision))
+    self.name = name
+    self.action = action
+    if precision:
+      self.precision = precision
+    self.interval = interval
+
+    # Every polygon is a list of (longitudes, latitudes) rings, the first one the exterior
+    self.polygons = []
+    self.bounds = []
+    for polygon in polygons:
+      rings = []
+      for ring in polygon:
+        if len(ring) < 3:
+          raise ValueError("Geofence {} has a ring of less than 3 positions".format(name))
+        rings.append((array('d', (position[0] for position in ring)), array('d', (position[1] for position in ring))))
+      longitudes, latitudes = rings[0]
+      self.polygons.append(rings)
+      self.bounds.append((min(latitudes), min(longitudes), max(latitudes), max(longitudes)))
+    if not self.polygons:
+      raise ValueError("Geofence {} has no polygon".format(name))
+
+    south, west, north, east = zip(*self.bounds)
+    self.south, self.west, self.north, self.east = min(south), min(west), max(north), max(east)
+    self.arrays = None
+
+  def __repr__(self):
+    return self.name
+
+  def contains(self, latitude, longitude):
+    for (south, west, north, east), rings in zip(self.bounds, self.polygons):
+      if south <= latitude <= north and west <= longitude <= east and pointInRings(longitude, latitude, rings):
+        return True
+    return False
+
+  def containsMany(self, latitudes, longitudes):
+    """ Boolean NumPy array of which of the locations are inside """
+    import numpy
+    if self.arrays is None:
+      self.arrays = [[(numpy.frombuffer(xs), numpy.frombuffer(ys)) for xs, ys in rings] for rings in self.polygons]
+
+    inside = numpy.zeros(len(latitudes), dtype=bool)
+    for (south, west, north, east), rings in zip(self.bounds, self.arrays):
+      candidates = numpy.flatnonzero((latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east))
+      if not len(candidates):
+        continue
+      x = longitudes[candidates, None]
+      y = latitudes[candidates, None]
+      crossings = numpy.zeros(len(candidates), dtype=int)
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        for xs, ys in rings:
+          xj = numpy.roll(xs, 1)
+          yj = numpy.roll(ys, 1)
+          crossings += (((ys > y) != (yj > y)) & (x < (xj - xs) * (y - ys) / (yj - ys) + xs)).sum(axis=1)
+      inside[candidates[crossings % 2 == 1]] = True
+    return inside
+
+class Geofences:
+  """ Geofences in a grid index, and which of them the last location was inside
+
+  Every grid cell lists the geofences whose bounding box overlaps it, so a location is only tested
+  against the geofences of its cell. Geofences which would cover more than maxCells cells are kept
+  aside and tested by their bounding box first.
+  """
+  # Size of the grid cells in degrees
+  cellSize = 0.05
+  maxCells = 10000
+  # Geofences with fewer locations of a batch in their cells test them one by one
+  minBatch = 16
+
+  def __init__(self, geofences, cellSize = None):
+    if cellSize:
+      self.cellSize = cellSize
+    self.geofences = list(geofences)
+    self.grid = {}
+    self.large = []
+    for geofence in self.geofences:
+      rows = range(self.cell(geofence.south), self.cell(geofence.north) + 1)
+      columns = range(self.cell(geofence.west), self.cell(geofence.east) + 1)
+      if len(rows) * len(columns) > self.maxCells:
+        self.large.append(geofence)
+        continue
+      for row in rows:
+        for column in columns:
+          self.grid.setdefault((row, column), []).append(geofence)
+
+    # The geofences the last location was inside
+    self.inside = set()
+    # Called with the event, 'enter' or 'exit', and the geofence
+    self.listeners = []
+
+  def __len__(self):
+    return len(self.geofences)
+
+  @classmethod
+  def load(cls, path):
+    """ Load the Polygon and MultiPolygon features of a GeoJSON file
+
+    The properties name, action, precision and interval of a feature configure its geofence.
+    """
+    with open(path) as file:
+      data = json.load(file)
+    if data.get('type') == 'FeatureCollection':
+      features = data.get('features', [])
+    elif data.get('type') == 'Feature':
+      features = [data]
+    else:
+      features = [{'type': 'Feature', 'geometry': data, 'properties': {}}]
+
+    geofences = []
+    for index, feature in enumerate(features):
+      geometry = feature.get('geometry') or {}
+      properties = feature.get('properties') or {}
+      if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+      elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+      else:
+        logger.debug("Skipping {} geometry".format(geometry.get('type')))
+        continue
+      geofences.append(Geofence(str(properties.get('name', feature.get('id', index))), polygons, properties.get('action'), properties.get('precision'), properties.get('interval')))
+    logger.info("Loaded {} geofences".format(len(geofences)))
+    return cls(geofences)
+
+  def cell(self, degrees):
+    return math.floor(degrees / self.cellSize)
+
+  def find(self, latitude, longitude):
+    """ The geofences the location is inside """
+    candidates = self.grid.get((self.cell(latitude), self.cell(longitude)), [])
+    found = [geofence for geofence in candidates if geofence.contains(latitude, longitude)]
+    for geofence in self.large:
+      if geofence.south <= latitude <= geofence.north and geofence.west <= longitude <= geofence.east and geofence.contains(latitude, longitude):
+        found.append(geofence)
+    return found
+
+  def findMany(self, latitudes, longitudes):
+    """ The geofences every location of the NumPy arrays is inside, as a list of lists """
+    import numpy
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    found = [[] for i in range(len(latitudes))]
+    # Python floats are much faster than NumPy scalars when testing one by one
+    latitudeList = latitudes.tolist()
+    longitudeList = longitudes.tolist()
+
+    # Group the locations by cell, then test all locations in the cells of a geofence at once
+    cells = numpy.stack([numpy.floor(latitudes / self.cellSize), numpy.floor(longitudes / self.cellSize)], axis=1).astype(int)
+    keys, inverse = numpy.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = numpy.argsort(inverse, kind='stable')
+    starts = numpy.searchsorted(inverse[order], numpy.arange(len(keys) + 1))
+    candidates = {}
+    for key, start, end in zip(map(tuple, keys.tolist()), starts[:-1], starts[1:]):
+      for geofence in self.grid.get(key, []):
+        candidates.setdefault(geofence, []).append(order[start:end])
+    for geofence, indices in candidates.items():
+      indices = numpy.concatenate(indices)
+      if len(indices) < self.minBatch:
+        # Vectorizing doesn't pay off for a few locations
+        inside = [index for index in indices.tolist() if geofence.contains(latitudeList[index], longitudeList[index])]
+      else:
+        inside = indices[geofence.containsMany(latitudes[indices], longitudes[indices])]
+      for index in inside:
+        found[index].append(geofence)
+
+    for geofence in self.large:
+      for index in numpy.flatnonzero(geofence.containsMany(latitudes, longitudes)):
+        found[index].append(geofence)
+    return found
+
+  def update(self, location):
+    """ Find the geofences the location is inside and emit the enter and exit events, returns them as a list of (event, geofence) """
+    inside = set(self.find(location[0], location[1]))
+    events = [('exit', geofence) for geofence in self.inside - inside] + [('enter', geofence) for geofence in inside - self.inside]
+    self.inside = inside
+    for event, geofence in events:
+      logger.info("{} geofence {}".format('Entered' if event == 'enter' else 'Left', geofence.name))
+      metrics.increment('follw_geofence_events_total', event=event)
+      for listener in self.listeners:
+        listener(event, geofence)
+    return events
+
+  def getInterval(self, interval):
+    """ The interval inside the geofences of the last location, the shortest when inside several """
+    intervals = [geofence.interval for geofence in self.inside if geofence.interval]
+    return min(intervals) if intervals else interval
+
+  def apply(self, location):
+    """ The location to submit, None when inside a geofence that suppresses it, coarsened when inside one that coarsens it """
+    geofences = self.find(location[0], location[1])
+    if any(geofence.action == 'suppress' for geofence in geofences):
+      return None
+    precisions = [geofence.precision for geofence in geofences if geofence.action == 'coarsen']
+    if precisions:
+      return coarsen(location, max(precisions))
+    return location
@@ -0,0 +1,53 @@
+import logging, threading, collections
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class LatestQueue:
+  """ Bounded queue which keeps the most recent items
+
+  Putting never blocks, when the queue is full the oldest item is dropped. This hands fixes from the
+  acquisition to the submission without a slow submission ever delaying the acquisition, a newer fix
+  supersedes one that could not be submitted yet.
+  """
+  maxSize = 1
+
+  def __init__(self, maxSize = None, name = 'fixes'):
+    if maxSize:
+      self.maxSize = maxSize
+    self.name = name
+    self.items = collections.deque(maxlen=self.maxSize)
+    self.condition = threading.Condition()
+    self.closed = False
+    self.dropped = 0
+
+  def __len__(self):
+    return len(self.items)
+
+  def put(self, item):
+    """ Add an item, returns False when an older item had to be dropped for it """
+    with self.condition:
+      dropped = len(self.items) == self.maxSize
+      if dropped:
+        self.dropped += 1
+      self.items.append(item)
+      self.condition.notify()
+
+    if dropped:
+      logger.debug("Dropped an older item from the {} queue".format(self.name))
+      metrics.increment('follw_queue_dropped_total', queue=self.name)
+    return not dropped
+
+  def get(self, timeout = None):
+    """ Take the oldest item, waits until there is one, returns None on timeout or when closed """
+    with self.condition:
+      self.condition.wait_for(lambda: self.items or self.closed, timeout)
+      if not self.items:
+        return None
+      return self.items.popleft()
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
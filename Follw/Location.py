@@ -1,58 +1,141 @@
-import sys, logging, time, json, platform, subprocess, re, multiprocessing, urllib, socket
+import sys, os, logging, time, math, json, platform, re, socket, concurrent.futures
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# GPS Hardware
-try:
-  from gps import *
-except ImportError:
-  logger.warning("GPSd library not installed")
-
-# Mac OS Core Location
-if platform.system() == 'Darwin':
-  try:
-    multiprocessing.set_start_method('spawn')
-    import CoreLocation
-  except ImportError:
-    logger.warning("CoreLocation library not installed")
-else:
-  logger.debug("Core Location not supported on {}".format(platform.system()))
+from Metrics import metrics
+from Provider import Provider
+from MovementFilter import haversine
+from Track import Fix, TrackBuffer
+
+# The location sources and their libraries are only imported once they are enabled and first used,
+# so a --oneshot run doesn't pay for the libraries of the sources it doesn't use
+optionalModules = {}
+
+def importOptional(name):
+  """ Import an optional library once, returns None when it is not installed """
+  if name not in optionalModules:
+    try:
+      optionalModules[name] = __import__(name)
+    except ImportError:
+      logger.warning("{} library not installed".format(name))
+      optionalModules[name] = None
+  return optionalModules[name]
+
+def importCoreLocation():
+  """ Mac OS Core Location """
+  if platform.system() != 'Darwin':
+    return None
+  if 'CoreLocation' not in optionalModules:
+    import multiprocessing
+    try:
+      multiprocessing.set_start_method('spawn')
+    except RuntimeError:
+      # The start method has already been set
+      pass
+  return importOptional('CoreLocation')
 
 # Windows Location Services
 #ToDo Import the right library which supports Location Services
-# if platform.system() == 'Windows':
-#   try:
-#     import LocationServices
-#   except ImportError:
-#     logger.warning("Location Services library not installed")
-# else:
-#   logger.debug("Location Services not supported on {}".format(platform.system()))
 
 # WiFi Location Lookup
 wifiLocationConfigs = {
-  'yandex': {},
-  'wigle': {},
-  'mls': {},
-  'gls': {}
+  'yandex': { 'url': 'http://mobile.maps.yandex.net/cellid_location/?wifinetworks={bssid}:{signal}'},
+  'wigle': { 'url': 'https://api.wigle.net/api/v2/network/detail?netid={bssid}&type=wifi'},
+  'mls': { 'url': 'https://location.services.mozilla.com/v1/geolocate?key={key}'},
+  'gls': { 'url': 'https://www.googleapis.com/geolocation/v1/geolocate?key={key}'},
+  # Offline lookup in a database imported with WiFiDatabase.py
+  'local': {}
   }
 
 # IP Location Lookup
 ipLocationConfigs = {
-  'ip-api.com': { 'url': 'http://ip-api.com/json/?fields=49344', 'latitudeKey': 'lat', 'longitudeKey': 'lon', 'interval': 60/45},
-  'ipapi.co': { 'url': 'https://ipapi.co/json/', 'latitudeKey': 'latitude', 'longitudeKey': 'longitude', 'interval': (60*60*24)/1000},
-  'extreme-ip-lookup.com': { 'url': 'https://extreme-ip-lookup.com/json/', 'latitudeKey': 'lat', 'longitudeKey': 'lon', 'interval': (60*60*24*31)/10000},
-  'ipwhois.io': { 'url': 'https://ipwhois.app/json/?objects=latitude,longitude', 'latitudeKey': 'latitude', 'longitudeKey': 'longitude', 'interval': (60*60*24*31)/10000},
-  'geoplugin.net': {'url': 'http://www.geoplugin.net/json.gp', 'latitudeKey': 'geoplugin_latitude', 'longitudeKey': 'geoplugin_longitude', 'accuracyKey': 'geoplugin_locationAccuracyRadius', 'interval': (60*60*24)/100000}
+  'ip-api.com': { 'url': 'http://ip-api.com/json/?fields=49344', 'latitudeKey': 'lat', 'longitudeKey': 'lon', 'quota': (45, 60)},
+  'ipapi.co': { 'url': 'https://ipapi.co/json/', 'latitudeKey': 'latitude', 'longitudeKey': 'longitude', 'quota': (1000, 60*60*24)},
+  'extreme-ip-lookup.com': { 'url': 'https://extreme-ip-lookup.com/json/', 'latitudeKey': 'lat', 'longitudeKey': 'lon', 'quota': (10000, 60*60*24*31)},
+  'ipwhois.io': { 'url': 'https://ipwhois.app/json/?objects=latitude,longitude', 'latitudeKey': 'latitude', 'longitudeKey': 'longitude', 'quota': (10000, 60*60*24*31)},
+  'geoplugin.net': {'url': 'http://www.geoplugin.net/json.gp', 'latitudeKey': 'geoplugin_latitude', 'longitudeKey': 'geoplugin_longitude', 'accuracyKey': 'geoplugin_locationAccuracyRadius', 'quota': (100000, 60*60*24)}
   }
 
+# Location sources in order of priority, sources with the same priority are ranked by accuracy
+locationSources = [
+  ('Replay', 'getReplayLocation', 0),
+  ('GPS', 'getGPSLocation', 0),
+  ('CoreLocation', 'getCoreLocationLocation', 1),
+  ('LocationServices', 'getLocationServicesLocation', 1),
+  ('WiFi', 'getWiFiLocation', 2),
+  ('IP', 'getIPLocation', 3)
+  ]
+
+# Sources which can block on a subprocess, a system API or the network run in a worker with a deadline
+blockingSources = ['CoreLocation', 'LocationServices', 'WiFi', 'IP']
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2
+
+def ipConsensus(answers, outlierDistance, minimumAccuracy):
+  """ The median of the answers of several IP location providers, without outliers """
+  if not answers:
+    return None
+  if len(answers) == 1:
+    # A single provider can't be checked against others, it gets at least the same accuracy floor
+    answer = answers[0]
+    accuracy = answer[2] if len(answer) > 2 and answer[2] is not None else 0
+    return [answer[0], answer[1], round(max(accuracy, minimumAccuracy))]
+
+  latitude = median([answer[0] for answer in answers])
+  longitude = median([answer[1] for answer in answers])
+  distances = [haversine(latitude, longitude, answer[0], answer[1]) for answer in answers]
+  threshold = max(outlierDistance, 3 * median(distances))
+  inliers = [answer for answer, distance in zip(answers, distances) if distance <= threshold]
+  if len(inliers) < len(answers):
+    logger.debug("Dropped {} outlying IP locations".format(len(answers) - len(inliers)))
+
+  latitude = median([answer[0] for answer in inliers])
+  longitude = median([answer[1] for answer in inliers])
+  spread = max(haversine(latitude, longitude, answer[0], answer[1]) for answer in inliers)
+  return [latitude, longitude, round(max(spread, minimumAccuracy))]
+
 class Location:
   terminate = False
-  online = True
+  isOnline = True
+
+  # Concurrent location acquisition
+  concurrent = False
+  # Maximum time in seconds to wait for the location sources when acquiring concurrently
+  deadline = 2
+  executor = None
+  pending = None
+  locations = None
+
+  # Combine the locations of all sources with a Kalman filter, requires NumPy
+  fusion = False
+  kalmanFilter = None
+  # The last (time, location) fed into the filter per source and the last fused location
+  fusedInputs = None
+  fusedLocation = None
+
+  # Recorded locations to play back instead of the real location
+  replay = None
 
   # GPS Hardware
-  gpsd = None
+  gpsReader = None
   nGPSDevices = 0
+  # GPSd endpoints as (host, port, device) tuples, the local GPSd when None
+  gpsdEndpoints = None
+  # 'best' to use the fix of the best GPS device, 'blend' to average the fixes of all devices
+  gpsSelection = 'best'
+  # Serial GPS device or pty to read NMEA 0183 sentences from directly instead of from GPSd
+  nmeaDevice = None
+  nmeaBaudRate = 9600
+  # Seconds to wait for a first GPS report after connecting to GPSd
+  gpsStartupTimeout = 2
+  # GPS fixes older than this many seconds are not used
+  gpsMaxAge = 10
 
   # Mac OS Core Location
   coreLocationManager = None
@@ -61,147 +144,320 @@ class Location:
   wifiLocationLookup = False
   wifiLocationProvider = 'yandex'
   wifiAPIKey = None
+  wifiLocationCache = None
+  wifiScanner = None
+  wifiDatabasePath = None
+  wifiDatabase = None
+  # The last WiFi location and the network watcher generation it was looked up in
+  wifiLocation = None
+  wifiLocationGeneration = None
+  # The visible access points change with every scan, so MLS and GLS aren't asked again for up to
+  # sameBSSIDInterval seconds while still connected to the same access point
+  sameBSSIDInterval = 300
+  # The access point of the last MLS or GLS lookup, its location and monotonic time
   previousBSSID = None
+  previousBSSIDLocation = None
+  previousBSSIDTime = None
 
   # IP Location Lookup
   ipLocationLookup = False
   ipLocationProvider = 'ip-api.com'
   ipLocationConfig = None
-  # We have to keep track of the interval of IP lookups since IP Location Providers have a rate limit
-  lastIPLocationLookup = 0
-
+  # Query all providers in ipConsensusProviders, or all providers when None, at once and combine their answers
+  ipConsensus = False
+  ipConsensusProviders = None
+  # Number of answers to wait for before combining them
+  ipQuorum = 2
+  # Answers farther than this many meters, and three times the median distance, from the median are dropped
+  ipOutlierDistance = 50000
+  # An IP location is never more accurate than a city
+  ipMinimumAccuracy = 5000
+  ipExecutor = None
+  # Seconds the location of an external IP address is cached
+  ipLocationTTL = 60*60*24*7
+  ipLocationCache = None
+  # The external IP address is looked up at a service without a tight rate limit
+  publicIPAddressURL = 'https://api.ipify.org'
+  publicIPAddressInterval = 60
+  publicIPAddress = None
+  lastPublicIPAddressLookup = 0
+  # When the network is watched the external IP address is only checked again after a network change, or this often
+  publicIPAddressWatchedInterval = 60*60
+  publicIPAddressGeneration = None
+
+  # Watch the network on Linux and only do the WiFi and IP lookups again when it changed
+  watchNetwork = True
+  networkWatcher = None
+
+  # Directory to keep the persistent location lookup caches in, None to only cache in memory
+  cacheDir = None
+
+  # Rate limits and circuit breakers of the external location providers
+  providers = None
+
+  # The last fix
   location = None
   timestamp = None
   method = None
+  # Number of recent fixes kept in the track history
+  trackSize = 3600
+  track = None
+
+  def __init__(self):
+    # Called with the new location whenever a location source pushes one
+    self.listeners = []
+    self.track = TrackBuffer(self.trackSize)
+    # Called with every fix that is added to the track
+    self.trackListeners = []
 
   def stop(self, signum = None, frame = None):
     self.terminate = True
+    if self.gpsReader:
+      self.gpsReader.stop()
+    if self.replay:
+      self.replay.stop()
+    if self.executor:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+    if self.ipExecutor:
+      self.ipExecutor.shutdown(wait=False, cancel_futures=True)
+    if self.networkWatcher:
+      self.networkWatcher.stop()
 
   def online(self, online = True):
-    self.online = online
+    self.isOnline = online
 
   def offline(self, offline = True):
-    self.online = not online
+    self.online(not offline)
+
+  def notify(self, location):
+    for listener in self.listeners:
+      listener(location)
 
   def getLocation(self):
-    location = None
+    if self.fusion:
+      location, method = self.getFusedLocation()
+    elif self.concurrent:
+      location, method = self.getConcurrentLocation()
+    else:
+      location, method = self.getSerialLocation()
 
-    location = self.getGPSLocation()
     if location:
-      self.method="GPS"
+      location = Fix.fromLocation(location, self.getFixTime(method), method)
+      self.location = location
+      self.timestamp = time.time()
+      self.method = method
+      self.track.append(location)
+      for listener in self.trackListeners:
+        listener(location)
 
-    if not location:
-      location = self.getCoreLocationLocation()
-      if location:
-        self.method="CoreLocation"
+    return location
 
-    if not location:
-      location = self.getLocationServicesLocation()
-      if location:
-        self.method="LocationServices"
+  def getFixTime(self, method):
+    """ Monotonic time the last location of a source was measured
 
-    if not location:
-      location = self.getWiFiLocation()
-      if location:
-        self.method="WiFi"
+    GPS fixes and recordings are measured in the background, other sources measure when they are asked.
+    """
+    if method == 'GPS' and self.gpsReader and self.gpsReader.timestamp:
+      return self.gpsReader.timestamp
+    if method == 'Replay' and self.replay and self.replay.timestamp is not None:
+      return self.replay.timestamp
+    return time.monotonic()
 
-    if not location:
-      location = self.getIPLocation()
+  def acquire(self, method, function):
+    """ Call a location source and record its latency and result """
+    with metrics.timer('follw_source_duration_seconds', source=method):
+      try:
+        location = getattr(self, function)()
+      except Exception:
+        metrics.increment('follw_source_total', source=method, result='error')
+        raise
+    metrics.increment('follw_source_total', source=method, result='success' if location else 'none')
+    return location
+
+  def getSerialLocation(self):
+    """ Try the location sources one after the other, in order of priority """
+    for method, function, priority in locationSources:
+      # Stopped while acquiring, the worker pool is shut down
+      if self.terminate:
+        break
+      if method in blockingSources:
+        location = self.acquireWithDeadline(method, function)
+      else:
+        location = self.acquire(method, function)
       if location:
-        self.method="IP"
+        return location, method
 
-    if location:
-      self.location = location
-      self.timestamp = time.time()
+    return None, None
 
-    return location
+  def startSource(self, method, function):
+    """ Run a location source in the worker pool, returns None when it is still running from before or when stopped """
+    if self.terminate:
+      return None
+    if not self.executor:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(locationSources), thread_name_prefix='Location')
+      self.pending = {}
 
-  def getGPSLocation(self, timeout = 2):
-    """ Get the location using the GPS daemon """
-    if not self.gpsd and 'gps' in sys.modules:
+    future = self.pending.get(method)
+    if future and not future.done():
+      return None
+    try:
+      future = self.executor.submit(self.acquire, method, function)
+    except RuntimeError:
+      # Stopped meanwhile
+      return None
+    self.pending[method] = future
+    return future
+
+  def acquireWithDeadline(self, method, function):
+    """ Call a location source in the worker pool and give up on it after the deadline """
+    future = self.startSource(method, function)
+    if not future:
+      if self.terminate:
+        return None
+      logger.debug("{} location source is still running".format(method))
+      return None
+
+    try:
+      return future.result(timeout=self.deadline)
+    except concurrent.futures.TimeoutError:
+      # The source is left to finish on its own, it isn't started again until it has
+      logger.warning("{} location source did not return within {}s".format(method, self.deadline))
+      metrics.increment('follw_source_total', source=method, result='timeout')
+    except Exception as e:
+      logger.error("{} location source failed: {}".format(method, e))
+    return None
+
+  def getConcurrentLocation(self, deadline = None, waitForAll = False):
+    """ Start all location sources at once and return the best location available within the deadline
+
+    All locations that were found are kept in self.locations as (method, location, time) tuples. Unless
+    waitForAll is set, this returns as soon as no running source can give a better location.
+    """
+    if deadline is None:
+      deadline = self.deadline
+
+    _time = time.monotonic()
+    futures = {}
+    for method, function, priority in locationSources:
+      if self.terminate:
+        break
+      # A source which is still running from a previous acquisition is not started again
+      future = self.startSource(method, function)
+      if future:
+        futures[future] = (method, priority)
+
+    best = None
+    self.locations = []
+    while futures and not self.terminate:
+      remaining = deadline - (time.monotonic() - _time)
+      if remaining <= 0:
+        break
+      done, notDone = concurrent.futures.wait(futures, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        method, priority = futures.pop(future)
+        try:
+          location = future.result()
+        except Exception as e:
+          logger.error("{} location source failed: {}".format(method, e))
+          continue
+        if location:
+          self.locations.append((method, location, self.getFixTime(method)))
+          accuracy = location[2] if len(location) > 2 and location[2] is not None else float('inf')
+          if not best or (priority, accuracy) < best[0]:
+            best = ((priority, accuracy), location, method)
+
+      # No source which is still running can give a better location
+      if best and not waitForAll and all(priority > best[0][0] for method, priority in futures.values()):
+        break
+
+    # Sources that did not start yet are cancelled, sources that are running are left to finish on their own
+    for future in futures:
+      future.cancel()
+    if futures:
+      logger.debug("Location sources still running: {}".format(', '.join(method for method, priority in futures.values())))
+
+    if best:
+      return best[1], best[2]
+    return None, None
+
+  def getFusedLocation(self):
+    """ Combine the locations of all sources with a Kalman filter """
+    if not self.kalmanFilter:
       try:
-        self.gpsd = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
-      except ConnectionRefusedError as e:
-        logger.warning("Can't connect to GPSd")
-
-    if self.gpsd:
-      _time = time.time()
-      report = None
-      while not self.terminate:
-        if self.gpsd.waiting():
-          # Get current location from GPS device
-          report = self.gpsd.next()
-          if report['class'] == 'DEVICES':
-            self.nGPSDevices = len(report['devices'])
-          elif report['class'] == 'DEVICE':
-            if report['activated'] == 0:
-              logger.warning("GPS device disconnected")
-              self.nGPSDevices -= 1
-            else:
-              logger.info("GPS device connected")
-              self.nGPSDevices += 1
-          elif report['class'] == 'TPV':
-            if report['mode'] in [0,1]:
-              logger.warning("GPS has no fix")
-            else:
-              if 'lat' in report and 'lon' in report:
-                location = [ report['lat'], report['lon'] ]
-
-                # Accuracy
-                if 'epx' in report and 'epy' in report:
-                  location.append(max([ report['epx'], report['epy'] ]))
-                else:
-                  location.append(None)
-
-                # Altitude
-                if 'alt' in report:
-                  location.append(report['alt'])
-                else:
-                  location.append(None)
-
-                # Direction
-                if 'track' in report:
-                  location.append(report['track'])
-                else:
-                  location.append(None)
-
-                # Speed
-                if 'speed' in report:
-                  location.append(report['speed'])
-                else:
-                  location.append(None)
-
-                return location
-
-              logger.warning("No latitude or longitude in GPS report, this should not happen")
-              logger.warning(report)
-          elif report['class'] == 'SKY':
-            if 'satellites' not in report:
-              logger.debug("No satellites in view")
-              return None
-            _time = time.time()
-          elif report['class'] in ['VERSION', 'WATCH']:
-            _time = time.time()
-          else:
-            logger.debug("Unsupported class {}".format(report['class']))
-            logger.debug(report)
-            _time = time.time()
-        else:
-          elapsedTime = time.time() - _time
-          if self.nGPSDevices == 0:
-            logger.warning("No GPS device connected")
-            return None
-          if elapsedTime > timeout:
-            logger.warning("GPS did not return a location")
-            logger.debug(elapsedTime)
-            return None
-          time.sleep(0.1)
+        from Fusion import KalmanFilter
+        self.kalmanFilter = KalmanFilter()
+      except ImportError as e:
+        logger.error(e)
+        self.fusion = False
+        return self.getConcurrentLocation()
+
+    best, method = self.getConcurrentLocation(waitForAll=True)
+    if not best:
+      return None, None
+
+    from Fusion import defaultAccuracies
+    if self.fusedInputs is None:
+      self.fusedInputs = {}
+    fixes = []
+    for method, location, fixTime in self.locations:
+      # Feeding the same measurement again would make the filter ever more sure of it
+      previous = self.fusedInputs.get(method)
+      if previous and (fixTime <= previous[0] or (method not in ('GPS', 'Replay') and list(location) == previous[1])):
+        continue
+      self.fusedInputs[method] = (fixTime, list(location))
+      accuracy = location[2] if len(location) > 2 and location[2] else defaultAccuracies.get(method, 100)
+      fixes.append((fixTime, location[0], location[1], accuracy))
+    # In the order they were measured, of locations measured at the same time the most accurate last so it has the final say
+    fixes.sort(key=lambda fix: (fix[0], -fix[3]))
+    states = self.kalmanFilter.filter(fixes)
+    if not len(states):
+      # No source measured anything new
+      return (list(self.fusedLocation), 'Fusion') if self.fusedLocation else (None, None)
+    fused = states[-1]
+
+    altitude = best[3] if len(best) > 3 else None
+    # A heading just below 360 degrees rounds to 360.0, which is 0
+    direction = None if math.isnan(fused[4]) else round(float(fused[4]), 1) % 360
+    self.fusedLocation = [float(fused[1]), float(fused[2]), round(float(fused[3]), 1), altitude, direction, round(float(fused[5]), 2)]
+    return list(self.fusedLocation), 'Fusion'
+
+  def getReplayLocation(self):
+    """ Get the location from a recording """
+    if self.replay:
+      return self.replay.getLocation()
+
+    return None
+
+  def getGPSLocation(self, maxAge = None):
+    """ Get the location using the GPS daemon """
+    if not self.gpsReader and self.nmeaDevice:
+      from NMEAReader import NMEAReader
+      self.gpsReader = NMEAReader(self.nmeaDevice, self.nmeaBaudRate, callback=self.notify)
+      self.gpsReader.start()
+    elif not self.gpsReader:
+      from GPSReader import GPSReader, gps
+      if not gps:
+        return None
+      self.gpsReader = GPSReader(callback=self.notify, endpoints=self.gpsdEndpoints)
+      self.gpsReader.selection = self.gpsSelection
+      self.gpsReader.start()
+
+    if self.gpsReader:
+      # Give GPSd some time to report a fix when it has just been connected
+      if not self.gpsReader.ready.wait(self.gpsStartupTimeout):
+        logger.warning("GPS did not return a location")
+      self.nGPSDevices = self.gpsReader.nGPSDevices
+
+      if maxAge is None:
+        maxAge = self.gpsMaxAge
+      return self.gpsReader.getLocation(maxAge)
 
     return None
 
   def getCoreLocationLocation(self):
     """ Get the location using the macOS Core Location API """
-    if platform.system() == 'Darwin' and 'CoreLocation' in sys.modules:
+    CoreLocation = importCoreLocation()
+    if CoreLocation:
       if not self.coreLocationManager:
         self.coreLocationManager = CoreLocation.CLLocationManager.alloc().init()
         self.coreLocationManager.delegate()
@@ -232,51 +488,96 @@ class Location:
 
     return None
 
+  def getProvider(self, name, quota = None):
+    if self.providers is None:
+      self.providers = {}
+    if name not in self.providers:
+      self.providers[name] = Provider(name, quota)
+    return self.providers[name]
+
+  def getNetworkWatcher(self):
+    """ The network watcher, started on first use, None when the network can't be watched """
+    if not self.watchNetwork or platform.system() != 'Linux':
+      return None
+    if not self.networkWatcher:
+      from NetworkWatcher import NetworkWatcher
+      watcher = NetworkWatcher()
+      try:
+        watcher.open()
+      except OSError as e:
+        logger.warning("Can't watch the network, polling instead: {}".format(e))
+        self.watchNetwork = False
+        return None
+      watcher.start()
+      self.networkWatcher = watcher
+    return self.networkWatcher
+
   def getWiFiLocation(self):
     """ Get the location using the WiFi BSSID """
 
-    if not self.online:
+    # The local WiFi database can be used without internet connection
+    if not self.isOnline and self.wifiLocationProvider != 'local':
       return None
 
     if not self.wifiLocationLookup:
       return None
 
+    # Without a change of the network or the access point the location is still the same
+    watcher = self.getNetworkWatcher()
+    generation = None
+    if watcher and watcher.wifi:
+      generation = (watcher.networkGeneration, watcher.wifiGeneration)
+      if self.wifiLocation and generation == self.wifiLocationGeneration:
+        return self.wifiLocation
+
+    location = self.lookupWiFiLocationOfNetwork()
+    self.wifiLocation = location
+    self.wifiLocationGeneration = generation if location else None
+    return location
+
+  def lookupWiFiLocationOfNetwork(self):
+    """ Get the location of the access point we're associated with """
     bssid = None
+    aps = []
 
     if platform.system() == 'Linux':
+      from NL80211 import NL80211, getDefaultRouteInterfaces
       # Get the default route interface
-      output = subprocess.check_output(['ip', 'route', 'show', 'default']).decode()
-
-      interfaces = re.findall("^default via [0-9.]* dev ([^ ]*)", output, re.MULTILINE)
-      interfaces = list(set(interfaces))
+      try:
+        interfaces = getDefaultRouteInterfaces()
+      except OSError as e:
+        logger.error(e)
+        return None
 
       if len(interfaces) != 1:
         logger.warning("More than one default route interfaces detected")
         return None
 
       interface = interfaces[0]
-      output = subprocess.check_output(['iwconfig', interface]).decode()
-      ssids = re.findall("^.* ESSID:\"(.*)\".*$", output, re.MULTILINE)
-      bssids = re.findall("^.* Access Point: ([0-9a-fA-F:]*).*$", output, re.MULTILINE)
-      signals = re.findall("^.* Signal level=(-[0-9]*) dBm.*$", output, re.MULTILINE)
-
-      if len(bssids) == 0:
-        logger.warning("No AP BSSID detected")
+      if not self.wifiScanner:
+        self.wifiScanner = NL80211()
+      try:
+        with metrics.timer('follw_lookup_duration_seconds', lookup='wifi-scan'):
+          aps = self.wifiScanner.getScanResults(interface)
+      except OSError as e:
+        logger.warning("Can't get WiFi scan results for {}: {}".format(interface, e))
+        self.wifiScanner.close()
         return None
-      if len(bssids) > 1:
-        logger.warning("More than one AP BSSID detected")
 
-      if len(signals) == 0:
+      associated = [ap for ap in aps if ap['associated']]
+      if len(associated) == 0:
         logger.warning("No AP BSSID detected")
         return None
-      if len(signals) > 1:
+      if len(associated) > 1:
         logger.warning("More than one AP BSSID detected")
 
-      ssid = ssids[0]
-      bssid = bssids[0]
-      signal = signals[0]
+      ssid = associated[0]['ssid']
+      bssid = associated[0]['bssid']
+      signal = associated[0]['signal']
     elif platform.system() == 'Darwin':
-      output = subprocess.check_output(['/System/Library/PrivateFrameworks/Apple80211.framework/Versions/A/Resources/airport', '-I']).decode()
+      import subprocess
+      with metrics.timer('follw_lookup_duration_seconds', lookup='wifi-scan'):
+        output = subprocess.check_output(['/System/Library/PrivateFrameworks/Apple80211.framework/Versions/A/Resources/airport', '-I']).decode()
       logger.debug(output)
       ssids = re.findall("^ *SSID: (.*)$", output, re.MULTILINE)
       bssids = re.findall("^ *BSSID: ([0-9a-fA-F:]+)$", output, re.MULTILINE)
@@ -295,7 +596,8 @@ class Location:
       signal = signals[0]
       ap = {'bssid': bssid, 'ssid': ssids[0], 'channel': channels[0], 'signal': signals[0], 'noise': noises[0], 'age': 0}
 
-      output = subprocess.check_output(['/System/Library/PrivateFrameworks/Apple80211.framework/Versions/A/Resources/airport', '-s', '-x'])
+      with metrics.timer('follw_lookup_duration_seconds', lookup='wifi-scan'):
+        output = subprocess.check_output(['/System/Library/PrivateFrameworks/Apple80211.framework/Versions/A/Resources/airport', '-s', '-x'])
       import plistlib
       scanresults = plistlib.loads(output)
       aps = []
@@ -312,127 +614,336 @@ class Location:
       logger.info("AP BSSID detection not yet implemented on Windows")
       return None
 
-    if bssid and bssid != self.previousBSSID:
-      location = None
-      if self.wifiLocationProvider == 'yandex':
-        _bssid = bssid.replace(':', '')
-        url = "http://mobile.maps.yandex.net/cellid_location/?wifinetworks={}:{}".format(_bssid, signal)
-        logger.debug(url)
-        try:
-          with urllib.request.urlopen(url, timeout=1) as response:
-            data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
-            logger.debug(data)
-            latitude = float(re.compile(" latitude=\"([0-9.]*)\".*", re.MULTILINE).search(response).group(1))
-            longitude = float(re.compile(" longitude=\"([0-9.]*)\".*", re.MULTILINE).search(response).group(1))
-            location = [latitude, longitude]
-        except urllib.error.HTTPError as e:
-          if e.code == 404:
-            logger.warning("No location found for BSSID {}".format(bssid))
-          else:
-            logger.error(e.code)
-            return None
-        except urllib.error.URLError as e:
-          logger.error(e)
-          return None
-        except socket.timeout as e:
-          logger.error(e)
-          return None
-      elif self.wifiLocationProvider == 'wigle' and self.wifiAPIKey:
-        url = "https://api.wigle.net/api/v2/network/detail?netid={}&type=wifi".format(bssid, signal)
-        logger.debug(url)
-        try:
-          request = urllib.request.Request(url, headers={'Authorization': 'Basic ' + self.wifiAPIKey})
-          with urllib.request.urlopen(request, timeout=1) as response:
-            data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
-            logger.debug(data)
-            data = json.loads(data)
-            if data.get('success', False) and data.get('results')[0].get('ssid', None) == ssid:
-              latitude = data.get('results')[0].get('locationData')[0].get('latitude')
-              longitude = data.get('results')[0].get('locationData')[0].get('longitude')
-              location = [latitude, longitude]
-            else:
-              logger.debug("No location found for BSSID {}".format(bssid))
-        except urllib.error.HTTPError as e:
-          logger.error(e.code)
-          return None
-        except urllib.error.URLError as e:
-          logger.error(e)
-          return None
-      elif self.wifiLocationProvider in ['mls', 'gls'] and self.wifiAPIKey:
-        data = {'wifiAccessPoints': []}
-        for ap in aps:
-          data['wifiAccessPoints'].append({'macAddress': ap['bssid'], 'age': ap['age'], 'channel': ap['channel'], 'signalStrength': ap['signal'], 'signalToNoiseRatio': ap['noise']})
-        logger.debug(data)
-        if self.wifiLocationProvider == 'mls':
-          url = "https://location.services.mozilla.com/v1/geolocate?key={}".format(self.wifiAPIKey)
-        elif self.wifiLocationProvider == 'gls':
-          url = "https://www.googleapis.com/geolocation/v1/geolocate?key={}".format(self.wifiAPIKey)
-        logger.debug(url)
-        try:
-          request = urllib.request.Request(url, headers={'Content-Type': 'application/json'})
-          with urllib.request.urlopen(request, json.dumps(data).encode(), timeout=1) as response:
-            data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
-            logger.debug(data)
-            data = json.loads(data)
-            if data.get('location', False) and data.get('accuracy', None):
-              latitude = data.get('location').get('lat')
-              longitude = data.get('location').get('lng')
-              accuracy = data.get('accuracy')
-              location = [latitude, longitude, accuracy]
-            elif data.get('error', False):
-              logger.error(data.get('message'))
-            else:
-              logger.debug("No location found for BSSID {}".format(bssid))
-        except urllib.error.HTTPError as e:
-          logger.error(e.code)
-          return None
-        except urllib.error.URLError as e:
-          logger.error(e)
-          return None
+    if not bssid:
+      return None
 
-      self.previousBSSID = bssid
+    if self.wifiLocationProvider == 'local':
+      return self.getLocalWiFiLocation(bssid, signal, aps)
+    if self.wifiLocationProvider not in wifiLocationConfigs or (self.wifiLocationProvider != 'yandex' and not self.wifiAPIKey):
+      logger.debug("WiFi location provider {} is not configured".format(self.wifiLocationProvider))
+      return None
+
+    # MLS and GLS use all visible access points, the other providers only the connected one
+    if self.wifiLocationProvider in ['mls', 'gls']:
+      if bssid == self.previousBSSID and time.monotonic() - self.previousBSSIDTime < self.sameBSSIDInterval:
+        logger.debug("Still connected to BSSID {}".format(bssid))
+        return self.previousBSSIDLocation
+      key = '{}:{}'.format(self.wifiLocationProvider, ','.join(sorted(ap['bssid'] for ap in aps) or [bssid]))
+    else:
+      key = '{}:{}'.format(self.wifiLocationProvider, bssid)
+
+    cache = self.getWiFiLocationCache()
+    hit, location = cache.get(key)
+    if hit:
+      logger.debug("WiFi location cache hit for BSSID {}".format(bssid))
       return location
 
-    return None
+    # Skip the provider right away when it is down or its quota is used up
+    provider = self.getProvider(self.wifiLocationProvider, wifiLocationConfigs[self.wifiLocationProvider].get('quota'))
+    if not provider.allow():
+      return None
 
-  def getIPLocation(self):
-    """ Get the location using the external IP address """
-    global ipLocationConfigs
+    found = False
+    try:
+      with metrics.timer('follw_lookup_duration_seconds', lookup='wifi-provider'):
+        location, found = self.lookupWiFiLocation(bssid, ssid, signal, aps)
+    finally:
+      # A lookup that raised counts as failed too, or a half-open provider would never be probed again
+      if found:
+        provider.success()
+      else:
+        provider.failure()
+    # Lookups that failed are not cached, lookups without a location are
+    if found:
+      cache.put(key, location)
+      if self.wifiLocationProvider in ['mls', 'gls']:
+        self.previousBSSID = bssid
+        self.previousBSSIDLocation = location
+        self.previousBSSIDTime = time.monotonic()
+    return location
 
-    if not self.online:
-      return None
+  def getLocalWiFiLocation(self, bssid, signal, aps):
+    """ Get the location of the visible access points from the local WiFi database """
+    if not self.wifiDatabase:
+      if not self.wifiDatabasePath:
+        logger.error("No WiFi database configured")
+        return None
+      from WiFiDatabase import WiFiDatabase
+      try:
+        self.wifiDatabase = WiFiDatabase(self.wifiDatabasePath)
+      except (OSError, ValueError) as e:
+        logger.error("Can't open WiFi database: {}".format(e))
+        return None
 
-    if not self.ipLocationLookup:
-      return None
+    with metrics.timer('follw_lookup_duration_seconds', lookup='wifi-database'):
+      location = self.wifiDatabase.locate(aps or [{'bssid': bssid, 'signal': signal}])
+    if not location:
+      logger.debug("No location found for BSSID {}".format(bssid))
+    return location
 
-    if not self.ipLocationConfig:
-      self.ipLocationConfig = ipLocationConfigs[self.ipLocationProvider]
+  def getWiFiLocationCache(self):
+    if not self.wifiLocationCache:
+      from LocationCache import LocationCache
+      path = os.path.join(self.cacheDir, 'cache.sqlite') if self.cacheDir else None
+      self.wifiLocationCache = LocationCache(path, 'wifi')
+    return self.wifiLocationCache
 
-    elapsedTime = time.time() - self.lastIPLocationLookup
-    if elapsedTime > self.ipLocationConfig['interval']:
+  def lookupWiFiLocation(self, bssid, ssid, signal, aps):
+    """ Look up the location of the WiFi access points, returns a tuple (location, found) """
+    import urllib.request
+    location = None
+    if self.wifiLocationProvider == 'yandex':
+      _bssid = bssid.replace(':', '')
+      url = wifiLocationConfigs['yandex']['url'].format(bssid=_bssid, signal=signal)
+      logger.debug(url)
+      try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+          data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
+          logger.debug(data)
+          latitude = float(re.compile(" latitude=\"([0-9.]*)\".*", re.MULTILINE).search(data).group(1))
+          longitude = float(re.compile(" longitude=\"([0-9.]*)\".*", re.MULTILINE).search(data).group(1))
+          location = [latitude, longitude]
+      except urllib.error.HTTPError as e:
+        if e.code == 404:
+          logger.warning("No location found for BSSID {}".format(bssid))
+        else:
+          logger.error(e.code)
+          return None, False
+      except urllib.error.URLError as e:
+        logger.error(e)
+        return None, False
+      except socket.timeout as e:
+        logger.error(e)
+        return None, False
+      except (AttributeError, ValueError) as e:
+        logger.error("Unexpected reply from yandex: {}".format(e))
+        return None, False
+    elif self.wifiLocationProvider == 'wigle' and self.wifiAPIKey:
+      url = wifiLocationConfigs['wigle']['url'].format(bssid=bssid)
+      logger.debug(url)
       try:
-        with urllib.request.urlopen(self.ipLocationConfig['url'], timeout=1) as response:
+        request = urllib.request.Request(url, headers={'Authorization': 'Basic ' + self.wifiAPIKey})
+        with urllib.request.urlopen(request, timeout=1) as response:
           data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
           logger.debug(data)
           data = json.loads(data)
-
-          latitude = data.get(self.ipLocationConfig['latitudeKey'])
-          longitude = data.get(self.ipLocationConfig['longitudeKey'])
-          location = [latitude , longitude]
-          accuracy = None
-          if 'accuracyKey' in self.ipLocationConfig:
-            accuracy = data.get(self.ipLocationConfig['accuracyKey'], None)
-          if accuracy:
-            location.append(accuracy)
-
-          self.lastIPLocationLookup = time.time()
-
-          return location
+          results = data.get('results') or []
+          if data.get('success', False) and results and results[0].get('ssid', None) == ssid:
+            latitude = results[0].get('locationData')[0].get('latitude')
+            longitude = results[0].get('locationData')[0].get('longitude')
+            location = [latitude, longitude]
+          else:
+            logger.debug("No location found for BSSID {}".format(bssid))
+      except urllib.error.HTTPError as e:
+        logger.error(e.code)
+        return None, False
       except urllib.error.URLError as e:
-        logger.error(e.reason)
+        logger.error(e)
+        return None, False
+      except socket.timeout as e:
+        logger.error(e)
+        return None, False
+      except (AttributeError, IndexError, TypeError, ValueError) as e:
+        logger.error("Unexpected reply from wigle: {}".format(e))
+        return None, False
+    elif self.wifiLocationProvider in ['mls', 'gls'] and self.wifiAPIKey:
+      data = {'wifiAccessPoints': []}
+      for ap in aps:
+        accessPoint = {'macAddress': ap['bssid'], 'age': ap['age'], 'channel': ap['channel'], 'signalStrength': ap['signal'], 'signalToNoiseRatio': ap['noise']}
+        # Not every scanner knows all the fields
+        data['wifiAccessPoints'].append({key: value for key, value in accessPoint.items() if value is not None})
+      logger.debug(data)
+      url = wifiLocationConfigs[self.wifiLocationProvider]['url'].format(key=self.wifiAPIKey)
+      logger.debug(url)
+      try:
+        request = urllib.request.Request(url, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, json.dumps(data).encode(), timeout=1) as response:
+          data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
+          logger.debug(data)
+          data = json.loads(data)
+          if data.get('location', False) and data.get('accuracy', None):
+            latitude = data.get('location').get('lat')
+            longitude = data.get('location').get('lng')
+            accuracy = data.get('accuracy')
+            location = [latitude, longitude, accuracy]
+          elif data.get('error', False):
+            logger.error(data.get('message'))
+            return None, False
+          else:
+            logger.debug("No location found for BSSID {}".format(bssid))
       except urllib.error.HTTPError as e:
         logger.error(e.code)
+        return None, False
+      except urllib.error.URLError as e:
+        logger.error(e)
+        return None, False
       except socket.timeout as e:
         logger.error(e)
+        return None, False
+      except (AttributeError, TypeError, ValueError) as e:
+        logger.error("Unexpected reply from {}: {}".format(self.wifiLocationProvider, e))
+        return None, False
+    else:
+      return None, False
+
+    return location, True
+
+  def getIPLocation(self):
+    """ Get the location using the external IP address """
+    if not self.isOnline:
+      return None
+
+    if not self.ipLocationLookup:
+      return None
+
+    name = 'consensus' if self.ipConsensus else self.ipLocationProvider
+
+    # The location of an IP address rarely changes, so only look it up again when the IP address has changed
+    ipAddress = self.getPublicIPAddress()
+    if ipAddress:
+      key = '{}:{}'.format(name, ipAddress)
+      hit, location = self.getIPLocationCache().get(key)
+      if hit:
+        return location
+
+    if self.ipConsensus:
+      location = self.getIPConsensusLocation()
+    else:
+      if not self.ipLocationConfig:
+        self.ipLocationConfig = ipLocationConfigs[self.ipLocationProvider]
+      location = self.lookupIPLocation(self.ipLocationProvider, self.ipLocationConfig)
+
+    if ipAddress and location:
+      self.getIPLocationCache().put(key, location)
+    return location
+
+  def lookupIPLocation(self, name, config):
+    """ Look up the location of the external IP address at a provider, within its rate limit """
+    provider = self.getProvider(name, config.get('quota'))
+    if not provider.allow():
+      return None
+
+    import urllib.request
+    data = None
+    try:
+      with metrics.timer('follw_lookup_duration_seconds', lookup='ip-provider'):
+        with urllib.request.urlopen(config['url'], timeout=1) as response:
+          data = response.read().decode(response.headers.get_content_charset(failobj = 'utf-8'))
+          logger.debug(data)
+          data = json.loads(data)
+    except urllib.error.HTTPError as e:
+      logger.error("{}: {}".format(name, e.code))
+      return None
+    except urllib.error.URLError as e:
+      logger.error("{}: {}".format(name, e.reason))
+      return None
+    except (socket.timeout, ValueError) as e:
+      logger.error("{}: {}".format(name, e))
+      data = None
+      return None
+    finally:
+      # Whatever went wrong, also an unexpected exception, counts as a failure
+      if data is None:
+        provider.failure()
+      else:
+        provider.success()
+
+    try:
+      location = [float(data[config['latitudeKey']]), float(data[config['longitudeKey']])]
+    except (KeyError, TypeError, ValueError):
+      logger.debug("{} did not return a location".format(name))
+      return None
+    accuracy = data.get(config['accuracyKey']) if 'accuracyKey' in config else None
+    if accuracy:
+      location.append(accuracy)
+    return location
+
+  def getIPConsensusLocation(self):
+    """ Query several IP location providers at once and combine their answers
+
+    Returns as soon as ipQuorum providers have answered, or with the answers so far when the deadline
+    passes. Answers far from the median are dropped as outliers and the accuracy is derived from how
+    far the remaining answers are spread.
+    """
+    names = self.ipConsensusProviders or list(ipLocationConfigs.keys())
+    if not self.ipExecutor:
+      self.ipExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=len(ipLocationConfigs), thread_name_prefix='IPLocation')
+
+    futures = {self.ipExecutor.submit(self.lookupIPLocation, name, ipLocationConfigs[name]): name for name in names}
+    answers = []
+    try:
+      for future in concurrent.futures.as_completed(futures, timeout=self.deadline):
+        location = future.result()
+        if location:
+          logger.debug("{} located the IP address at {}, {}".format(futures[future], location[0], location[1]))
+          answers.append(location)
+          if len(answers) >= self.ipQuorum:
+            break
+    except concurrent.futures.TimeoutError:
+      logger.debug("IP location deadline passed with {} answers".format(len(answers)))
+    # Lookups which are still running finish in the background
+    for future in futures:
+      future.cancel()
+
+    return ipConsensus(answers, self.ipOutlierDistance, self.ipMinimumAccuracy)
+
+  def getIPLocationCache(self):
+    if not self.ipLocationCache:
+      from LocationCache import LocationCache
+      path = os.path.join(self.cacheDir, 'cache.sqlite') if self.cacheDir else None
+      self.ipLocationCache = LocationCache(path, 'ip', ttl=self.ipLocationTTL)
+    return self.ipLocationCache
+
+  def getPublicIPAddress(self):
+    """ Get the external IP address, which is checked at most once every publicIPAddressInterval seconds
+
+    When the network is watched it is only checked again after the network changed.
+    """
+    elapsedTime = time.time() - self.lastPublicIPAddressLookup
+    watcher = self.getNetworkWatcher()
+    generation = watcher.networkGeneration if watcher else None
+    if self.publicIPAddress:
+      if watcher and generation == self.publicIPAddressGeneration:
+        if elapsedTime < self.publicIPAddressWatchedInterval:
+          return self.publicIPAddress
+      elif elapsedTime < self.publicIPAddressInterval:
+        return self.publicIPAddress
+
+    provider = self.getProvider('publicIPAddress')
+    if not provider.allow():
+      return None
+
+    import urllib.request, ipaddress
+    ipAddress = None
+    try:
+      with metrics.timer('follw_lookup_duration_seconds', lookup='ip-address'):
+        with urllib.request.urlopen(self.publicIPAddressURL, timeout=1) as response:
+          ipAddress = response.read().decode().strip()
+    except urllib.error.HTTPError as e:
+      logger.error(e.code)
+      return None
+    except urllib.error.URLError as e:
+      logger.error(e.reason)
+      return None
+    except (socket.timeout, UnicodeDecodeError) as e:
+      logger.error(e)
+      return None
+    finally:
+      # Whatever went wrong, also an unexpected exception, counts as a failure
+      if ipAddress is None:
+        provider.failure()
+      else:
+        provider.success()
+
+    try:
+      ipaddress.ip_address(ipAddress)
+    except ValueError:
+      logger.error("Invalid external IP address {}".format(ipAddress))
+      return None
 
-    return None
\ No newline at end of file
+    if ipAddress != self.publicIPAddress:
+      logger.debug("External IP address is {}".format(ipAddress))
+    self.publicIPAddress = ipAddress
+    self.publicIPAddressGeneration = generation
+    self.lastPublicIPAddressLookup = time.time()
+    return ipAddress
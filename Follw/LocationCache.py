@@ -0,0 +1,75 @@
+import logging, time, threading, json, os, sqlite3
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class LocationCache:
+  """ Persistent LRU cache of location lookups with a TTL, backed by SQLite """
+  # Maximum number of entries, the least recently used entries are evicted first
+  maxSize = 10000
+  # Seconds a location is valid
+  ttl = 60*60*24*30
+  # Seconds a lookup without a location is remembered
+  negativeTTL = 60*60*24
+  # Seconds before the access time of an entry is updated again, so hits don't write on every lookup
+  touchInterval = 60
+
+  def __init__(self, path = None, table = 'cache', maxSize = None, ttl = None, negativeTTL = None):
+    if maxSize is not None:
+      self.maxSize = maxSize
+    if ttl is not None:
+      self.ttl = ttl
+    if negativeTTL is not None:
+      self.negativeTTL = negativeTTL
+    self.table = table
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+    if path:
+      # The state directory also holds the secret sharing URLs, the daemon runs with umask 0
+      os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    else:
+      path = ':memory:'
+    # The cache is used from the location acquisition threads
+    self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    # With WAL a commit is only synced at checkpoints, losing the last lookups on a power loss is fine for a cache
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, location TEXT, stored REAL, used REAL)".format(self.table))
+    self.db.execute("CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)".format(self.table))
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  def get(self, key):
+    """ Returns a tuple (hit, location), location is None for a cached lookup without a location """
+    now = time.time()
+    with self.lock:
+      row = self.db.execute("SELECT location, stored, used FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+      if row:
+        location = json.loads(row[0])
+        ttl = self.ttl if location is not None else self.negativeTTL
+        if now - row[1] <= ttl:
+          if now - row[2] >= self.touchInterval:
+            self.db.execute("UPDATE {} SET used = ? WHERE key = ?".format(self.table), (now, key))
+          self.hits += 1
+          metrics.increment('follw_cache_total', cache=self.table, result='hit')
+          return True, location
+        self.db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+      self.misses += 1
+    metrics.increment('follw_cache_total', cache=self.table, result='miss')
+    return False, None
+
+  def put(self, key, location):
+    now = time.time()
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO {} (key, location, stored, used) VALUES (?, ?, ?, ?)".format(self.table), (key, json.dumps(location), now, now))
+      size = self.db.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+      if size > self.maxSize:
+        self.db.execute("DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY used LIMIT ?)".format(self.table), (size - self.maxSize,))
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,255 @@
+import logging, os, stat, time, json, socket, selectors, threading, collections
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def encodeFix(fix):
+  """ A fix as a JSON line, the monotonic time is converted into an age and a wall clock time """
+  if fix is None:
+    return b'null\n'
+  return (json.dumps(fixToDict(fix)) + '\n').encode()
+
+def fixToDict(fix):
+  age = time.monotonic() - fix.time if fix.time is not None else None
+  return {
+    'latitude': fix.latitude,
+    'longitude': fix.longitude,
+    'accuracy': fix.accuracy,
+    'altitude': fix.altitude,
+    'direction': fix.direction,
+    'speed': fix.speed,
+    'time': time.time() - age if age is not None else None,
+    'age': age,
+    'source': fix.source
+    }
+
+class Client:
+  def __init__(self, connection):
+    self.connection = connection
+    self.input = bytearray()
+    self.output = bytearray()
+    self.subscribed = False
+
+class LocationServer(threading.Thread):
+  """ Serves the current fix and the recent track history over a Unix domain socket
+
+  The protocol is line based, every request is a line and every response a JSON line:
+
+    GET               the current fix, or null
+    HISTORY [seconds] a JSON array of the fixes of the last seconds, or all recent fixes
+    SUBSCRIBE         the current fix, followed by every new fix as it is acquired
+    UNSUBSCRIBE       stop pushing new fixes
+
+  A fix is an object with latitude, longitude, accuracy, altitude, direction, speed, time, age and
+  source. Unknown values are null.
+  """
+  # File mode of the socket, the location is personal data
+  mode = 0o600
+  # Subscribers which don't read their pending fixes are disconnected once this many bytes are pending
+  maxOutput = 1 << 20
+  maxRequest = 4096
+
+  def __init__(self, path, location):
+    super().__init__(name='LocationServer', daemon=True)
+    self.path = path
+    self.location = location
+    self.selector = selectors.DefaultSelector()
+    self.terminate = threading.Event()
+    self.socket = None
+    self.clients = {}
+
+    # New fixes are handed over from the acquiring thread and the server thread is woken up
+    self.lock = threading.Lock()
+    self.published = collections.deque()
+    self.wakeupReader, self.wakeupWriter = socket.socketpair()
+    self.wakeupReader.setblocking(False)
+    self.wakeupWriter.setblocking(False)
+
+    location.trackListeners.append(self.publish)
+
+  def listen(self):
+    # Remove the socket of a previous run
+    try:
+      if stat.S_ISSOCK(os.stat(self.path).st_mode):
+        os.unlink(self.path)
+    except FileNotFoundError:
+      pass
+
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o777 & ~self.mode)
+    try:
+      self.socket.bind(self.path)
+    finally:
+      os.umask(umask)
+    self.socket.listen()
+    self.socket.setblocking(False)
+    self.selector.register(self.socket, selectors.EVENT_READ)
+    self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+    logger.info("Serving the location on {}".format(self.path))
+
+  def stop(self):
+    self.terminate.set()
+    self.wakeup()
+
+  def wakeup(self):
+    try:
+      self.wakeupWriter.send(b'\0')
+    except (BlockingIOError, OSError):
+      # Already woken up, or stopped
+      pass
+
+  def publish(self, fix):
+    """ Called with every new fix, pushes it to the subscribers """
+    with self.lock:
+      self.published.append(fix)
+    self.wakeup()
+
+  def run(self):
+    try:
+      self.listen()
+    except OSError as e:
+      logger.error("Can't serve the location on {}: {}".format(self.path, e))
+      return
+
+    while not self.terminate.is_set():
+      for key, events in self.selector.select(timeout=1):
+        if key.fileobj is self.socket:
+          self.accept()
+        elif key.fileobj is self.wakeupReader:
+          self.broadcast()
+        else:
+          client = key.data
+          if events & selectors.EVENT_READ:
+            self.read(client)
+          if events & selectors.EVENT_WRITE and client.connection.fileno() != -1:
+            self.write(client)
+
+    for client in list(self.clients.values()):
+      self.disconnect(client)
+    self.selector.close()
+    self.socket.close()
+    self.wakeupReader.close()
+    self.wakeupWriter.close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+  def accept(self):
+    try:
+      connection, address = self.socket.accept()
+    except BlockingIOError:
+      return
+    connection.setblocking(False)
+    client = Client(connection)
+    self.clients[connection] = client
+    self.selector.register(connection, selectors.EVENT_READ, client)
+
+  def disconnect(self, client):
+    self.clients.pop(client.connection, None)
+    try:
+      self.selector.unregister(client.connection)
+    except (KeyError, ValueError):
+      pass
+    client.connection.close()
+
+  def broadcast(self):
+    try:
+      while self.wakeupReader.recv(4096):
+        pass
+    except BlockingIOError:
+      pass
+
+    with self.lock:
+      fixes = list(self.published)
+      self.published.clear()
+
+    subscribers = [client for client in self.clients.values() if client.subscribed]
+    for fix in fixes:
+      # Encoded once for all subscribers
+      line = encodeFix(fix)
+      for client in subscribers:
+        self.send(client, line)
+
+  def read(self, client):
+    try:
+      data = client.connection.recv(4096)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b''
+    if not data:
+      self.disconnect(client)
+      return
+
+    client.input += data
+    while b'\n' in client.input:
+      line, separator, rest = client.input.partition(b'\n')
+      client.input = bytearray(rest)
+      self.handle(client, bytes(line))
+      if client.connection not in self.clients:
+        return
+    if len(client.input) > self.maxRequest:
+      logger.debug("Request too long")
+      self.disconnect(client)
+
+  def handle(self, client, line):
+    request = line.decode('utf-8', errors='replace').split()
+    if not request:
+      return
+    command = request[0].upper()
+
+    if command == 'GET':
+      fixes = self.location.track.latest()
+      self.send(client, encodeFix(fixes[-1] if fixes else None))
+    elif command == 'HISTORY':
+      if len(request) > 1:
+        try:
+          fixes = self.location.track.last(float(request[1]), time.monotonic())
+        except ValueError:
+          self.send(client, b'{"error": "invalid number of seconds"}\n')
+          return
+      else:
+        fixes = self.location.track.fixes()
+      self.send(client, (json.dumps([fixToDict(fix) for fix in fixes]) + '\n').encode())
+    elif command == 'SUBSCRIBE':
+      client.subscribed = True
+      fixes = self.location.track.latest()
+      if fixes:
+        self.send(client, encodeFix(fixes[-1]))
+    elif command == 'UNSUBSCRIBE':
+      client.subscribed = False
+    else:
+      self.send(client, b'{"error": "unknown request"}\n')
+
+  def send(self, client, data):
+    if client.output:
+      client.output += data
+      if len(client.output) > self.maxOutput:
+        logger.warning("Disconnecting a location subscriber that doesn't keep up")
+        self.disconnect(client)
+      return
+
+    # Usually the whole response fits in the socket buffer and is sent right away
+    try:
+      sent = client.connection.send(data)
+    except (BlockingIOError, InterruptedError):
+      sent = 0
+    except OSError:
+      self.disconnect(client)
+      return
+    if sent < len(data):
+      client.output += data[sent:]
+      self.selector.modify(client.connection, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+  def write(self, client):
+    try:
+      sent = client.connection.send(client.output)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      self.disconnect(client)
+      return
+    del client.output[:sent]
+    if not client.output:
+      self.selector.modify(client.connection, selectors.EVENT_READ, client)
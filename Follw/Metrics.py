@@ -0,0 +1,172 @@
+import logging, sys, time, threading, bisect
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Upper bounds in seconds of the latency histogram buckets
+latencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds in seconds of the fix age histogram buckets
+ageBuckets = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+# Name: (type, help, histogram buckets)
+metricDescriptions = {
+  'follw_source_duration_seconds': ('histogram', "Time to get a location from a location source", latencyBuckets),
+  'follw_source_total': ('counter', "Location source calls by result", None),
+  'follw_lookup_duration_seconds': ('histogram', "Time spent in WiFi scans and WiFi and IP location provider lookups", latencyBuckets),
+  'follw_submit_duration_seconds': ('histogram', "Time to submit a location to the Follw.app WebService", latencyBuckets),
+  'follw_submit_total': ('counter', "Location submissions by HTTP status, error when the WebService could not be reached", None),
+  'follw_fix_age_seconds': ('histogram', "Age of the location when it is submitted", ageBuckets),
+  'follw_queue_dropped_total': ('counter', "Locations dropped because a newer location was acquired before they could be submitted", None),
+  'follw_provider_state': ('gauge', "Circuit breaker state of the external location providers, 0 closed, 1 half-open, 2 open", None),
+  'follw_geofence_events_total': ('counter', "Geofences entered and left", None),
+  'follw_network_events_total': ('counter', "Network changes by event, route, address, link or wifi, after which the WiFi and IP lookups are done again", None),
+  'follw_provider_total': ('counter', "External location provider requests by result, open and limited when skipped by the circuit breaker or rate limit", None),
+  'follw_cache_total': ('counter', "Location lookup cache lookups by cache, wifi or ip, and result, hit or miss", None),
+  }
+
+def metricKey(name, labels):
+  # Label values are compared when rendering, so they must all be strings
+  return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def formatLabels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+class Histogram:
+  def __init__(self, buckets):
+    self.buckets = buckets
+    # One extra bucket for the values above the highest bound
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+class Timer:
+  """ Context manager which observes the time spent in the with block """
+  def __init__(self, metrics, name, labels):
+    self.metrics = metrics
+    self.name = name
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+    return False
+
+class Metrics:
+  """ Counters, gauges and histograms of the location sources and submissions
+
+  Recording a value only takes a dictionary lookup and an increment under a lock, the text is only
+  rendered when the metrics are scraped or dumped.
+  """
+  host = '127.0.0.1'
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+    self.server = None
+
+  def increment(self, name, value = 1, **labels):
+    key = metricKey(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    key = metricKey(name, labels)
+    with self.lock:
+      self.gauges[key] = value
+
+  def observe(self, name, value, **labels):
+    key = metricKey(name, labels)
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if not histogram:
+        histogram = self.histograms[key] = Histogram(metricDescriptions[name][2] or latencyBuckets)
+      histogram.observe(value)
+
+  def timer(self, name, **labels):
+    return Timer(self, name, labels)
+
+  def render(self):
+    """ The metrics in the Prometheus text exposition format """
+    with self.lock:
+      counters = sorted(self.counters.items())
+      gauges = sorted(self.gauges.items())
+      histograms = sorted((key, list(histogram.counts), histogram.sum, histogram.count, histogram.buckets) for key, histogram in self.histograms.items())
+
+    lines = []
+    described = set()
+    def describe(name):
+      if name not in described and name in metricDescriptions:
+        described.add(name)
+        lines.append('# HELP {} {}'.format(name, metricDescriptions[name][1]))
+        lines.append('# TYPE {} {}'.format(name, metricDescriptions[name][0]))
+
+    for (name, labels), value in counters + gauges:
+      describe(name)
+      lines.append('{}{} {}'.format(name, formatLabels(labels), value))
+
+    for (name, labels), counts, sum, count, buckets in histograms:
+      describe(name)
+      cumulative = 0
+      for bound, bucketCount in zip(buckets + (float('inf'),), counts):
+        cumulative += bucketCount
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('{}_bucket{} {}'.format(name, formatLabels(labels + (('le', le),)), cumulative))
+      lines.append('{}_sum{} {}'.format(name, formatLabels(labels), repr(sum)))
+      lines.append('{}_count{} {}'.format(name, formatLabels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+  def dump(self, signum = None, frame = None):
+    """ Write the metrics to stderr, used as SIGUSR1 handler """
+    # The handler may interrupt the main thread while it holds the lock, so render in another thread
+    threading.Thread(target=self.write, name='MetricsDump', daemon=True).start()
+
+  def write(self):
+    sys.stderr.write(self.render())
+    sys.stderr.flush()
+
+  def start(self, port, host = None):
+    """ Serve the metrics over HTTP at /metrics, only on localhost unless an other host is given """
+    import http.server
+    metrics = self
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = http.server.ThreadingHTTPServer((host or self.host, port), MetricsHandler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, name='Metrics', daemon=True).start()
+    logger.info("Serving metrics on http://{}:{}/metrics".format(*self.server.server_address[:2]))
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+# The metrics of the process, shared by all location sources and shares
+metrics = Metrics()
@@ -0,0 +1,117 @@
+import logging, time, math
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+earthRadius = 6371008.8
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+  """ Great-circle distance in meters """
+  phi1 = math.radians(latitude1)
+  phi2 = math.radians(latitude2)
+  a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+  return 2 * earthRadius * math.asin(min(1, math.sqrt(a)))
+
+def bearing(latitude1, longitude1, latitude2, longitude2):
+  """ Initial bearing in degrees from the first to the second location """
+  phi1 = math.radians(latitude1)
+  phi2 = math.radians(latitude2)
+  deltaLambda = math.radians(longitude2 - longitude1)
+  x = math.sin(deltaLambda) * math.cos(phi2)
+  y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(deltaLambda)
+  return math.degrees(math.atan2(x, y)) % 360
+
+def headingDifference(heading1, heading2):
+  return abs((heading1 - heading2 + 180) % 360 - 180)
+
+def field(location, index):
+  return location[index] if len(location) > index else None
+
+class MovementFilter:
+  """ Decides which locations are worth submitting and how often to acquire a location """
+  # Locations within this many meters of the last submitted location are not submitted
+  deadBand = 5
+  # The dead-band grows with the reported accuracy, since a location is only known up to its accuracy
+  accuracyFactor = 0.5
+  # Heading change in degrees which is submitted even when within the dead-band
+  headingChange = 30
+  # Speed in m/s from which we're considered to be moving
+  movingSpeed = 1
+  # Interval when stationary, None to use the regular interval
+  stationaryInterval = None
+  # Maximum number of seconds without submitting a location
+  heartbeat = 300
+
+  def __init__(self):
+    self.lastLocation = None
+    self.lastTime = None
+    # Heading at the last submitted location, reported or derived from the location before it
+    self.lastHeading = None
+    self.moving = True
+
+  def accept(self, location):
+    """ Returns True when the location should be submitted """
+    if self.lastLocation is None:
+      return True
+
+    if self.heartbeat and time.monotonic() - self.lastTime >= self.heartbeat:
+      logger.debug("Heartbeat")
+      return True
+
+    distance = haversine(self.lastLocation[0], self.lastLocation[1], location[0], location[1])
+    accuracy = max(field(location, 2) or 0, field(self.lastLocation, 2) or 0)
+    deadBand = max(self.deadBand, self.accuracyFactor * accuracy)
+    if distance > deadBand:
+      return True
+
+    # A change of direction while moving is worth submitting even when the distance is small
+    direction = field(location, 4)
+    speed = field(location, 5)
+    if direction is None and distance > accuracy:
+      # Sources without a heading, the bearing is only meaningful once we moved more than the accuracy
+      direction = bearing(self.lastLocation[0], self.lastLocation[1], location[0], location[1])
+      if speed is None:
+        elapsedTime = time.monotonic() - self.lastTime
+        speed = distance / elapsedTime if elapsedTime > 0 else None
+    if direction is not None and self.lastHeading is not None and speed is not None and speed >= self.movingSpeed:
+      if headingDifference(direction, self.lastHeading) > self.headingChange:
+        return True
+
+    logger.debug("Location within {:.1f}m dead-band".format(deadBand))
+    return False
+
+  def submitted(self, location):
+    """ Record the location that has been submitted """
+    heading = field(location, 4)
+    if heading is None and self.lastLocation is not None:
+      distance = haversine(self.lastLocation[0], self.lastLocation[1], location[0], location[1])
+      if distance > max(field(location, 2) or 0, field(self.lastLocation, 2) or 0):
+        heading = bearing(self.lastLocation[0], self.lastLocation[1], location[0], location[1])
+    self.lastHeading = heading
+    self.lastLocation = location
+    self.lastTime = time.monotonic()
+
+  def isMoving(self, location):
+    speed = field(location, 5)
+    if speed is not None:
+      return speed >= self.movingSpeed
+
+    # Derive the speed from the last submitted location when the source doesn't report it
+    if self.lastLocation is None:
+      return True
+    elapsedTime = time.monotonic() - self.lastTime
+    if elapsedTime <= 0:
+      return self.moving
+    accuracy = max(field(location, 2) or 0, field(self.lastLocation, 2) or 0)
+    distance = max(0, haversine(self.lastLocation[0], self.lastLocation[1], location[0], location[1]) - accuracy)
+    return distance / elapsedTime >= self.movingSpeed
+
+  def getInterval(self, location, interval):
+    """ The acquisition interval for the given location, short when moving and long when stationary """
+    moving = self.isMoving(location)
+    if moving != self.moving:
+      logger.debug("Moving" if moving else "Stationary")
+      self.moving = moving
+    if not moving and self.stationaryInterval:
+      return self.stationaryInterval
+    return interval
@@ -0,0 +1,222 @@
+import logging, socket, struct, itertools
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Netlink
+NETLINK_GENERIC = 16
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_MULTI = 0x02
+NLM_F_DUMP = 0x300
+NLA_TYPE_MASK = 0x3fff
+
+# Generic netlink controller
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+CTRL_ATTR_MCAST_GROUPS = 7
+CTRL_ATTR_MCAST_GRP_NAME = 1
+CTRL_ATTR_MCAST_GRP_ID = 2
+
+# nl80211
+NL80211_CMD_GET_SCAN = 32
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_BSS = 47
+NL80211_BSS_BSSID = 1
+NL80211_BSS_FREQUENCY = 2
+NL80211_BSS_INFORMATION_ELEMENTS = 6
+NL80211_BSS_SIGNAL_MBM = 7
+NL80211_BSS_STATUS = 9
+NL80211_BSS_SEEN_MS_AGO = 10
+NL80211_BSS_STATUS_ASSOCIATED = 1
+
+nlmsghdr = struct.Struct('=IHHII')
+genlmsghdr = struct.Struct('=BBH')
+nlattr = struct.Struct('=HH')
+
+def align(length):
+  return (length + 3) & ~3
+
+def packAttribute(type, payload):
+  return nlattr.pack(nlattr.size + len(payload), type) + payload + b'\0' * (align(len(payload)) - len(payload))
+
+def parseAttributes(data, offset = 0, end = None):
+  """ Parse netlink attributes into a dict of type to payload """
+  if end is None:
+    end = len(data)
+  attributes = {}
+  while offset + nlattr.size <= end:
+    length, type = nlattr.unpack_from(data, offset)
+    if length < nlattr.size:
+      break
+    attributes[type & NLA_TYPE_MASK] = data[offset + nlattr.size:offset + length]
+    offset += align(length)
+  return attributes
+
+def parseMessages(data):
+  """ Split a netlink datagram into (type, flags, seq, payload) tuples """
+  offset = 0
+  while offset + nlmsghdr.size <= len(data):
+    length, type, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+    if length < nlmsghdr.size:
+      break
+    yield type, flags, seq, data[offset + nlmsghdr.size:offset + length]
+    offset += align(length)
+
+def frequencyToChannel(frequency):
+  if frequency == 2484:
+    return 14
+  if 2412 <= frequency <= 2472:
+    return (frequency - 2407) // 5
+  if 5000 <= frequency < 5925:
+    return (frequency - 5000) // 5
+  if 5925 <= frequency <= 7125:
+    return (frequency - 5950) // 5
+  return None
+
+def parseSSID(informationElements):
+  """ Get the SSID from the information elements of a beacon """
+  offset = 0
+  while offset + 2 <= len(informationElements):
+    id = informationElements[offset]
+    length = informationElements[offset + 1]
+    if id == 0:
+      return bytes(informationElements[offset + 2:offset + 2 + length]).decode('utf-8', errors='replace')
+    offset += 2 + length
+  return None
+
+def parseBSS(data):
+  """ Parse a nested NL80211_ATTR_BSS attribute into an access point dict """
+  attributes = parseAttributes(data)
+  if NL80211_BSS_BSSID not in attributes:
+    return None
+
+  ap = {
+    'bssid': ':'.join('{:02x}'.format(byte) for byte in attributes[NL80211_BSS_BSSID][:6]),
+    'ssid': None,
+    'channel': None,
+    'frequency': None,
+    'signal': None,
+    'noise': None,
+    'age': 0,
+    'associated': False
+    }
+  if NL80211_BSS_INFORMATION_ELEMENTS in attributes:
+    ap['ssid'] = parseSSID(attributes[NL80211_BSS_INFORMATION_ELEMENTS])
+  if NL80211_BSS_FREQUENCY in attributes:
+    ap['frequency'] = struct.unpack_from('=I', attributes[NL80211_BSS_FREQUENCY])[0]
+    ap['channel'] = frequencyToChannel(ap['frequency'])
+  if NL80211_BSS_SIGNAL_MBM in attributes:
+    # Signal strength in mBm, which is 100 * dBm
+    ap['signal'] = struct.unpack_from('=i', attributes[NL80211_BSS_SIGNAL_MBM])[0] // 100
+  if NL80211_BSS_SEEN_MS_AGO in attributes:
+    ap['age'] = struct.unpack_from('=I', attributes[NL80211_BSS_SEEN_MS_AGO])[0]
+  if NL80211_BSS_STATUS in attributes:
+    ap['associated'] = struct.unpack_from('=I', attributes[NL80211_BSS_STATUS])[0] == NL80211_BSS_STATUS_ASSOCIATED
+  return ap
+
+def parseScanResults(datagrams, familyId):
+  """ Parse recorded NL80211_CMD_GET_SCAN dump datagrams into a list of access points """
+  aps = []
+  for data in datagrams:
+    for type, flags, seq, payload in parseMessages(data):
+      if type != familyId:
+        continue
+      attributes = parseAttributes(payload, genlmsghdr.size)
+      if NL80211_ATTR_BSS in attributes:
+        ap = parseBSS(attributes[NL80211_ATTR_BSS])
+        if ap:
+          aps.append(ap)
+  return aps
+
+def parseFamily(datagrams):
+  """ Parse the CTRL_CMD_GETFAMILY response datagrams into the family ID and a dict of multicast group names to IDs, None when not found """
+  for data in datagrams:
+    for type, flags, seq, payload in parseMessages(data):
+      if type != GENL_ID_CTRL:
+        continue
+      attributes = parseAttributes(payload, genlmsghdr.size)
+      familyId = struct.unpack_from('=H', attributes[CTRL_ATTR_FAMILY_ID])[0]
+      groups = {}
+      for group in parseAttributes(attributes.get(CTRL_ATTR_MCAST_GROUPS, b'')).values():
+        group = parseAttributes(group)
+        groups[bytes(group[CTRL_ATTR_MCAST_GRP_NAME]).rstrip(b'\0').decode()] = struct.unpack_from('=I', group[CTRL_ATTR_MCAST_GRP_ID])[0]
+      return familyId, groups
+  return None
+
+def getDefaultRouteInterfaces(path = '/proc/net/route'):
+  """ Get the interfaces of the IPv4 default routes """
+  interfaces = []
+  with open(path) as file:
+    next(file)
+    for line in file:
+      fields = line.split()
+      # Destination 0.0.0.0 and flags RTF_UP | RTF_GATEWAY
+      if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 0x3 == 0x3:
+        if fields[0] not in interfaces:
+          interfaces.append(fields[0])
+  return interfaces
+
+class NL80211:
+  """ Minimal nl80211 generic netlink client to read WiFi scan results without running external commands """
+  timeout = 1
+
+  def __init__(self):
+    self.socket = None
+    self.familyId = None
+    self.multicastGroups = {}
+    self.sequence = itertools.count(1)
+
+  def close(self):
+    if self.socket:
+      self.socket.close()
+      self.socket = None
+
+  def open(self):
+    if self.socket:
+      return
+    self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    self.socket.settimeout(self.timeout)
+    self.socket.bind((0, 0))
+    self.familyId, self.multicastGroups = self.getFamily('nl80211')
+
+  def request(self, type, flags, command, attributes = b''):
+    """ Send a generic netlink request and return the datagrams of the response """
+    sequence = next(self.sequence)
+    payload = genlmsghdr.pack(command, 1, 0) + attributes
+    self.socket.send(nlmsghdr.pack(nlmsghdr.size + len(payload), type, NLM_F_REQUEST | flags, sequence, 0) + payload)
+
+    datagrams = []
+    while True:
+      data = self.socket.recv(65536)
+      done = False
+      for messageType, messageFlags, messageSequence, messagePayload in parseMessages(data):
+        if messageSequence != sequence:
+          continue
+        if messageType == NLMSG_ERROR:
+          error = struct.unpack_from('=i', messagePayload)[0]
+          if error:
+            raise OSError(-error, "Netlink error")
+          done = True
+        elif messageType == NLMSG_DONE or not messageFlags & NLM_F_MULTI:
+          done = True
+      datagrams.append(data)
+      if done:
+        return datagrams
+
+  def getFamily(self, name):
+    """ Resolve a generic netlink family name into its ID and multicast groups """
+    family = parseFamily(self.request(GENL_ID_CTRL, 0, CTRL_CMD_GETFAMILY, packAttribute(CTRL_ATTR_FAMILY_NAME, name.encode() + b'\0')))
+    if family:
+      return family
+    raise OSError("Generic netlink family {} not found".format(name))
+
+  def getScanResults(self, interface):
+    """ Get the cached scan results of the interface, including the access point we're associated with """
+    self.open()
+    ifindex = socket.if_nametoindex(interface)
+    datagrams = self.request(self.familyId, NLM_F_DUMP, NL80211_CMD_GET_SCAN, packAttribute(NL80211_ATTR_IFINDEX, struct.pack('=I', ifindex)))
+    return parseScanResults(datagrams, self.familyId)
@@ -0,0 +1,210 @@
+import logging, datetime
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# User equivalent range error in meters, multiplied with the HDOP to estimate the accuracy
+uere = 5
+knots = 0.514444
+
+def checksum(body):
+  """ XOR of all bytes between $ and * """
+  value = 0
+  for byte in body:
+    value ^= byte
+  return value
+
+def parseSentence(line, requireChecksum = True):
+  """ Validate a NMEA 0183 sentence, returns (type, fields) or None
+
+  The type is the sentence formatter without the talker ID, so GPRMC and GNRMC are both RMC. A
+  sentence without a checksum is only accepted when requireChecksum is False, for recorded logs.
+  """
+  line = line.strip()
+  if len(line) < 6 or line[0] not in b'$!':
+    return None
+  star = line.rfind(b'*')
+  if star == -1 and requireChecksum:
+    return None
+  if star != -1:
+    if len(line) - star != 3:
+      return None
+    try:
+      if int(line[star + 1:star + 3], 16) != checksum(line[1:star]):
+        return None
+    except ValueError:
+      return None
+    body = line[1:star]
+  else:
+    body = line[1:]
+  fields = body.split(b',')
+  address = fields[0]
+  return address[-3:].decode('ascii', errors='replace'), fields
+
+def parseCoordinate(value, hemisphere, limit):
+  """ Convert a (d)ddmm.mmmm value into degrees, raises ValueError when it isn't within limit degrees """
+  if not value:
+    return None
+  value = float(value)
+  degrees = int(value // 100)
+  minutes = value - degrees * 100
+  if not 0 <= minutes < 60:
+    raise ValueError("Invalid minutes {}".format(minutes))
+  degrees += minutes / 60
+  if degrees > limit:
+    raise ValueError("Coordinate {} out of range".format(degrees))
+  if hemisphere in (b'S', b'W'):
+    degrees = -degrees
+  return degrees
+
+def parseFloat(value):
+  try:
+    return float(value) if value else None
+  except ValueError:
+    return None
+
+def parseTime(date, time):
+  """ Parse a ddmmyy date and hhmmss.ss time into a UTC datetime """
+  if len(date) < 6 or len(time) < 6:
+    return None
+  try:
+    seconds = float(time[4:])
+    return datetime.datetime(2000 + int(date[4:6]), int(date[2:4]), int(date[0:2]), int(time[0:2]), int(time[2:4]), int(seconds), int(round(seconds % 1 * 1e6)) % 1000000, tzinfo=datetime.timezone.utc)
+  except ValueError:
+    return None
+
+def decodeRMC(fields):
+  if len(fields) < 10:
+    return None
+  return {
+    'time': parseTime(fields[9], fields[1]),
+    'valid': fields[2] == b'A',
+    'latitude': parseCoordinate(fields[3], fields[4], 90),
+    'longitude': parseCoordinate(fields[5], fields[6], 180),
+    'speed': parseFloat(fields[7]) * knots if parseFloat(fields[7]) is not None else None,
+    'direction': parseFloat(fields[8])
+    }
+
+def decodeGGA(fields):
+  if len(fields) < 10:
+    return None
+  return {
+    'latitude': parseCoordinate(fields[2], fields[3], 90),
+    'longitude': parseCoordinate(fields[4], fields[5], 180),
+    'quality': int(fields[6]) if fields[6].isdigit() else 0,
+    'satellites': int(fields[7]) if fields[7].isdigit() else None,
+    'hdop': parseFloat(fields[8]),
+    'altitude': parseFloat(fields[9])
+    }
+
+def decodeGSA(fields):
+  if len(fields) < 17:
+    return None
+  return {
+    'mode': int(fields[2]) if fields[2].isdigit() else 1,
+    'hdop': parseFloat(fields[16])
+    }
+
+def decodeVTG(fields):
+  if len(fields) < 8:
+    return None
+  speed = parseFloat(fields[7])
+  return {
+    'direction': parseFloat(fields[1]),
+    'speed': speed / 3.6 if speed is not None else None
+    }
+
+decoders = {
+  'RMC': decodeRMC,
+  'GGA': decodeGGA,
+  'GSA': decodeGSA,
+  'VTG': decodeVTG
+  }
+
+class NMEAState:
+  """ Combines the RMC, GGA, GSA and VTG sentences of an epoch into locations """
+  def __init__(self):
+    self.altitude = None
+    self.hdop = None
+    self.mode = None
+    self.direction = None
+    self.speed = None
+
+  def update(self, type, fields):
+    """ Process a sentence, returns (time, location) when it completes a location, otherwise None """
+    decoder = decoders.get(type)
+    if not decoder:
+      return None
+    try:
+      data = decoder(fields)
+    except (ValueError, IndexError):
+      return None
+    if not data:
+      return None
+
+    if type == 'GGA':
+      self.altitude = data['altitude']
+      self.hdop = data['hdop']
+      if data['quality'] == 0:
+        self.mode = 1
+    elif type == 'GSA':
+      self.mode = data['mode']
+      if data['hdop'] is not None:
+        self.hdop = data['hdop']
+    elif type == 'VTG':
+      self.direction = data['direction']
+      self.speed = data['speed']
+    elif type == 'RMC':
+      if not data['valid'] or data['latitude'] is None or data['longitude'] is None:
+        return None
+      accuracy = round(self.hdop * uere, 1) if self.hdop is not None else None
+      speed = data['speed'] if data['speed'] is not None else self.speed
+      direction = data['direction'] if data['direction'] is not None else self.direction
+      return data['time'], [data['latitude'], data['longitude'], accuracy, self.altitude, direction, speed]
+    return None
+
+class NMEAParser:
+  """ Incremental parser of a NMEA 0183 byte stream, as read from a serial GPS device
+
+  Data is appended to a single reusable buffer. Only sentences of the decoded types are copied out,
+  checksum validated and split into fields, all other sentences, such as GSV, and line noise are
+  skipped in the buffer.
+  """
+  # A sentence is at most 82 bytes, longer lines are noise
+  maxLength = 82
+
+  def __init__(self):
+    self.buffer = bytearray()
+    self.state = NMEAState()
+    self.types = set(type.encode() for type in decoders)
+    self.sentences = 0
+    self.invalid = 0
+
+  def feed(self, data):
+    """ Process the next bytes of the stream, returns the list of (time, location) fixes they complete """
+    buffer = self.buffer
+    buffer += data
+    fixes = []
+    start = 0
+    while True:
+      end = buffer.find(b'\n', start)
+      if end == -1:
+        break
+      dollar = buffer.find(b'$', start, end)
+      # The type follows the $ and the two character talker ID
+      if dollar != -1 and end - dollar <= self.maxLength and bytes(buffer[dollar + 3:dollar + 6]) in self.types:
+        sentence = parseSentence(bytes(buffer[dollar:end]))
+        if sentence:
+          self.sentences += 1
+          fix = self.state.update(*sentence)
+          if fix:
+            fixes.append(fix)
+        else:
+          self.invalid += 1
+      start = end + 1
+
+    del buffer[:start]
+    if len(buffer) > self.maxLength:
+      # No end of line in sight, not a NMEA stream or the wrong baud rate
+      buffer.clear()
+    return fixes
@@ -0,0 +1,132 @@
+import logging, os, time, threading, selectors
+from NMEA import NMEAParser
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class NMEAReader(threading.Thread):
+  """ Background reader of the NMEA 0183 sentences of a serial GPS device or pty, without GPSd
+
+  Has the same interface as the GPSReader, the fixes are timestamped as they are read from the device.
+  """
+  baudRate = 9600
+  # Seconds to wait before opening the device again
+  reconnectInterval = 5
+  readSize = 4096
+
+  def __init__(self, path, baudRate = None, callback = None):
+    super().__init__(name='NMEAReader', daemon=True)
+    self.path = path
+    if baudRate:
+      self.baudRate = baudRate
+    # Called with the new location whenever a sentence completes a fix
+    self.callback = callback
+
+    self.fd = None
+    self.selector = selectors.DefaultSelector()
+    self.terminate = threading.Event()
+    # Set once the device has sent a valid sentence, or when it can't be opened
+    self.ready = threading.Event()
+    self.lock = threading.Lock()
+    self.parser = None
+    # Read into the same buffer every time
+    self.chunk = bytearray(self.readSize)
+
+    self.nGPSDevices = 0
+    self.location = None
+    self.timestamp = None
+
+  def stop(self):
+    self.terminate.set()
+
+  def getLocation(self, maxAge = None):
+    """ Return the most recent location, or None when there is none or it is older than maxAge seconds """
+    with self.lock:
+      location = self.location
+      timestamp = self.timestamp
+
+    if location is None:
+      return None
+    if maxAge is not None and time.monotonic() - timestamp > maxAge:
+      return None
+    return list(location)
+
+  def open(self):
+    try:
+      self.fd = os.open(self.path, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+      if os.isatty(self.fd):
+        self.configure()
+    except (OSError, ValueError) as e:
+      logger.warning("Can't open GPS device {}: {}".format(self.path, e))
+      self.close()
+      self.ready.set()
+      return False
+
+    self.parser = NMEAParser()
+    self.selector.register(self.fd, selectors.EVENT_READ)
+    with self.lock:
+      self.nGPSDevices = 1
+    return True
+
+  def configure(self):
+    """ Put the serial device in raw mode at the baud rate """
+    import termios
+    speed = getattr(termios, 'B{}'.format(self.baudRate), None)
+    if speed is None:
+      raise ValueError("Unsupported baud rate {}".format(self.baudRate))
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self.fd)
+    cc[termios.VMIN] = 1
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(self.fd, termios.TCSANOW, [0, 0, termios.CS8 | termios.CREAD | termios.CLOCAL, 0, speed, speed, cc])
+
+  def close(self):
+    if self.fd is not None:
+      try:
+        self.selector.unregister(self.fd)
+      except (KeyError, ValueError):
+        pass
+      os.close(self.fd)
+      self.fd = None
+
+    with self.lock:
+      self.nGPSDevices = 0
+      self.location = None
+
+  def run(self):
+    view = memoryview(self.chunk)
+    while not self.terminate.is_set():
+      if self.fd is None and not self.open():
+        self.terminate.wait(self.reconnectInterval)
+        continue
+
+      # Block until the device sends something, wake up once a second to check if we need to stop
+      if not self.selector.select(timeout=1):
+        continue
+
+      try:
+        size = os.readv(self.fd, [self.chunk])
+      except (BlockingIOError, InterruptedError):
+        continue
+      except OSError:
+        # A pty returns EIO once the other side is closed
+        size = 0
+      if size == 0:
+        logger.warning("Lost GPS device {}".format(self.path))
+        self.close()
+        continue
+
+      fixes = self.parser.feed(view[:size])
+      if fixes:
+        now = time.monotonic()
+        # The time of the GPS clock is not used, the monotonic time of reading is comparable to the other sources
+        nmeaTime, location = fixes[-1]
+        with self.lock:
+          self.location = location
+          self.timestamp = now
+        if self.callback:
+          self.callback(location)
+      if self.parser.sentences:
+        self.ready.set()
+
+    self.close()
+    self.selector.close()
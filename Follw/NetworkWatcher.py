@@ -0,0 +1,188 @@
+import logging, socket, struct, threading, selectors
+from NL80211 import NL80211, parseMessages, parseAttributes, genlmsghdr
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# rtnetlink
+NETLINK_ROUTE = 0
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RT_TABLE_MAIN = 254
+RTA_TABLE = 15
+IFA_ADDRESS = 1
+RTN_UNICAST = 1
+RT_SCOPE_UNIVERSE = 0
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+# nl80211 MLME events
+NL80211_CMD_CONNECT = 46
+NL80211_CMD_ROAM = 47
+NL80211_CMD_DISCONNECT = 48
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_MAC = 6
+NL80211_ATTR_STATUS_CODE = 72
+
+rtmsg = struct.Struct('=BBBBBBBBI')
+ifaddrmsg = struct.Struct('=BBBBI')
+ifinfomsg = struct.Struct('=BxHiII')
+
+def parseRouteEvents(data, linkFlags, addresses):
+  """ Get the changes in a rtnetlink datagram that can change the network we're on
+
+  Returns a set of 'route' when a default route changed, 'address' when a global address was added or
+  removed and 'link' when an interface went up or down. linkFlags is a dict of interface index to the
+  flags seen before and addresses the set of global addresses seen before, both are updated.
+  """
+  events = set()
+  for type, flags, seq, payload in parseMessages(data):
+    if type in (RTM_NEWROUTE, RTM_DELROUTE) and len(payload) >= rtmsg.size:
+      family, dstLength, srcLength, tos, table, protocol, scope, routeType, routeFlags = rtmsg.unpack_from(payload)
+      attributes = parseAttributes(payload, rtmsg.size)
+      if RTA_TABLE in attributes:
+        table = struct.unpack_from('=I', attributes[RTA_TABLE])[0]
+      if dstLength == 0 and table == RT_TABLE_MAIN and routeType == RTN_UNICAST:
+        events.add('route')
+    elif type in (RTM_NEWADDR, RTM_DELADDR) and len(payload) >= ifaddrmsg.size:
+      family, prefixLength, addressFlags, scope, index = ifaddrmsg.unpack_from(payload)
+      if scope != RT_SCOPE_UNIVERSE:
+        continue
+      # IPv6 addresses are announced again whenever their lifetime is renewed
+      address = (index, bytes(parseAttributes(payload, ifaddrmsg.size).get(IFA_ADDRESS, b'')))
+      if type == RTM_NEWADDR and address not in addresses:
+        addresses.add(address)
+        events.add('address')
+      elif type == RTM_DELADDR and address in addresses:
+        addresses.discard(address)
+        events.add('address')
+    elif type in (RTM_NEWLINK, RTM_DELLINK) and len(payload) >= ifinfomsg.size:
+      family, deviceType, index, interfaceFlags, change = ifinfomsg.unpack_from(payload)
+      if interfaceFlags & IFF_LOOPBACK:
+        continue
+      # Wireless drivers send RTM_NEWLINK for all kinds of status updates, only up and down matter
+      state = 0 if type == RTM_DELLINK else interfaceFlags & (IFF_UP | IFF_RUNNING)
+      if linkFlags.get(index, state) != state:
+        events.add('link')
+      linkFlags[index] = state
+  return events
+
+def parseWiFiEvents(data, familyId):
+  """ Get the (interface index, BSSID) associations in a nl80211 MLME datagram, BSSID None on disconnect """
+  associations = []
+  for type, flags, seq, payload in parseMessages(data):
+    if type != familyId or len(payload) < genlmsghdr.size:
+      continue
+    command = payload[0]
+    if command not in (NL80211_CMD_CONNECT, NL80211_CMD_ROAM, NL80211_CMD_DISCONNECT):
+      continue
+    attributes = parseAttributes(payload, genlmsghdr.size)
+    index = struct.unpack_from('=I', attributes[NL80211_ATTR_IFINDEX])[0] if NL80211_ATTR_IFINDEX in attributes else None
+    bssid = None
+    if command != NL80211_CMD_DISCONNECT and NL80211_ATTR_MAC in attributes:
+      # A failed connection attempt doesn't change the association
+      if NL80211_ATTR_STATUS_CODE in attributes and struct.unpack_from('=H', attributes[NL80211_ATTR_STATUS_CODE])[0] != 0:
+        continue
+      bssid = ':'.join('{:02x}'.format(byte) for byte in attributes[NL80211_ATTR_MAC][:6])
+    associations.append((index, bssid))
+  return associations
+
+class NetworkWatcher(threading.Thread):
+  """ Watches rtnetlink and nl80211 for changes of the network we're on
+
+  networkGeneration is incremented whenever a default route, a global address or the state of an
+  interface changes, wifiGeneration also whenever the associated access point changes. Lookups which
+  depend on the network only have to be done again when the generation they were done in has changed.
+  """
+  def __init__(self):
+    super().__init__(name='NetworkWatcher', daemon=True)
+    # Called with the set of events whenever the network changes
+    self.listeners = []
+    self.selector = selectors.DefaultSelector()
+    self.terminate = threading.Event()
+    self.routeSocket = None
+    self.wifi = None
+    self.linkFlags = {}
+    self.addresses = set()
+    self.associations = {}
+
+    self.networkGeneration = 0
+    self.wifiGeneration = 0
+
+  def open(self):
+    """ Subscribe to the netlink events, raises OSError when netlink isn't available """
+    self.routeSocket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    self.routeSocket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+    self.routeSocket.setblocking(False)
+    self.selector.register(self.routeSocket, selectors.EVENT_READ)
+
+    # Without nl80211, for instance without WiFi hardware, only the routes and addresses are watched
+    try:
+      self.wifi = NL80211()
+      self.wifi.open()
+      if 'mlme' not in self.wifi.multicastGroups:
+        raise OSError("nl80211 has no mlme multicast group")
+      self.wifi.socket.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, self.wifi.multicastGroups['mlme'])
+      self.wifi.socket.setblocking(False)
+      self.selector.register(self.wifi.socket, selectors.EVENT_READ)
+    except OSError as e:
+      logger.debug("Not watching WiFi associations: {}".format(e))
+      if self.wifi:
+        self.wifi.close()
+      self.wifi = None
+
+  def stop(self):
+    self.terminate.set()
+
+  def run(self):
+    while not self.terminate.is_set():
+      for key, mask in self.selector.select(timeout=1):
+        try:
+          data = key.fileobj.recv(65536)
+        except (BlockingIOError, InterruptedError):
+          continue
+        except OSError as e:
+          # The kernel drops events when we don't keep up, assume everything changed
+          logger.warning("Missed network events: {}".format(e))
+          self.changed({'route', 'wifi'})
+          continue
+
+        if key.fileobj is self.routeSocket:
+          events = parseRouteEvents(data, self.linkFlags, self.addresses)
+        else:
+          events = set()
+          for index, bssid in parseWiFiEvents(data, self.wifi.familyId):
+            if self.associations.get(index) != bssid:
+              self.associations[index] = bssid
+              events.add('wifi')
+        if events:
+          self.changed(events)
+
+    self.selector.close()
+    if self.routeSocket:
+      self.routeSocket.close()
+    if self.wifi:
+      self.wifi.close()
+
+  def changed(self, events):
+    logger.debug("Network changed: {}".format(', '.join(sorted(events))))
+    for event in events:
+      metrics.increment('follw_network_events_total', event=event)
+    if events - {'wifi'}:
+      self.networkGeneration += 1
+    self.wifiGeneration += 1
+    for listener in self.listeners:
+      listener(events)
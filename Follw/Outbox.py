@@ -0,0 +1,216 @@
+import logging, time, threading, json, os, random
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def parseRetryAfter(value):
+  """ Parse a Retry-After header value into a number of seconds """
+  if not value:
+    return None
+  try:
+    return max(0, int(value))
+  except ValueError:
+    pass
+  import email.utils
+  try:
+    return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+class Outbox(threading.Thread):
+  """ Keeps the newest location that could not be submitted per share and retries it in the background """
+  path = None
+  # Retry delays grow exponentially from backoff up to maxBackoff seconds
+  backoff = 1
+  maxBackoff = 300
+  # While backing off a new location is submitted right away at most once every probeInterval seconds, to notice early that the server is back
+  probeInterval = 15
+  # The outbox thread writes the changed entries at most every saveInterval seconds, so many shares don't rewrite the file for every location
+  saveInterval = 1
+
+  def __init__(self, submit, path = None):
+    super().__init__(name='Outbox', daemon=True)
+    # Called with the share and location, returns a tuple (done, retryAfter)
+    self.submit = submit
+    if path:
+      self.path = path
+    self.lock = threading.Lock()
+    # Held while writing the outbox file, so writes are never interleaved and never go back in time
+    self.writeLock = threading.RLock()
+    # Whether the entries have changed since they were last written
+    self.dirty = False
+    # Monotonic time of the last write
+    self.saved = 0
+    self.event = threading.Event()
+    self.terminate = False
+    # Pending entries per share, each a dict with the location, attempts and due time (wall clock)
+    self.entries = {}
+    # Wall clock time of the last probe, shared by all shares since they are submitted to the same server
+    self.probed = 0
+    self.load()
+
+  def stop(self):
+    self.terminate = True
+    self.event.set()
+
+  def close(self, timeout = None):
+    """ Stop the outbox thread and write the pending entries """
+    self.stop()
+    if self.is_alive():
+      self.join(timeout)
+    self.save()
+
+  def load(self):
+    if not self.path or not os.path.exists(self.path):
+      return
+    try:
+      with open(self.path) as file:
+        self.entries = json.load(file)
+      if self.entries:
+        logger.info("{} pending location(s) in outbox".format(len(self.entries)))
+    except (OSError, ValueError) as e:
+      logger.error("Can't read outbox {}: {}".format(self.path, e))
+      self.entries = {}
+
+  def save(self):
+    """ Write the entries when they have changed since they were last written """
+    if not self.path:
+      return
+    with self.writeLock:
+      # The snapshot is taken while holding the write lock, so a later write always has newer entries
+      with self.lock:
+        if not self.dirty:
+          return
+        data = json.dumps(self.entries)
+        self.dirty = False
+      try:
+        # The sharing URLs are secret, only the owner may read the outbox, the daemon runs with umask 0
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        temporaryPath = self.path + '.tmp'
+        fd = os.open(temporaryPath, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        with os.fdopen(fd, 'w') as file:
+          file.write(data)
+        os.replace(temporaryPath, self.path)
+        self.saved = time.monotonic()
+      except OSError as e:
+        logger.error("Can't write outbox {}: {}".format(self.path, e))
+        with self.lock:
+          self.dirty = True
+
+  def changed(self):
+    """ Have the changed entries written, by the outbox thread when it runs, right away otherwise """
+    if self.is_alive():
+      self.event.set()
+    else:
+      self.save()
+
+  def delay(self, attempts):
+    """ Exponential backoff with jitter """
+    delay = min(self.maxBackoff, self.backoff * 2 ** attempts)
+    return random.uniform(delay / 2, delay)
+
+  def has(self, share):
+    return share in self.entries
+
+  def isDue(self, share):
+    entry = self.entries.get(share)
+    return entry is not None and entry['due'] <= time.time()
+
+  def probe(self, share):
+    """ Returns True when a new location of a share that is backing off may be submitted right away to check whether the server is back """
+    with self.lock:
+      entry = self.entries.get(share)
+      # Don't probe when the server told us when to retry
+      if entry is None or entry.get('hold'):
+        return False
+      now = time.time()
+      if now - self.probed < self.probeInterval:
+        return False
+      self.probed = now
+      return True
+
+  def put(self, share, location, retryAfter = None):
+    """ Queue a location, replacing any older pending location of the same share """
+    with self.lock:
+      entry = self.entries.get(share)
+      if entry:
+        entry['location'] = location
+        if retryAfter is not None:
+          entry['due'] = time.time() + retryAfter
+          entry['hold'] = True
+      else:
+        # Entries of which the server told us when to retry are not flushed early
+        hold = retryAfter is not None
+        if retryAfter is None:
+          retryAfter = self.delay(0)
+        self.entries[share] = {'location': location, 'attempts': 0, 'due': time.time() + retryAfter, 'hold': hold}
+      self.dirty = True
+    self.changed()
+    self.event.set()
+
+  def remove(self, share):
+    with self.lock:
+      removed = self.entries.pop(share, None)
+      if removed:
+        self.dirty = True
+    if removed:
+      self.changed()
+
+  def flush(self):
+    """ Retry all pending locations right away, except those the server asked to retry later """
+    with self.lock:
+      if not self.entries:
+        return
+      now = time.time()
+      for entry in self.entries.values():
+        if not entry.get('hold'):
+          entry['due'] = now
+    self.event.set()
+
+  def process(self, force = False):
+    """ Retry the pending locations which are due, returns the number of seconds until the next one is due """
+    now = time.time()
+    with self.lock:
+      due = [(share, entry['location']) for share, entry in self.entries.items() if force or entry['due'] <= now]
+
+    for share, location in due:
+      if self.terminate:
+        break
+      done, retryAfter = self.submit(share, location)
+      with self.lock:
+        entry = self.entries.get(share)
+        if not entry:
+          continue
+        self.dirty = True
+        if done:
+          # Only remove the entry when no newer location was queued while submitting
+          if entry['location'] == location:
+            del self.entries[share]
+          continue
+        entry['attempts'] += 1
+        entry['hold'] = retryAfter is not None
+        if retryAfter is None:
+          retryAfter = self.delay(entry['attempts'])
+        entry['due'] = time.time() + retryAfter
+        logger.debug("Retrying in {:.1f}s".format(retryAfter))
+    if due:
+      self.changed()
+
+    with self.lock:
+      if not self.entries:
+        return None
+      return max(0, min(entry['due'] for entry in self.entries.values()) - time.time())
+
+  def run(self):
+    while not self.terminate:
+      # Cleared before processing, so a location queued meanwhile isn't missed
+      self.event.clear()
+      timeout = self.process()
+      if self.dirty:
+        wait = self.saved + self.saveInterval - time.monotonic()
+        if wait <= 0:
+          self.save()
+        else:
+          timeout = wait if timeout is None else min(timeout, wait)
+      self.event.wait(timeout)
+    self.save()
@@ -0,0 +1,100 @@
+import logging, time, threading
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+providerStates = {'closed': 0, 'half-open': 1, 'open': 2}
+
+class Provider:
+  """ Rate limit and circuit breaker of an external location provider
+
+  The rate limit is a token bucket holding a quota of requests which refills at the quota rate. After
+  failureThreshold consecutive failures the circuit opens and the provider is skipped without a
+  request. Once openTimeout seconds have passed a single probe request is let through, half-open, which
+  closes the circuit on success and opens it again for twice as long on failure.
+  """
+  # Consecutive failures after which the circuit opens
+  failureThreshold = 3
+  # Seconds the circuit stays open before a probe is let through
+  openTimeout = 30
+  maxOpenTimeout = 600
+
+  def __init__(self, name, quota = None):
+    """ The quota is a tuple (requests, seconds), None when the provider has no rate limit """
+    self.name = name
+    self.lock = threading.Lock()
+
+    self.capacity = None
+    if quota:
+      self.capacity = quota[0]
+      self.rate = quota[0] / quota[1]
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+
+    self.state = 'closed'
+    self.failures = 0
+    self.openedAt = None
+    self.timeout = self.openTimeout
+    self.probing = False
+    metrics.set('follw_provider_state', providerStates[self.state], provider=self.name)
+
+  def setState(self, state):
+    if state == self.state:
+      return
+    if state == 'open':
+      logger.warning("{} failed {} times, skipping it for {}s".format(self.name, self.failures, self.timeout))
+    elif state == 'half-open':
+      logger.info("Probing {}".format(self.name))
+    else:
+      logger.info("{} recovered".format(self.name))
+    self.state = state
+    metrics.set('follw_provider_state', providerStates[state], provider=self.name)
+
+  def allow(self):
+    """ Returns True when a request may be made now, which then has to be followed by success() or failure() """
+    with self.lock:
+      now = time.monotonic()
+
+      if self.state == 'open':
+        if now - self.openedAt < self.timeout:
+          metrics.increment('follw_provider_total', provider=self.name, result='open')
+          return False
+        self.setState('half-open')
+      if self.state == 'half-open' and self.probing:
+        # Only one probe at a time
+        metrics.increment('follw_provider_total', provider=self.name, result='open')
+        return False
+
+      if self.capacity:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+          logger.debug("{} rate limit reached".format(self.name))
+          metrics.increment('follw_provider_total', provider=self.name, result='limited')
+          return False
+        self.tokens -= 1
+
+      if self.state == 'half-open':
+        self.probing = True
+      return True
+
+  def success(self):
+    with self.lock:
+      metrics.increment('follw_provider_total', provider=self.name, result='success')
+      self.failures = 0
+      self.probing = False
+      self.timeout = self.openTimeout
+      self.setState('closed')
+
+  def failure(self):
+    with self.lock:
+      metrics.increment('follw_provider_total', provider=self.name, result='failure')
+      self.failures += 1
+      if self.state == 'half-open':
+        self.probing = False
+        self.timeout = min(self.timeout * 2, self.maxOpenTimeout)
+      elif self.failures < self.failureThreshold:
+        return
+      self.openedAt = time.monotonic()
+      self.setState('open')
@@ -0,0 +1,184 @@
+import logging, time, mmap, re, os, datetime
+from NMEA import NMEAState, parseSentence
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+replayFormats = ['nmea', 'gpx', 'geojson']
+
+number = rb'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?'
+gpxPoint = re.compile(rb'<(trkpt|rtept)\b([^>]*?)(/>|>(.*?)</\1>)', re.DOTALL)
+gpxAttribute = re.compile(rb'\b(lat|lon)\s*=\s*["\'](' + number + rb')["\']')
+gpxElement = re.compile(rb'<(?:\w+:)?(ele|time|speed|course)>\s*([^<]*?)\s*</')
+geojsonToken = re.compile(rb'"type"\s*:\s*"(\w+)"|"coordinates"\s*:|\[\s*(' + number + rb')\s*,\s*(' + number + rb')(?:\s*,\s*(' + number + rb'))?\s*\]')
+
+def parseISOTime(value):
+  try:
+    return datetime.datetime.fromisoformat(value.decode().replace('Z', '+00:00')).timestamp()
+  except ValueError:
+    return None
+
+def readNMEA(map):
+  state = NMEAState()
+  for line in iter(map.readline, b''):
+    # Recorded logs are often written without checksums
+    sentence = parseSentence(line, requireChecksum=False)
+    if not sentence:
+      continue
+    fix = state.update(*sentence)
+    if fix:
+      timestamp, location = fix
+      yield timestamp.timestamp() if timestamp else None, location
+
+def readGPX(map):
+  for match in gpxPoint.finditer(map):
+    attributes = dict(gpxAttribute.findall(match.group(2)))
+    if b'lat' not in attributes or b'lon' not in attributes:
+      continue
+    elements = dict(gpxElement.findall(match.group(4) or b''))
+    altitude = float(elements[b'ele']) if elements.get(b'ele') else None
+    direction = float(elements[b'course']) if elements.get(b'course') else None
+    speed = float(elements[b'speed']) if elements.get(b'speed') else None
+    timestamp = parseISOTime(elements[b'time']) if elements.get(b'time') else None
+    yield timestamp, [float(attributes[b'lat']), float(attributes[b'lon']), None, altitude, direction, speed]
+
+def readGeoJSON(map):
+  """ Yield the positions of LineString and MultiLineString geometries
+
+  GeoJSON has no timestamps. The "type" member of a geometry must come before its "coordinates"
+  member, which is how practically all GeoJSON writers order them.
+  """
+  geometryType = None
+  inCoordinates = False
+  for match in geojsonToken.finditer(map):
+    if match.group(1) is not None:
+      geometryType = match.group(1)
+      inCoordinates = False
+    elif match.group(2) is None:
+      inCoordinates = True
+    elif inCoordinates and geometryType in (b'LineString', b'MultiLineString'):
+      altitude = float(match.group(4)) if match.group(4) is not None else None
+      yield None, [float(match.group(3)), float(match.group(2)), None, altitude, None, None]
+
+readers = {
+  'nmea': readNMEA,
+  'gpx': readGPX,
+  'geojson': readGeoJSON
+  }
+
+class Replay:
+  """ Location source which plays back a recorded NMEA log, GPX track or GeoJSON LineString
+
+  The file is memory mapped and read with a generator, so large recordings are never loaded whole.
+  A speed of 1 plays back in real time, N plays back N times faster and 0 returns the next
+  location on every call, as fast as possible.
+  """
+  speed = 1
+  loop = False
+  # Seconds between locations of recordings without timestamps
+  step = 1
+
+  def __init__(self, path, speed = None, loop = None, format = None):
+    self.path = path
+    if speed is not None:
+      self.speed = speed
+    if loop is not None:
+      self.loop = loop
+    if not format:
+      extension = os.path.splitext(path)[1].lower()
+      format = {'.gpx': 'gpx', '.geojson': 'geojson', '.json': 'geojson'}.get(extension, 'nmea')
+    if format not in readers:
+      raise ValueError("Unsupported replay format {}".format(format))
+    self.format = format
+    self.method = 'Replay'
+
+    self.file = None
+    self.map = None
+    self.fixes = None
+    self.finished = False
+    # Playback state
+    self.start = None
+    self.firstTime = None
+    self.current = None
+    self.next = None
+    # Monotonic time the current location was measured at during playback
+    self.timestamp = None
+    self.open()
+
+  def open(self):
+    self.close()
+    self.file = open(self.path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.fixes = self.read()
+
+  def close(self):
+    if self.fixes:
+      self.fixes.close()
+      self.fixes = None
+    if self.map:
+      self.map.close()
+      self.map = None
+    if self.file:
+      self.file.close()
+      self.file = None
+
+  def stop(self):
+    self.close()
+
+  def read(self):
+    """ Yield (time, location) tuples, inventing timestamps for recordings without them """
+    index = 0
+    previousTime = None
+    for timestamp, location in readers[self.format](self.map):
+      if timestamp is None:
+        timestamp = previousTime + self.step if previousTime is not None else index * self.step
+      previousTime = timestamp
+      index += 1
+      yield timestamp, location
+
+  def advance(self):
+    """ Get the next fix, starting over at the end of the recording when looping """
+    fix = next(self.fixes, None)
+    if fix is None and self.loop:
+      logger.debug("Restarting replay")
+      self.open()
+      fix = next(self.fixes, None)
+    if fix is None and not self.finished:
+      logger.info("Replay finished")
+      self.finished = True
+    return fix
+
+  def getLocation(self):
+    if self.fixes is None:
+      return None
+
+    if not self.speed:
+      fix = self.advance()
+      if fix:
+        self.current = fix
+        self.timestamp = time.monotonic()
+      return list(self.current[1]) if self.current else None
+
+    now = time.monotonic()
+    if self.start is None:
+      self.next = self.advance()
+      if not self.next:
+        return None
+      self.start = now
+      self.firstTime = self.next[0]
+
+    # Skip ahead to the last location which is due at the current playback time
+    playbackTime = self.firstTime + (now - self.start) * self.speed
+    while self.next and self.next[0] <= playbackTime:
+      self.current = self.next
+      self.next = self.advance()
+      if self.next and self.next[0] < self.current[0]:
+        # Looped back to the start of the recording
+        self.start = now
+        self.firstTime = self.next[0]
+        break
+
+    if self.current:
+      # When the location was recorded, on the playback clock
+      self.timestamp = min(now, self.start + (self.current[0] - self.firstTime) / self.speed)
+    return list(self.current[1]) if self.current else None
@@ -0,0 +1,87 @@
+import logging, time, threading, math
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+scheduleModes = ['fixed-rate', 'fixed-delay']
+
+def checkInterval(interval):
+  # Without any sleep between runs the main loop would spin
+  if not interval > 0:
+    raise ValueError("The interval must be positive, not {}".format(interval))
+  return interval
+
+class Scheduler:
+  """ Sleeps until the next run is due, until it is woken up or until it is stopped """
+  interval = 5
+  # fixed-rate runs on a fixed grid of interval seconds, fixed-delay waits interval seconds after each run
+  mode = 'fixed-rate'
+  # Seconds to wait before retrying an unsuccessful run, None to wait for the next regular run
+  retryInterval = 1
+
+  def __init__(self, interval = None, mode = None):
+    if interval is not None:
+      self.interval = checkInterval(interval)
+    if mode is not None:
+      self.mode = mode
+    self.event = threading.Event()
+    self.terminate = False
+    self.woken = False
+    # Monotonic time of the next run, None to run right away
+    self.due = None
+    # Start of the fixed-rate grid
+    self.anchor = None
+    self.started = None
+
+  def stop(self):
+    self.terminate = True
+    self.event.set()
+
+  def wake(self):
+    """ Make the current wait return right away """
+    self.woken = True
+    self.event.set()
+
+  def setInterval(self, interval):
+    checkInterval(interval)
+    if interval != self.interval:
+      self.interval = interval
+      # Start a new fixed-rate grid from the last run
+      self.anchor = self.started
+      if self.due is not None and self.started is not None:
+        self.due = min(self.due, self.started + interval)
+
+  def wait(self):
+    """ Sleep until the next run is due, returns False when the scheduler has been stopped """
+    while not self.terminate:
+      if self.woken:
+        break
+      if self.due is None:
+        break
+      remaining = self.due - time.monotonic()
+      if remaining <= 0:
+        break
+      self.event.wait(remaining)
+      self.event.clear()
+
+    self.woken = False
+    self.event.clear()
+    self.started = time.monotonic()
+    if self.anchor is None:
+      self.anchor = self.started
+    return not self.terminate
+
+  def done(self, success = True):
+    """ Schedule the next run after a run has finished """
+    now = time.monotonic()
+    if self.mode == 'fixed-rate' and self.interval > 0:
+      # The next slot on the grid, slots that have been missed are skipped
+      slots = math.floor((now - self.anchor) / self.interval) + 1
+      due = self.anchor + slots * self.interval
+    else:
+      due = now + self.interval
+
+    if not success and self.retryInterval is not None:
+      due = min(due, now + self.retryInterval)
+
+    self.due = due
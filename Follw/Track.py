@@ -0,0 +1,177 @@
+import logging, threading, collections
+from array import array
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+nan = float('nan')
+
+class Fix(collections.namedtuple('Fix', ['latitude', 'longitude', 'accuracy', 'altitude', 'direction', 'speed', 'time', 'source'], defaults=(None, None, None, None, None, None))):
+  """ A location with the monotonic time it was measured and the source that measured it
+
+  The first six fields are in the order of the location lists of the location sources, so a fix can
+  be used wherever such a list is expected. fix[:6] gives the location to submit.
+  """
+  __slots__ = ()
+
+  @classmethod
+  def fromLocation(cls, location, time = None, source = None):
+    return cls(*location[:6], *(None,) * (6 - len(location[:6])), time, source)
+
+def toFloat(value):
+  return nan if value is None else float(value)
+
+def fromFloat(value):
+  # NaN is the only value which isn't equal to itself
+  return None if value != value else value
+
+class TrackBuffer:
+  """ The last size fixes in fixed size array('d') columns, oldest first
+
+  Memory use is constant, appending overwrites the oldest fix once the buffer is full. Fixes are
+  kept in time order, so time windows are found with a binary search. A fix older than the newest
+  one, as when sources measure at different times, is inserted in its place.
+  """
+  size = 3600
+
+  def __init__(self, size = None):
+    if size:
+      self.size = size
+    self.lock = threading.Lock()
+    # time, latitude, longitude, accuracy, altitude, direction and speed, NaN for unknown values
+    self.columns = [array('d', [nan]) * self.size for i in range(7)]
+    # Sources are stored as an index into sourceNames
+    self.sources = array('B', [0]) * self.size
+    self.sourceNames = [None]
+    self.start = 0
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def append(self, fix):
+    with self.lock:
+      time = toFloat(fix.time)
+      times = self.columns[0]
+      position = self.count
+      if self.count and time < times[(self.start + self.count - 1) % self.size]:
+        # Position after the last fix measured at or before the fix
+        low = 0
+        while low < position:
+          middle = (low + position) // 2
+          if times[(self.start + middle) % self.size] <= time:
+            low = middle + 1
+          else:
+            position = middle
+        if position == 0 and self.count == self.size:
+          # Older than all fixes of a full buffer
+          return
+
+      if self.count == self.size:
+        self.start = (self.start + 1) % self.size
+        position -= 1
+      else:
+        self.count += 1
+      # Move the newer fixes up to make room
+      for current in range(self.count - 1, position, -1):
+        index = (self.start + current) % self.size
+        previous = (self.start + current - 1) % self.size
+        for column in self.columns:
+          column[index] = column[previous]
+        self.sources[index] = self.sources[previous]
+
+      index = (self.start + position) % self.size
+      self.columns[0][index] = time
+      for column, value in zip(self.columns[1:], fix[:6]):
+        column[index] = toFloat(value)
+
+      if fix.source not in self.sourceNames:
+        if len(self.sourceNames) > 255:
+          logger.warning("Too many location sources to keep track of {}".format(fix.source))
+        else:
+          self.sourceNames.append(fix.source)
+      self.sources[index] = self.sourceNames.index(fix.source) if fix.source in self.sourceNames else 0
+
+  def clear(self):
+    with self.lock:
+      self.start = 0
+      self.count = 0
+
+  def fix(self, index):
+    """ The fix at the ring buffer index, the lock has to be held """
+    values = [fromFloat(column[index]) for column in self.columns]
+    return Fix(*values[1:], values[0], self.sourceNames[self.sources[index]])
+
+  def slice(self, first = 0, last = None):
+    """ The fixes from the first up to the last position, the lock has to be held """
+    if last is None or last > self.count:
+      last = self.count
+    return [self.fix((self.start + position) % self.size) for position in range(first, last)]
+
+  def fixes(self, first = 0, last = None):
+    """ The fixes from the first up to the last position, oldest first """
+    with self.lock:
+      return self.slice(first, last)
+
+  def latest(self, n = 1):
+    """ The n most recent fixes, oldest first """
+    # Positions shift when a fix is appended to a full buffer, so they are only valid while holding the lock
+    with self.lock:
+      return self.slice(max(0, self.count - n))
+
+  def find(self, time):
+    """ Position of the first fix measured at or after time, the lock has to be held """
+    times = self.columns[0]
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      if times[(self.start + middle) % self.size] < time:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def since(self, time):
+    """ The fixes measured at or after the monotonic time """
+    with self.lock:
+      return self.slice(self.find(time))
+
+  def last(self, seconds, now):
+    """ The fixes of the last seconds before the monotonic time now """
+    return self.since(now - seconds)
+
+  def within(self, south, west, north, east, since = None):
+    """ The fixes inside the bounding box, optionally only those measured at or after since
+
+    A bounding box with west larger than east crosses the antimeridian.
+    """
+    with self.lock:
+      first = self.find(since) if since is not None else 0
+      latitudes = self.columns[1]
+      longitudes = self.columns[2]
+      fixes = []
+      for position in range(first, self.count):
+        index = (self.start + position) % self.size
+        latitude = latitudes[index]
+        longitude = longitudes[index]
+        if not south <= latitude <= north:
+          continue
+        if west <= east:
+          if not west <= longitude <= east:
+            continue
+        elif east < longitude < west:
+          continue
+        fixes.append(self.fix(index))
+      return fixes
+
+  def bounds(self, since = None):
+    """ The bounding box (south, west, north, east) of the fixes, None when there are none """
+    with self.lock:
+      first = self.find(since) if since is not None else 0
+      indices = [(self.start + position) % self.size for position in range(first, self.count)]
+      if not indices:
+        return None
+      latitudes = [self.columns[1][index] for index in indices]
+      longitudes = [self.columns[2][index] for index in indices]
+    return min(latitudes), min(longitudes), max(latitudes), max(longitudes)
@@ -0,0 +1,192 @@
+import logging, os, time, threading, ssl, socket, http.client, urllib.parse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class TransportError(Exception):
+  """ Raised when a request could not be delivered to the remote host """
+  pass
+
+def getProxy(scheme, netloc):
+  """ The proxy URL for the scheme and host from the http_proxy, https_proxy and no_proxy environment variables, or None """
+  if not any(name.lower().endswith('_proxy') for name in os.environ):
+    return None
+  # Only needed when a proxy is configured
+  import urllib.request
+  proxy = urllib.request.getproxies_environment().get(scheme)
+  if not proxy or urllib.request.proxy_bypass_environment(urllib.parse.urlsplit('//' + netloc).hostname or netloc):
+    return None
+  if '://' not in proxy:
+    proxy = 'http://' + proxy
+  return urllib.parse.urlsplit(proxy)
+
+def proxyHeaders(proxy):
+  """ The Proxy-Authorization header for a proxy URL with credentials """
+  if not proxy.username:
+    return {}
+  import base64
+  credentials = '{}:{}'.format(urllib.parse.unquote(proxy.username), urllib.parse.unquote(proxy.password or ''))
+  return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
+
+class Response:
+  status = None
+  reason = None
+  headers = None
+  body = None
+  latency = None
+
+  def __init__(self, status, reason, headers, body, latency):
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.body = body
+    self.latency = latency
+
+class Transport:
+  """ Pool of persistent HTTP/1.1 keep-alive connections, one pool per host
+
+  Connections go through the proxy of the http_proxy and https_proxy environment variables, HTTPS
+  connections are tunneled through it.
+  """
+  timeout = 1
+  # Maximum number of idle connections kept open per host
+  maxIdle = 4
+  # Connections that have been idle longer than this are not reused, servers tend to drop them
+  idleTimeout = 30
+
+  def __init__(self, timeout = None):
+    if timeout is not None:
+      self.timeout = timeout
+    self.lock = threading.Lock()
+    # Idle connections per (scheme, netloc), each stored as [connection, lastUsed]
+    self.idle = {}
+    # Last TLS session per netloc, used to resume TLS sessions when reconnecting
+    self.sessions = {}
+    self.sslContext = ssl.create_default_context()
+    # Proxy per (scheme, netloc), None for a direct connection
+    self.proxies = {}
+    self.lastLatency = None
+
+  def close(self):
+    """ Close all idle connections """
+    with self.lock:
+      idle = self.idle
+      self.idle = {}
+    for connections in idle.values():
+      for connection, lastUsed in connections:
+        connection.close()
+
+  def _storeSession(self, netloc, connection):
+    if connection.sock is not None and hasattr(connection.sock, 'session'):
+      self.sessions[netloc] = connection.sock.session
+
+  def _acquire(self, scheme, netloc):
+    now = time.monotonic()
+    with self.lock:
+      connections = self.idle.get((scheme, netloc), [])
+      while connections:
+        connection, lastUsed = connections.pop()
+        if now - lastUsed < self.idleTimeout:
+          return connection, True
+        connection.close()
+    return self._newConnection(scheme, netloc), False
+
+  def _getProxy(self, scheme, netloc):
+    if (scheme, netloc) not in self.proxies:
+      self.proxies[(scheme, netloc)] = getProxy(scheme, netloc)
+    return self.proxies[(scheme, netloc)]
+
+  def _newConnection(self, scheme, netloc):
+    proxy = self._getProxy(scheme, netloc)
+    if scheme == 'https':
+      if proxy:
+        connection = _HTTPSConnection(proxy.netloc.rpartition('@')[2], timeout=self.timeout, context=self.sslContext)
+        connection.set_tunnel(netloc, headers=proxyHeaders(proxy))
+      else:
+        connection = _HTTPSConnection(netloc, timeout=self.timeout, context=self.sslContext)
+      connection.session = self.sessions.get(netloc)
+    elif proxy:
+      connection = http.client.HTTPConnection(proxy.netloc.rpartition('@')[2], timeout=self.timeout)
+    else:
+      connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+    return connection
+
+  def _release(self, scheme, netloc, connection):
+    if scheme == 'https':
+      self._storeSession(netloc, connection)
+    with self.lock:
+      connections = self.idle.setdefault((scheme, netloc), [])
+      if len(connections) < self.maxIdle:
+        connections.append([connection, time.monotonic()])
+        return
+    connection.close()
+
+  def request(self, scheme, netloc, path, method = 'GET', body = None, headers = {}):
+    """ Perform a request over a pooled connection and return a Response """
+    proxy = self._getProxy(scheme, netloc)
+    if proxy and scheme == 'http':
+      # A HTTP proxy is asked for the absolute URL
+      path = 'http://' + netloc + path
+      headers = dict(headers, **proxyHeaders(proxy))
+    attempts = 0
+    while True:
+      connection, reused = self._acquire(scheme, netloc)
+      attempts += 1
+      _time = time.monotonic()
+      try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.CannotSendRequest, http.client.BadStatusLine) as e:
+        connection.close()
+        # The server dropped an idle keep-alive connection, retry once on a fresh connection
+        if reused and attempts == 1:
+          logger.debug("Connection to {} was dropped, reconnecting".format(netloc))
+          continue
+        raise TransportError(e)
+      except (socket.timeout, OSError, http.client.HTTPException) as e:
+        connection.close()
+        raise TransportError(e)
+
+      latency = time.monotonic() - _time
+      self.lastLatency = latency
+
+      if response.will_close:
+        connection.close()
+      else:
+        self._release(scheme, netloc, connection)
+
+      return Response(response.status, response.reason, response.headers, data, latency)
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+  """ HTTPS connection which resumes a previous TLS session when available """
+  session = None
+
+  def __init__(self, host, timeout, context):
+    super().__init__(host, timeout=timeout, context=context)
+    self._sslContext = context
+
+  def connect(self):
+    # Same as http.client.HTTPSConnection.connect() but with TLS session resumption
+    http.client.HTTPConnection.connect(self)
+    # When the server does not accept the session a full handshake is done, through a proxy the tunnel host is the server
+    self.sock = self._sslContext.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host, session=self.session)
+
+class Endpoint:
+  """ Precomputed scheme, host and base path of a URL """
+  def __init__(self, url):
+    parsedUrl = urllib.parse.urlparse(url)
+    self.url = url
+    self.scheme = parsedUrl.scheme
+    self.netloc = parsedUrl.netloc
+    self.path = parsedUrl.path or '/'
+    self.query = parsedUrl.query
+
+  def target(self, query = None):
+    """ Return the request target for the given query string """
+    target = self.path
+    if self.query and query:
+      return target + '?' + self.query + '&' + query
+    if self.query or query:
+      return target + '?' + (self.query or query)
+    return target
@@ -0,0 +1,212 @@
+import sys, os, logging, struct, csv, heapq, mmap, math, tempfile, argparse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+magic = b'FOLLWWF1'
+# BSSID, latitude and longitude in 1e-7 degrees and accuracy in meters
+record = struct.Struct('>6siiH')
+
+# Column names used by WiGLE, MLS and other exports
+bssidColumns = ['MAC', 'mac', 'BSSID', 'bssid', 'netid', 'key']
+latitudeColumns = ['CurrentLatitude', 'trilat', 'lat', 'latitude', 'Latitude']
+longitudeColumns = ['CurrentLongitude', 'trilong', 'lon', 'lng', 'longitude', 'Longitude']
+accuracyColumns = ['AccuracyMeters', 'accuracy', 'range']
+
+def parseBSSID(value):
+  """ Convert a BSSID into 6 bytes, returns None when it's not a valid BSSID """
+  value = value.replace(':', '').replace('-', '').strip()
+  if len(value) != 12:
+    return None
+  try:
+    return bytes.fromhex(value)
+  except ValueError:
+    return None
+
+def formatBSSID(key):
+  return ':'.join('{:02x}'.format(byte) for byte in key)
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+  """ Approximate distance in meters, good enough for the short distances between access points """
+  x = math.radians(longitude2 - longitude1) * math.cos(math.radians((latitude1 + latitude2) / 2))
+  y = math.radians(latitude2 - latitude1)
+  return 6371000 * math.hypot(x, y)
+
+def readCSV(file):
+  """ Yield (key, latitude, longitude, accuracy) tuples from a WiGLE or MLS style CSV export """
+  line = file.readline()
+  # WiGLE exports start with a line describing the export before the header
+  if not line.startswith('WigleWifi'):
+    file.seek(0)
+  reader = csv.DictReader(file)
+  columns = reader.fieldnames or []
+  bssidColumn = next((column for column in bssidColumns if column in columns), None)
+  latitudeColumn = next((column for column in latitudeColumns if column in columns), None)
+  longitudeColumn = next((column for column in longitudeColumns if column in columns), None)
+  accuracyColumn = next((column for column in accuracyColumns if column in columns), None)
+  if not bssidColumn or not latitudeColumn or not longitudeColumn:
+    raise ValueError("CSV file has no BSSID, latitude or longitude column")
+
+  for row in reader:
+    if row.get('Type', 'WIFI') != 'WIFI':
+      continue
+    key = parseBSSID(row[bssidColumn] or '')
+    if not key:
+      continue
+    try:
+      latitude = float(row[latitudeColumn])
+      longitude = float(row[longitudeColumn])
+      accuracy = float(row[accuracyColumn]) if accuracyColumn and row[accuracyColumn] else 0
+    except (TypeError, ValueError):
+      continue
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180 or (latitude == 0 and longitude == 0):
+      continue
+    # The accuracy is stored as an unsigned short, a negative, NaN or infinite one can't be packed
+    if not math.isfinite(accuracy) or accuracy < 0:
+      continue
+    yield key, latitude, longitude, accuracy
+
+def writeRun(records, directory):
+  records.sort()
+  file = tempfile.TemporaryFile(dir=directory)
+  for key, latitude, longitude, accuracy in records:
+    file.write(record.pack(key, round(latitude * 1e7), round(longitude * 1e7), min(65535, round(accuracy))))
+  file.seek(0)
+  return file
+
+def readRun(file):
+  while True:
+    data = file.read(record.size * 4096)
+    if not data:
+      return
+    for key, latitude, longitude, accuracy in record.iter_unpack(data):
+      yield key, latitude / 1e7, longitude / 1e7, accuracy
+
+def importCSV(csvPath, databasePath, chunkSize = 500000):
+  """ Import a CSV export into a database, returns the number of access points
+
+  The rows are sorted in chunks into temporary files which are merged afterwards, so exports with
+  millions of rows don't have to fit in memory. Observations of the same BSSID are averaged.
+  """
+  directory = os.path.dirname(os.path.abspath(databasePath))
+  runs = []
+  records = []
+  with open(csvPath, newline='', encoding='utf-8', errors='replace') as file:
+    for row in readCSV(file):
+      records.append(row)
+      if len(records) >= chunkSize:
+        runs.append(writeRun(records, directory))
+        records = []
+  runs.append(writeRun(records, directory))
+
+  count = 0
+  temporaryPath = databasePath + '.tmp'
+  with open(temporaryPath, 'wb') as database:
+    database.write(magic)
+
+    def write(key, observations):
+      latitude = sum(observation[0] for observation in observations) / len(observations)
+      longitude = sum(observation[1] for observation in observations) / len(observations)
+      # The accuracy is the reported accuracy or the spread of the observations, whichever is larger
+      accuracy = max([observation[2] for observation in observations] + [distance(latitude, longitude, observation[0], observation[1]) for observation in observations])
+      database.write(record.pack(key, round(latitude * 1e7), round(longitude * 1e7), min(65535, round(accuracy))))
+
+    currentKey = None
+    observations = []
+    for key, latitude, longitude, accuracy in heapq.merge(*[readRun(run) for run in runs]):
+      if key != currentKey:
+        if observations:
+          write(currentKey, observations)
+          count += 1
+        currentKey = key
+        observations = []
+      # Keep memory bounded for access points with very many observations
+      if len(observations) < 1000:
+        observations.append((latitude, longitude, accuracy))
+    if observations:
+      write(currentKey, observations)
+      count += 1
+
+  for run in runs:
+    run.close()
+  os.replace(temporaryPath, databasePath)
+  return count
+
+class WiFiDatabase:
+  """ Memory mapped, sorted BSSID index for offline WiFi positioning """
+  # Accuracy in meters of an access point without a known accuracy
+  defaultAccuracy = 50
+  # Signal strength in dBm of an access point without a known signal strength
+  defaultSignal = -90
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.map[:len(magic)] != magic:
+      self.close()
+      raise ValueError("{} is not a WiFi database".format(path))
+    self.count = (len(self.map) - len(magic)) // record.size
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+  def lookup(self, bssid):
+    """ Returns a tuple (latitude, longitude, accuracy) for the BSSID, or None """
+    key = parseBSSID(bssid)
+    if not key:
+      return None
+
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      offset = len(magic) + middle * record.size
+      middleKey = self.map[offset:offset + 6]
+      if middleKey < key:
+        low = middle + 1
+      elif middleKey > key:
+        high = middle
+      else:
+        key, latitude, longitude, accuracy = record.unpack_from(self.map, offset)
+        return latitude / 1e7, longitude / 1e7, accuracy or self.defaultAccuracy
+    return None
+
+  def locate(self, aps):
+    """ Signal weighted centroid of the known access points, returns [latitude, longitude, accuracy] or None """
+    found = []
+    for ap in aps:
+      position = self.lookup(ap['bssid'])
+      if position:
+        signal = ap.get('signal')
+        if signal is None:
+          signal = self.defaultSignal
+        # Weigh by the received amplitude, so nearby access points count more
+        found.append((position, 10 ** (float(signal) / 20)))
+
+    if not found:
+      return None
+
+    totalWeight = sum(weight for position, weight in found)
+    latitude = sum(position[0] * weight for position, weight in found) / totalWeight
+    longitude = sum(position[1] * weight for position, weight in found) / totalWeight
+    # Weighted root mean square of the distance to the centroid and the access point accuracy
+    accuracy = math.sqrt(sum((distance(latitude, longitude, position[0], position[1]) ** 2 + position[2] ** 2) * weight for position, weight in found) / totalWeight)
+    return [latitude, longitude, round(accuracy)]
+
+def main():
+  argparser = argparse.ArgumentParser(description="Import a WiGLE or MLS style CSV export into a WiFi database for offline WiFi location lookup")
+  argparser.add_argument('csv', help="CSV export to import")
+  argparser.add_argument('database', help="WiFi database to create")
+  args = argparser.parse_args()
+
+  logging.basicConfig(format='%(levelname)-8s %(message)s', level=logging.INFO)
+  try:
+    count = importCSV(args.csv, args.database)
+  except (OSError, ValueError) as e:
+    logger.error(e)
+    sys.exit(1)
+  logger.info("Imported {} access points".format(count))
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,10 @@
-import os, sys, logging, signal, argparse, urllib.parse, platform, multiprocessing
-import base64
+import os, sys, logging, signal, argparse, urllib.parse
 
 from Follw import Follw
+from Scheduler import Scheduler, scheduleModes
+from MovementFilter import MovementFilter
 from Location import Location, wifiLocationConfigs, ipLocationConfigs
+from Metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -60,6 +62,7 @@ class IntRange:
     return value
 
 def wigleToken(value):
+  import base64
   try:
     # Decode, then re-encode
     # If the re-encoded string is equal to the encoded string, then it is base64 encoded.
@@ -70,23 +73,90 @@ def wigleToken(value):
 
   raise argparse.ArgumentTypeError("Not a valid WiGLE token")
 
+def gpsdEndpoint(value):
+  from GPSReader import parseEndpoint
+  try:
+    return parseEndpoint(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError("%s is an invalid GPSd endpoint, expected host[:port][/device]" % value)
+
+def startMetrics(args):
+  """ Serve the metrics, this has to be done after daemonizing since threads don't survive a fork """
+  if args.metricsPort:
+    try:
+      metrics.start(args.metricsPort)
+    except OSError as e:
+      logger.error("Can't serve metrics on port {}: {}".format(args.metricsPort, e))
+
+def runFleet(args, foreground):
+  from Fleet import Fleet
+
+  try:
+    fleet = Fleet.load(args.fleet, outboxPath=os.path.join(args.stateDir, 'fleet-outbox.json'))
+  except (OSError, ValueError, KeyError) as e:
+    logger.error("Can't load fleet configuration {}: {}".format(args.fleet, e))
+    sys.exit(1)
+  signal.signal(signal.SIGINT, fleet.stop)
+  signal.signal(signal.SIGTERM, fleet.stop)
+
+  if foreground:
+    startMetrics(args)
+    try:
+      fleet.run()
+    except (KeyboardInterrupt):
+      fleet.stop()
+  else:
+    daemonize()
+    startMetrics(args)
+    fleet.run()
+
 def main():
   # Read command line arguments
   argparser = argparse.ArgumentParser()
-  argparser.add_argument('url', type=url, help="your unique Follw.app sharing URL")
+  argparser.add_argument('url', type=url, nargs='?', help="your unique Follw.app sharing URL")
+  argparser.add_argument("--fleet", dest="fleet", default=None, help="run all shares of the given JSON fleet configuration file in one process")
   argparser.add_argument("-f", "--foreground", dest="foreground", action="store_const", const=True, default=False, help="run process in the foreground")
   argparser.add_argument("--oneshot", dest="oneshot", action="store_const", const=True, default=False, help="submit location only once and exit")
-  argparser.add_argument("-i", "--interval", dest="interval", type=IntRange(0), default=Follw.interval, help="logging interval in seconds (default: %(default)s)")
+  argparser.add_argument("-i", "--interval", dest="interval", type=IntRange(1), default=Follw.interval, help="logging interval in seconds (default: %(default)s)")
+  argparser.add_argument("--stationaryinterval", dest="stationaryInterval", type=IntRange(1), default=MovementFilter.stationaryInterval, help="logging interval in seconds when not moving (default: same as interval)")
+  argparser.add_argument("--deadband", dest="deadBand", type=IntRange(0), default=MovementFilter.deadBand, help="only submit a location when moved more than this many meters (default: %(default)s)")
+  argparser.add_argument("--heartbeat", dest="heartbeat", type=IntRange(0), default=MovementFilter.heartbeat, help="submit the location at least every this many seconds, also when not moving (default: %(default)s)")
+  argparser.add_argument("--schedule", dest="schedule", choices=scheduleModes, default=Scheduler.mode, help="submit on a fixed rate or with a fixed delay between submissions (default: %(default)s)")
+  argparser.add_argument("--wakeonfix", dest="wakeOnFix", action="store_const", const=True, default=False, help="submit as soon as the GPS reports a new location instead of waiting for the interval")
+  argparser.add_argument("--replay", dest="replay", default=None, help="play back the locations of a NMEA log, GPX track or GeoJSON LineString instead of getting the real location")
+  argparser.add_argument("--replayspeed", dest="replaySpeed", type=float, default=1, help="playback speed of the recording, 0 to play back as fast as possible (default: %(default)s)")
+  argparser.add_argument("--replayloop", dest="replayLoop", action="store_const", const=True, default=False, help="start over at the end of the recording")
+  argparser.add_argument("--geofences", dest="geofences", default=None, help="GeoJSON file of polygons inside which locations are suppressed, coarsened or acquired at their own interval")
+  argparser.add_argument("--gpsd", dest="gpsdEndpoints", type=gpsdEndpoint, action="append", default=None, help="read GPS devices from this GPSd host[:port][/device], can be given more than once (default: the local GPSd)")
+  argparser.add_argument("--gpsselection", dest="gpsSelection", choices=['best', 'blend'], default=Location.gpsSelection, help="use the fix of the best GPS device or blend the fixes of all devices (default: %(default)s)")
+  argparser.add_argument("--nmea", dest="nmeaDevice", default=None, help="read NMEA 0183 sentences from this serial GPS device or pty instead of from GPSd")
+  argparser.add_argument("--nmeabaudrate", dest="nmeaBaudRate", type=IntRange(1), default=Location.nmeaBaudRate, help="baud rate of the serial GPS device (default: %(default)s)")
+  argparser.add_argument("--gpsmaxage", dest="gpsMaxAge", type=IntRange(0), default=Location.gpsMaxAge, help="maximum age in seconds of a GPS fix (default: %(default)s)")
   argparser.add_argument("--wifi", "--enablewifilocationlookup", dest="wifiLocationLookup", action="store_const", const=True, default=False, help="enable WiFi location lookup")
   argparser.add_argument("--wifilocationprovider", dest="wifiLocationProvider", choices=wifiLocationConfigs.keys(), default=Location.wifiLocationProvider, help="provider for WiFi location lookup (default: %(default)s)")
   argparser.add_argument("--wifiapikey", dest="wifiAPIKey", default=None, help="")
   argparser.add_argument("--wigletoken", dest="wigleToken", type=wigleToken, default=None, help="your WiGLE authentication token for WiFi location lookup")
   argparser.add_argument("--mlsapikey", dest="mlsAPIKey", default=None, help="your Mozilla Location Service API key")
   argparser.add_argument("--glsapikey", dest="glsAPIKey", default=None, help="your Google Location Service API key")
+  argparser.add_argument("--wifidatabase", dest="wifiDatabase", default=None, help="your WiFi database for offline WiFi location lookup, created with WiFiDatabase.py")
   argparser.add_argument("--ip", "--enableiplocationlookup", dest="ipLocationLookup", action="store_const", const=True, default=False, help="enable external IP address location lookup")
   argparser.add_argument("--iplocationprovider", dest="ipLocationProvider", choices=ipLocationConfigs.keys(), default=Location.ipLocationProvider, help="provider for external IP address location lookup (default: %(default)s)")
+  argparser.add_argument("--ipconsensus", dest="ipConsensus", action="store_const", const=True, default=False, help="query all IP location providers at once and use the median of their answers")
+  argparser.add_argument("--ipquorum", dest="ipQuorum", type=IntRange(1), default=Location.ipQuorum, help="number of IP location providers to wait for with --ipconsensus (default: %(default)s)")
+  argparser.add_argument("--iplocationttl", dest="ipLocationTTL", type=IntRange(0), default=Location.ipLocationTTL, help="seconds the location of an external IP address is cached (default: %(default)s)")
+  argparser.add_argument("--concurrent", dest="concurrent", action="store_const", const=True, default=False, help="query all location sources at once instead of one after the other")
+  argparser.add_argument("--deadline", dest="deadline", type=float, default=Location.deadline, help="maximum time in seconds to wait for a location source which can block, or for all location sources when querying concurrently (default: %(default)s)")
+  argparser.add_argument("--serial", dest="serial", action="store_const", const=True, default=False, help="submit the location on the same thread that acquires it instead of on a separate thread")
+  argparser.add_argument("--fusion", dest="fusion", action="store_const", const=True, default=False, help="combine the locations of all sources into a smoothed location, requires NumPy")
+  argparser.add_argument("--statedir", dest="stateDir", default=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'Follw'), help="directory to keep state such as pending locations and location lookup caches in (default: %(default)s)")
+  argparser.add_argument("--socket", dest="socket", default=None, help="serve the location to other local processes on this Unix domain socket")
+  argparser.add_argument("--metricsport", dest="metricsPort", type=IntRange(1, 65535), default=None, help="serve Prometheus metrics on this port of localhost")
   argparser.add_argument("--debug", dest="debug", action="store_const", const=True, default=False, help="Show debugging messages")
   args = argparser.parse_args()
+  if not args.url and not args.fleet:
+    argparser.error("a sharing URL or a fleet configuration is required")
+  # The outbox and caches are written after daemonizing, which changes to /
+  args.stateDir = os.path.abspath(args.stateDir)
 
   foreground = False
   if args.foreground or args.oneshot:
@@ -108,12 +178,41 @@ def main():
   #else:
   #  logging.basicConfig(filename=logFile, format='%(asctime)s %(levelname)-8s %(name)s.%(funcName)s() %(message)s', datefmt='%x %X', level=logging.INFO)
 
-  follw = Follw()
+  # Dump the metrics to stderr with kill -USR1
+  if hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, metrics.dump)
+  if args.fleet:
+    runFleet(args, foreground)
+    return
+
+  follw = Follw(outboxPath=os.path.join(args.stateDir, 'outbox.json'))
   signal.signal(signal.SIGINT, follw.stop)
   signal.signal(signal.SIGTERM, follw.stop)
 
   follw.oneshot = args.oneshot
   follw.interval = args.interval
+  follw.scheduler.mode = args.schedule
+  follw.wakeOnFix = args.wakeOnFix
+  follw.pipeline = not args.serial
+  follw.movementFilter.stationaryInterval = args.stationaryInterval
+  follw.movementFilter.deadBand = args.deadBand
+  follw.movementFilter.heartbeat = args.heartbeat
+
+  if args.replay:
+    from Replay import Replay
+    try:
+      follw.location.replay = Replay(args.replay, args.replaySpeed, args.replayLoop)
+    except (OSError, ValueError) as e:
+      logger.error("Can't play back {}: {}".format(args.replay, e))
+      sys.exit(1)
+
+  follw.location.gpsMaxAge = args.gpsMaxAge
+  follw.location.gpsdEndpoints = args.gpsdEndpoints
+  follw.location.gpsSelection = args.gpsSelection
+  # The daemon changes its working directory
+  follw.location.nmeaDevice = os.path.abspath(args.nmeaDevice) if args.nmeaDevice else None
+  follw.location.nmeaBaudRate = args.nmeaBaudRate
+  follw.location.cacheDir = args.stateDir
 
   follw.location.wifiLocationLookup = args.wifiLocationLookup
   follw.location.wifiLocationProvider = args.wifiLocationProvider
@@ -131,9 +230,35 @@ def main():
     follw.location.wifiLocationLookup = True
     follw.location.wifiLocationProvider = 'gls'
     follw.location.wifiAPIKey = args.glsAPIKey
+  if args.wifiDatabase:
+    follw.location.wifiLocationLookup = True
+    follw.location.wifiLocationProvider = 'local'
+    follw.location.wifiDatabasePath = os.path.abspath(args.wifiDatabase)
 
   follw.location.ipLocationLookup = args.ipLocationLookup
   follw.location.ipLocationProvider = args.ipLocationProvider
+  follw.location.ipLocationTTL = args.ipLocationTTL
+  follw.location.ipConsensus = args.ipConsensus
+  follw.location.ipQuorum = args.ipQuorum
+  if args.ipConsensus:
+    follw.location.ipLocationLookup = True
+
+  follw.location.concurrent = args.concurrent
+  follw.location.deadline = args.deadline
+  follw.location.fusion = args.fusion
+
+  if args.geofences:
+    from Geofences import Geofences
+    try:
+      follw.geofences = Geofences.load(args.geofences)
+    except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+      logger.error("Can't load geofences {}: {}".format(args.geofences, e))
+      sys.exit(1)
+
+  if args.socket:
+    from LocationServer import LocationServer
+    # The daemon changes its working directory
+    follw.server = LocationServer(os.path.abspath(args.socket), follw.location)
 
   # URL is validated by argparse
   follw.url = args.url
@@ -142,12 +267,14 @@ def main():
     logger.info("Starting Follw")
 
   if foreground:
+    startMetrics(args)
     try:
       follw.run()
     except (KeyboardInterrupt):
       follw.stop()
   else:
     daemonize()
+    startMetrics(args)
     follw.run()
 
 if __name__ == '__main__':
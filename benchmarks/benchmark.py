@@ -0,0 +1,536 @@
+""" Benchmarks of the hot paths of the Follw.app Python client
+
+Starts a local HTTP stub standing in for the Follw.app WebService and the IP and WiFi location
+providers, and a fake GPSd, then measures the latency, throughput, CPU time and peak memory of
+submitLocation, Location.getLocation and Follw.run. The peak memory of every scenario is measured
+in a fresh interpreter of its own. The results are written as JSON, pass a previous result file with
+--compare to see the difference between versions.
+"""
+import sys, os, time, math, json, socket, threading, logging, argparse, platform, resource, statistics, subprocess, http.server, tempfile, re
+
+follwDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Follw')
+sys.path.insert(0, follwDirectory)
+
+# Target in seconds from interpreter start to the first submission of a --oneshot run
+oneshotTarget = 0.25
+# Modules which are only needed by optional location sources and must not be imported at start up
+lazyModules = ['numpy', 'gps', 'sqlite3', 'urllib.request', 'http.server', 'multiprocessing', 'subprocess', 'CoreLocation',
+  'GPSReader', 'LocationCache', 'NL80211', 'WiFiDatabase', 'Fusion', 'Replay', 'Fleet', 'NetworkWatcher', 'NMEAReader', 'Geofences']
+# Scenarios of which the peak memory is measured, idle only starts the stubs
+memoryScenarios = ['idle', 'submitLocation', 'getLocation', 'run']
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+  """ Stands in for Follw.app, ipify.org, ip-api.com, MLS, WiGLE and Yandex """
+  protocol_version = 'HTTP/1.1'
+  publicIPAddresses = 0
+  rotatePublicIPAddress = False
+  # Times at which a location was submitted
+  submitTimes = []
+
+  def reply(self, body, contentType = 'application/json'):
+    body = body.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', contentType)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path.startswith('/ip-api'):
+      self.reply(json.dumps({'lat': 52.37, 'lon': 4.89}))
+    elif self.path.startswith('/ip'):
+      if StubHandler.rotatePublicIPAddress:
+        StubHandler.publicIPAddresses += 1
+      self.reply('198.51.100.{}'.format(StubHandler.publicIPAddresses % 250 + 1), 'text/plain')
+    elif self.path.startswith('/wigle'):
+      self.reply(json.dumps({'success': True, 'results': [{'ssid': 'benchmark', 'locationData': [{'latitude': 52.37, 'longitude': 4.89}]}]}))
+    elif self.path.startswith('/yandex'):
+      self.reply('<location latitude="52.37" longitude="4.89"/>', 'text/xml')
+    else:
+      # Follw.app sharing URL
+      StubHandler.submitTimes.append(time.perf_counter())
+      self.reply('')
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    self.reply(json.dumps({'location': {'lat': 52.37, 'lng': 4.89}, 'accuracy': 30}))
+
+  def log_message(self, format, *args):
+    pass
+
+def startStubServer():
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def startFakeGPSd(rate = 0.01):
+  """ Fake GPSd which streams a TPV report every rate seconds to every client """
+  server = socket.socket()
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind(('127.0.0.1', 0))
+  server.listen()
+
+  def feed(connection):
+    reports = [{'class': 'VERSION'}, {'class': 'DEVICES', 'devices': [{'path': '/dev/ttyUSB0'}]}]
+    try:
+      connection.recv(1024)
+      for report in reports:
+        connection.sendall((json.dumps(report) + '\r\n').encode())
+      i = 0
+      while True:
+        i += 1
+        report = {'class': 'TPV', 'mode': 3, 'lat': 52.37 + i * 1e-6, 'lon': 4.89, 'epx': 3.1, 'epy': 4.2, 'alt': 2.0, 'track': 90.0, 'speed': 1.5}
+        connection.sendall((json.dumps(report) + '\r\n').encode())
+        time.sleep(rate)
+    except OSError:
+      pass
+
+  def serve():
+    while True:
+      connection, address = server.accept()
+      threading.Thread(target=feed, args=(connection,), daemon=True).start()
+
+  threading.Thread(target=serve, daemon=True).start()
+  return server.getsockname()[1]
+
+class FakeScanner:
+  """ Replaces the nl80211 scanner with a fixed set of access points """
+  def getScanResults(self, interface):
+    return [
+      {'bssid': '00:11:22:33:44:55', 'ssid': 'benchmark', 'channel': 6, 'frequency': 2437, 'signal': -50, 'noise': None, 'age': 0, 'associated': True},
+      {'bssid': '00:11:22:33:44:66', 'ssid': 'other', 'channel': 11, 'frequency': 2462, 'signal': -70, 'noise': None, 'age': 100, 'associated': False}
+      ]
+
+def latencyStatistics(latencies):
+  latencies = sorted(latencies)
+  result = {'count': len(latencies)}
+  if latencies:
+    result['mean'] = statistics.fmean(latencies)
+    result['p50'] = latencies[len(latencies) // 2]
+    result['p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    result['max'] = latencies[-1]
+  return result
+
+def measure(function, iterations):
+  """ Call function iterations times, returns latency statistics, throughput and CPU time per call """
+  latencies = []
+  cpu = time.process_time()
+  start = time.perf_counter()
+  for i in range(iterations):
+    _time = time.perf_counter()
+    function()
+    latencies.append(time.perf_counter() - _time)
+  elapsed = time.perf_counter() - start
+  cpu = time.process_time() - cpu
+  return {
+    'latency': latencyStatistics(latencies),
+    'perSecond': iterations / elapsed,
+    'cpuPerCall': cpu / iterations
+    }
+
+def benchmarkSubmit(baseURL, iterations):
+  from Follw import Follw
+  follw = Follw()
+  follw.url = baseURL + '/share/benchmark'
+  i = [0]
+  def submit():
+    i[0] += 1
+    if not follw.submitLocation(52.37 + i[0] * 1e-6, 4.89, 5, 2, 90, 1.5):
+      raise RuntimeError("Submit failed")
+  result = measure(submit, iterations)
+  follw.transport.close()
+  return result
+
+def benchmarkLocation(baseURL, iterations, gpsdPort):
+  import Location, GPSReader
+  results = {}
+
+  Location.ipLocationConfigs['ip-api.com'] = {'url': baseURL + '/ip-api', 'latitudeKey': 'lat', 'longitudeKey': 'lon'}
+  Location.wifiLocationConfigs['mls']['url'] = baseURL + '/mls?key={key}'
+  Location.wifiLocationConfigs['wigle']['url'] = baseURL + '/wigle?netid={bssid}'
+  import NL80211
+  NL80211.getDefaultRouteInterfaces = lambda: ['wlan0']
+
+  def newLocation(watchNetwork = False):
+    location = Location.Location()
+    location.publicIPAddressURL = baseURL + '/ip'
+    location.publicIPAddressInterval = 0
+    # Polls the external IP address on every lookup, unless the network is watched
+    location.watchNetwork = watchNetwork
+    location.wifiScanner = FakeScanner()
+    return location
+
+  # IP location, with the external IP address changing on every call, and cached
+  for name, rotate in [('ip', True), ('ipCached', False)]:
+    StubHandler.rotatePublicIPAddress = rotate
+    location = newLocation()
+    location.ipLocationLookup = True
+    results[name] = measure(location.getLocation, iterations)
+  StubHandler.rotatePublicIPAddress = False
+
+  # The external IP address is only checked again after a network change, polls where netlink isn't available
+  location = newLocation(watchNetwork=True)
+  location.ipLocationLookup = True
+  location.getLocation()
+  results['ipWatched'] = measure(location.getLocation, iterations)
+  location.stop()
+
+  # WiFi location over MLS, the second round is served from the cache
+  location = newLocation()
+  location.wifiLocationLookup = True
+  location.wifiLocationProvider = 'mls'
+  location.wifiAPIKey = 'benchmark'
+  location.getWiFiLocation()
+  results['wifiCached'] = measure(location.getLocation, iterations)
+
+  # GPS through the background GPSd reader
+  if GPSReader.gps:
+    GPSReader.GPSReader.port = gpsdPort
+    location = newLocation()
+    location.getLocation()
+    results['gps'] = measure(location.getLocation, iterations)
+    location.stop()
+  else:
+    results['gps'] = None
+
+  return results
+
+def benchmarkRun(baseURL, duration, pipeline = True):
+  """ Run the main loop sampling at 500Hz for duration seconds """
+  from Follw import Follw
+  follw = Follw()
+  follw.url = baseURL + '/share/run'
+  follw.interval = 0.002
+  follw.pipeline = pipeline
+  follw.movementFilter.deadBand = 0
+
+  # A location source which changes on every call, its fixes carry the time they were acquired
+  from Track import Fix
+  i = [0]
+  def getLocation():
+    i[0] += 1
+    return Fix(52.37 + i[0] * 1e-5, 4.89, 5, 2, 90, 1.5, time.monotonic(), 'Benchmark')
+  follw.location.getLocation = getLocation
+
+  latencies = []
+  deliverLocation = follw.deliverLocation
+  def timedDeliverLocation(location):
+    result = deliverLocation(location)
+    latencies.append(time.monotonic() - location.time)
+    return result
+  follw.deliverLocation = timedDeliverLocation
+
+  timer = threading.Timer(duration, follw.stop)
+  timer.start()
+  cpu = time.process_time()
+  start = time.perf_counter()
+  follw.run()
+  elapsed = time.perf_counter() - start
+  cpu = time.process_time() - cpu
+  timer.cancel()
+
+  return {
+    'fixToSubmitLatency': latencyStatistics(latencies),
+    'submissionsPerSecond': len(latencies) / elapsed,
+    'acquisitionsPerSecond': i[0] / elapsed,
+    'droppedFixes': follw.queue.dropped if follw.queue is not None else 0,
+    'cpuPerCycle': cpu / max(1, i[0])
+    }
+
+def peakRSS():
+  """ Peak resident set size of this process in bytes """
+  # On Linux ru_maxrss survives exec, so a child would report the peak of the benchmark that started it
+  try:
+    with open('/proc/self/status') as file:
+      for line in file:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  # ru_maxrss is in kilobytes on Linux and bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if platform.system() == 'Darwin' else peak * 1024
+
+def runScenario(scenario, iterations, duration):
+  """ Run a single scenario against its own stubs and print its peak memory as JSON """
+  server = startStubServer()
+  baseURL = 'http://127.0.0.1:{}'.format(server.server_port)
+  gpsdPort = startFakeGPSd()
+  if scenario == 'submitLocation':
+    benchmarkSubmit(baseURL, iterations)
+  elif scenario == 'getLocation':
+    benchmarkLocation(baseURL, iterations, gpsdPort)
+  elif scenario == 'run':
+    benchmarkRun(baseURL, duration)
+  print(json.dumps({'peakRSS': peakRSS()}))
+
+def benchmarkMemory(iterations, duration):
+  """ Peak resident set size in bytes of every scenario, each run in a fresh interpreter so they don't hide each other """
+  results = {}
+  for scenario in memoryScenarios:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', scenario, '-n', str(iterations), '-d', str(duration)], check=True, capture_output=True, text=True).stdout
+    results[scenario] = json.loads(output)['peakRSS']
+  return results
+
+def benchmarkStartup(iterations = 5):
+  """ Interpreter start up to an imported client, measured in a fresh interpreter """
+  durations = []
+  for i in range(iterations):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import Follw, Location'], cwd=follwDirectory, check=True, stderr=subprocess.DEVNULL)
+    durations.append(time.perf_counter() - start)
+  return latencyStatistics(durations)
+
+def benchmarkImportTime():
+  """ Import times reported by python -X importtime, and the optional modules that were imported anyway """
+  output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import Follw'], cwd=follwDirectory, check=True, capture_output=True, text=True).stderr
+  modules = {}
+  for match in re.finditer(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$', output, re.MULTILINE):
+    modules[match.group(4)] = int(match.group(2)) / 1e6
+  slowest = sorted(((name, duration) for name, duration in modules.items() if name != 'Follw'), key=lambda module: -module[1])[:10]
+  return {
+    'total': modules.get('Follw'),
+    'slowest': dict(slowest),
+    'lazyModulesImported': [name for name in lazyModules if name in modules]
+    }
+
+def nmeaLog(epochs):
+  """ A NMEA log of a 1Hz receiver, every epoch has a RMC, GGA, GSA, VTG and three GSV sentences """
+  from NMEA import checksum
+  def sentence(body):
+    return '${}*{:02X}\r\n'.format(body, checksum(body.encode())).encode()
+  log = bytearray()
+  for i in range(epochs):
+    hours, minutes, seconds = i // 3600 % 24, i // 60 % 60, i % 60
+    latitude = '{:010.5f}'.format(5222.2 + i * 0.0001)
+    log += sentence('GPRMC,{:02d}{:02d}{:02d}.00,A,{},N,00453.40000,E,2.9,90.0,010124,,,A'.format(hours, minutes, seconds, latitude))
+    log += sentence('GPGGA,{:02d}{:02d}{:02d}.00,{},N,00453.40000,E,1,09,0.9,2.0,M,46.9,M,,'.format(hours, minutes, seconds, latitude))
+    log += sentence('GPGSA,A,3,01,02,03,04,05,06,07,08,09,,,,1.6,0.9,1.3')
+    log += sentence('GPVTG,90.0,T,,M,2.9,N,5.4,K,A')
+    for j in range(3):
+      log += sentence('GPGSV,3,{},09,01,40,083,46,02,17,308,41,03,07,344,39,04,22,228,45'.format(j + 1))
+  return bytes(log)
+
+def benchmarkNMEA(epochs = 20000):
+  """ Sentences per second read straight from a pty, parsed alone, and TPV reports per second on the GPSd path """
+  from NMEA import NMEAParser
+  from NMEAReader import NMEAReader
+  import GPSReader
+  log = nmeaLog(epochs)
+  sentences = log.count(b'\n')
+  results = {}
+
+  # The parser alone, fed in chunks as they are read from a device
+  parser = NMEAParser()
+  start = time.perf_counter()
+  for offset in range(0, len(log), 4096):
+    fixes = parser.feed(log[offset:offset + 4096])
+  elapsed = time.perf_counter() - start
+  results['parser'] = {'sentencesPerSecond': sentences / elapsed, 'fixesPerSecond': epochs / elapsed}
+
+  # A recorded log fed through a pty pair to the reader
+  master, slave = os.openpty()
+  done = threading.Event()
+  last = fixes[-1][1]
+  def callback(location):
+    if location == last:
+      done.set()
+  reader = NMEAReader(os.ttyname(slave), callback=callback)
+  reader.open()
+  os.close(slave)
+  reader.start()
+  start = time.perf_counter()
+  view = memoryview(log)
+  while view:
+    view = view[os.write(master, view[:4096]):]
+  if not done.wait(60):
+    raise RuntimeError("Not all NMEA sentences were read from the pty")
+  elapsed = time.perf_counter() - start
+  reader.stop()
+  reader.join()
+  os.close(master)
+  results['pty'] = {'sentencesPerSecond': sentences / elapsed, 'fixesPerSecond': epochs / elapsed}
+
+  # The same fixes as GPSd TPV reports, only the JSON decoding and handling, without GPSd parsing the NMEA
+  gpsReader = GPSReader.GPSReader()
+  connection = gpsReader.connections[0]
+  reports = [(json.dumps({'class': 'TPV', 'device': '/dev/ttyUSB0', 'mode': 3, 'lat': 52.37 + i * 1e-6, 'lon': 4.89, 'epx': 3.1, 'epy': 4.2, 'alt': 2.0, 'track': 90.0, 'speed': 1.5}) + '\r\n').encode() for i in range(epochs)]
+  start = time.perf_counter()
+  for report in reports:
+    gpsReader.handleReport(connection, json.loads(report))
+  elapsed = time.perf_counter() - start
+  results['gpsd'] = {'reportsPerSecond': epochs / elapsed}
+  return results
+
+def benchmarkGeofences(iterations, count = 5000, batch = 10000):
+  """ Geofence lookups among count polygons of 4 to 40 vertices, one location at a time and as a NumPy batch """
+  import random
+  from Geofences import Geofences, Geofence
+  from Track import Fix
+  generator = random.Random(1)
+  def polygon():
+    latitude, longitude, radius, vertices = generator.uniform(50, 54), generator.uniform(3, 8), generator.uniform(0.005, 0.05), generator.randint(4, 40)
+    ring = [[longitude + radius * math.cos(2 * math.pi * i / vertices), latitude + radius * math.sin(2 * math.pi * i / vertices)] for i in range(vertices)]
+    return [ring + ring[:1]]
+  start = time.perf_counter()
+  geofences = Geofences([Geofence(str(i), [polygon()], generator.choice([None, 'suppress', 'coarsen']), interval=generator.choice([None, 60])) for i in range(count)])
+  results = {'index': time.perf_counter() - start}
+
+  locations = [(generator.uniform(50, 54), generator.uniform(3, 8)) for i in range(batch)]
+  i = [0]
+  def update():
+    i[0] += 1
+    latitude, longitude = locations[i[0] % batch]
+    location = Fix(latitude, longitude, 5, None, None, None, time.monotonic(), 'Benchmark')
+    geofences.update(location)
+    geofences.apply(location)
+  results['update'] = measure(update, iterations)
+
+  try:
+    import numpy
+  except ImportError:
+    results['batchPerLocation'] = None
+    return results
+  latitudes, longitudes = numpy.array(locations).T
+  start = time.perf_counter()
+  geofences.findMany(latitudes, longitudes)
+  results['batchPerLocation'] = (time.perf_counter() - start) / batch
+  return results
+
+def benchmarkOneshot(baseURL, iterations = 5):
+  """ Interpreter start to the first submission of a --oneshot run, as run from cron """
+  durations = []
+  with tempfile.TemporaryDirectory() as directory:
+    track = os.path.join(directory, 'track.gpx')
+    with open(track, 'w') as file:
+      file.write('<gpx><trk><trkseg><trkpt lat="52.37" lon="4.89"/></trkseg></trk></gpx>')
+    for i in range(iterations):
+      del StubHandler.submitTimes[:]
+      start = time.perf_counter()
+      subprocess.run([sys.executable, follwDirectory, '--oneshot', '--replay', track, '--replayspeed', '0', '--statedir', directory, baseURL + '/share/oneshot'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      if StubHandler.submitTimes:
+        durations.append(StubHandler.submitTimes[0] - start)
+  result = latencyStatistics(durations)
+  result['target'] = oneshotTarget
+  return result
+
+def checkNetlink(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netlink.json')):
+  """ Parse the netlink datagrams of netlink.json and compare them with the expected results, returns the list of differences
+
+  The generic netlink controller and rtnetlink datagrams were recorded from a kernel, the nl80211
+  ones are laid out as the kernel sends them.
+  """
+  from NL80211 import parseFamily, parseScanResults
+  from NetworkWatcher import parseRouteEvents, parseWiFiEvents
+  with open(path) as file:
+    fixtures = json.load(file)
+
+  failures = []
+  def check(fixture, result, expected):
+    if result != expected:
+      failures.append("{}: got {}, expected {}".format(fixture['description'], result, expected))
+  datagrams = lambda fixture: [bytes.fromhex(data) for data in fixture['datagrams']]
+
+  for fixture in fixtures['family']:
+    check(fixture, parseFamily(datagrams(fixture)), (fixture['familyId'], fixture['multicastGroups']))
+  for fixture in fixtures['scan']:
+    check(fixture, parseScanResults(datagrams(fixture), fixture['familyId']), fixture['aps'])
+  for fixture in fixtures['route']:
+    linkFlags = {int(index): flags for index, flags in fixture['linkFlags'].items()}
+    addresses = set()
+    events = set()
+    for data in datagrams(fixture):
+      events |= parseRouteEvents(data, linkFlags, addresses)
+    check(fixture, sorted(events), fixture['events'])
+  for fixture in fixtures['wifi']:
+    check(fixture, [[list(association) for association in parseWiFiEvents(data, fixture['familyId'])] for data in datagrams(fixture)], fixture['associations'])
+  return failures
+
+def checkTrack():
+  """ Append fixes out of time order to the track buffer and check the time window queries, returns the list of differences """
+  from Track import Fix, TrackBuffer
+  failures = []
+  for size in (4, 10):
+    track = TrackBuffer(size)
+    # GPS fixes measured in the background alternate with sources that measure when they are asked
+    times = [1, 2, 5, 3, 6, 4, 8, 7, 0.5, 9]
+    for index, time in enumerate(times):
+      track.append(Fix(52 + index, 4.9, 5, time=time, source='GPS' if index % 2 else 'WiFi'))
+    kept = sorted(times)[-size:]
+    if [fix.time for fix in track.fixes()] != kept:
+      failures.append("Track of {} fixes holds {}, expected {}".format(size, [fix.time for fix in track.fixes()], kept))
+    if [fix.time for fix in track.since(4)] != [time for time in kept if time >= 4]:
+      failures.append("Track of {} fixes since 4 returned {}".format(size, [fix.time for fix in track.since(4)]))
+    if any(fix.latitude != 52 + times.index(fix.time) or fix.source != ('GPS' if times.index(fix.time) % 2 else 'WiFi') for fix in track.fixes()):
+      failures.append("Track of {} fixes mixed up the fields of its fixes".format(size))
+  return failures
+
+def compare(results, baseline, path = ''):
+  """ Print the relative difference of every numeric metric """
+  for key, value in results.items():
+    if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+      compare(value, baseline[key], path + key + '.')
+    elif isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+      print("{:60} {:>12.6g} {:>12.6g} {:>+8.1f}%".format(path + key, baseline[key], value, (value - baseline[key]) / baseline[key] * 100))
+
+def main():
+  argparser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  argparser.add_argument("-n", "--iterations", dest="iterations", type=int, default=200, help="iterations per benchmark (default: %(default)s)")
+  argparser.add_argument("-d", "--duration", dest="duration", type=float, default=3, help="seconds to run the main loop (default: %(default)s)")
+  argparser.add_argument("-o", "--output", dest="output", default=None, help="write the results to this JSON file instead of stdout")
+  argparser.add_argument("--compare", dest="compare", default=None, help="compare the results with a previous JSON result file")
+  argparser.add_argument("--scenario", dest="scenario", choices=memoryScenarios, default=None, help="only run this scenario and print its peak memory, used to measure the peak memory of every scenario")
+  argparser.add_argument("--check", dest="check", action="store_const", const=True, default=False, help="exit with an error when the --oneshot target is missed, optional modules are imported at start up, the recorded netlink datagrams aren't parsed as expected or the track buffer doesn't keep out of order fixes in order")
+  args = argparser.parse_args()
+
+  logging.disable(logging.CRITICAL)
+
+  if args.scenario:
+    runScenario(args.scenario, args.iterations, args.duration)
+    return
+
+  server = startStubServer()
+  baseURL = 'http://127.0.0.1:{}'.format(server.server_port)
+  gpsdPort = startFakeGPSd()
+
+  results = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.time(),
+    'startup': benchmarkStartup(),
+    'importTime': benchmarkImportTime(),
+    'oneshot': benchmarkOneshot(baseURL),
+    'submitLocation': benchmarkSubmit(baseURL, args.iterations),
+    'getLocation': benchmarkLocation(baseURL, args.iterations, gpsdPort),
+    'nmea': benchmarkNMEA(),
+    'geofences': benchmarkGeofences(args.iterations),
+    'run': benchmarkRun(baseURL, args.duration),
+    'runSerial': benchmarkRun(baseURL, args.duration, False),
+    'peakRSS': benchmarkMemory(args.iterations, args.duration)
+    }
+
+  output = json.dumps(results, indent=2)
+  if args.output:
+    with open(args.output, 'w') as file:
+      file.write(output)
+  else:
+    print(output)
+
+  if args.compare:
+    with open(args.compare) as file:
+      compare(results, json.load(file))
+
+  if args.check:
+    failures = checkNetlink() + checkTrack()
+    if results['importTime']['lazyModulesImported']:
+      failures.append("Imported at start up: {}".format(', '.join(results['importTime']['lazyModulesImported'])))
+    if results['oneshot'].get('p50', float('inf')) > oneshotTarget:
+      failures.append("Start to first submission {:.3f}s, target {:.3f}s".format(results['oneshot'].get('p50', float('inf')), oneshotTarget))
+    for failure in failures:
+      print(failure, file=sys.stderr)
+    if failures:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()